@@ -3,6 +3,7 @@ Use AMICO - Accelerated Microstructure Imaging via Convex Optimization to fit NO
 """
 import amico
 import os
+from resource_manager import get_thread_budget
 from useful import delete_directory, verify_file
 
 
@@ -11,15 +12,16 @@ def NODDI(dwi, mask):
     Run AMICO to fit NODDI model 
 
     Parameters:
-    - dwi (string): path to diffusion (.nii.gz)
+    - dwi (string): path to diffusion (.nii.gz or .nii, with .bval / .bvec)
     - mask (string): path to brain mask (.nii.gz)
     """
 
     # Paths
     base_dir = os.path.dirname(os.path.dirname(dwi))
     AMICO_dir = os.path.join(base_dir, "AMICO")
-    bval_file = dwi.replace(".nii.gz", ".bval")
-    bvec_file = dwi.replace(".nii.gz", ".bvec")
+    stem = dwi[:-len(".nii.gz")] if dwi.endswith(".nii.gz") else os.path.splitext(dwi)[0]
+    bval_file = stem + ".bval"
+    bvec_file = stem + ".bvec"
     if not verify_file(AMICO_dir):
         # Setup AMICO
         os.chdir(base_dir)
@@ -38,6 +40,8 @@ def NODDI(dwi, mask):
         # Load data
         print("Loading data...")
         ae = amico.Evaluation()
+        # Use the threads given to the stage
+        ae.set_config("nthreads", get_thread_budget())
         ae.load_data(dwi, scheme_file, mask_filename=mask, b0_thr=0)
         print("Data loaded.\n")
 
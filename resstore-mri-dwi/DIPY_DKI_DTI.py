@@ -1,20 +1,20 @@
 """
 Use dipy library to fit Diffusion Tensor Imaging (DTI) and Diffusion Kurtosis Imaging (DKI) model
+(fitted by chunks of voxels on several processes, see model_fitting;
+DKI can be fitted slab by slab with a memory cap)
 """
 
 import os
-import dipy.reconst.dki as dki
-import dipy.reconst.dti as dti
-from dipy.io.image import load_nifti
-from dipy.io.gradients import read_bvals_bvecs
-from dipy.core.gradients import gradient_table
-from dipy.reconst.dti import fractional_anisotropy
 from termcolor import colored
+from dwi_dataset import get_dataset
+from mif_io import load_dwi
+from model_fitting import CHUNK_SIZE, MODEL_METRICS, fit_masked, fit_model_slabs
 from useful import verify_file
 import nibabel as nib
+import numpy as np
 
 
-def dipy_DTI(dwi_unbias_mif, dwi_mask_nii, DTI_dir):
+def dipy_DTI(dwi_unbias_mif, dwi_mask_nii, DTI_dir, n_jobs=None, chunk_size=CHUNK_SIZE):
     """
     Fit DTI model with dipy 
 
@@ -22,33 +22,29 @@ def dipy_DTI(dwi_unbias_mif, dwi_mask_nii, DTI_dir):
     - dwi_unbias_mif (string): diffusion path (.mif)
     - dwi_mask_nii: brain mask path (.nii.gz)
     - DTI_dir (string): output path directory
+    - n_jobs (int): (optionnal) number of processes (default: thread budget)
+    - chunk_size (int): (optionnal) number of voxels fitted at a time
     
     """
 
-    dwi_unbias_nii = dwi_unbias_mif.replace(".mif", ".nii.gz")
-    dwi_bval = dwi_unbias_nii.replace(".nii.gz", ".bval")
-    dwi_bvec = dwi_unbias_nii.replace(".nii.gz", ".bvec")
-
     FA_file = os.path.join(DTI_dir, "dipy_dti_" + "FA" + ".nii.gz")
     print(colored("\n~~DTI dipy starts~~", "cyan"))
 
     if not verify_file(FA_file):
         print("\nDTI recontruction with dipy")
-        data, affine = load_nifti(dwi_unbias_nii)
-        bvals, bvecs = read_bvals_bvecs(dwi_bval, dwi_bvec)
-        gtab = gradient_table(bvals, bvecs)
-        dtimodel = dti.TensorModel(gtab, fit_method='WLS')
-        mask, affine_mask = load_nifti(dwi_mask_nii)
-        dtifit = dtimodel.fit(data, mask=mask)
-        dti_metrics = {"FA": dtifit.fa,
-                    "MD": dtifit.md,
-                    "AD": dtifit.ad,
-                    "RD": dtifit.rd, 
-                    "FA2" :  fractional_anisotropy(dtifit.evals)
-                    }
+        # MIF read directly (memory-mapped), mask and gradient table shared with the other fits
+        dataset = get_dataset(dwi_unbias_mif, dwi_mask_nii)
+        affine = dataset.affine
+        # Only the voxels of the mask, put back in the volume when saved
+        masked = dataset.masked
+        # WLS fit, same maps as TensorModel(gtab, fit_method='WLS').fit(data, mask)
+        dti_metrics = fit_masked(
+            "DTI", masked.signal, dataset.bvals, dataset.bvecs,
+            n_jobs=n_jobs, chunk_size=chunk_size
+        )
 
         for metric in list(dti_metrics.keys()):
-            img = nib.Nifti1Image(dti_metrics[metric], affine)
+            img = nib.Nifti1Image(masked.scatter(dti_metrics[metric]), affine)
             path = os.path.join(DTI_dir, "dipy_dti_" + metric + ".nii.gz")
             nib.save(img, path)
 
@@ -59,7 +55,40 @@ def dipy_DTI(dwi_unbias_mif, dwi_mask_nii, DTI_dir):
     return 1, msg, info_DTI
 
 
-def dipy_DKI(dwi_unbias_mif, dwi_mask_nii, DKI_dir):
+def _dki_slabs(dwi, dwi_mask_nii, DKI_dir, max_memory, n_jobs, chunk_size):
+    """
+    Fit DKI slab by slab (see model_fitting.fit_model_slabs): maps are
+    written in memmaps on disk, then saved in NIfTI
+    """
+    data, affine, bvals, bvecs = load_dwi(dwi, proxy=True)
+    mask = np.asarray(nib.load(dwi_mask_nii).dataobj) > 0
+    tmp_files = {
+        metric: os.path.join(DKI_dir, f".tmp{os.getpid()}_dipy_dki_{metric}.npy")
+        for metric in MODEL_METRICS["DKI"]
+    }
+    try:
+        maps = {
+            metric: np.lib.format.open_memmap(
+                tmp_file, mode="w+", dtype=np.float64, shape=mask.shape)
+            for metric, tmp_file in tmp_files.items()
+        }
+        fit_model_slabs(
+            "DKI", data, mask, bvals, bvecs, maps, max_memory,
+            n_jobs=n_jobs, chunk_size=chunk_size
+        )
+        for metric, metric_map in maps.items():
+            metric_map.flush()
+            img = nib.Nifti1Image(metric_map, affine)
+            path = os.path.join(DKI_dir, "dipy_dki_" + metric + ".nii.gz")
+            nib.save(img, path)
+    finally:
+        for tmp_file in tmp_files.values():
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+def dipy_DKI(dwi_unbias_mif, dwi_mask_nii, DKI_dir, n_jobs=None, chunk_size=CHUNK_SIZE,
+             max_memory=None):
     """
     Fit DKI model with dipy
 
@@ -67,41 +96,46 @@ def dipy_DKI(dwi_unbias_mif, dwi_mask_nii, DKI_dir):
     - dwi_unbias_mif (string): diffusion path (.mif)
     - dwi_mask_nii: brain mask path (.nii.gz)
     - DKI_dir (string): output path directory
-    
-    
+    - n_jobs (int): (optionnal) number of processes (default: thread budget)
+    - chunk_size (int): (optionnal) number of voxels fitted at a time
+    - max_memory (int): (optionnal) memory cap of the fit (bytes): the DWI
+                        is read and fitted slab by slab, None: all the
+                        voxels of the mask at once
+
+    Returns:
+    - int: 1 success, 0 failure
+    - msg
+    - info_DKI (dict): "FA_map", "MD_map" (diffusion tensor of the DKI fit)
     """
 
-    dwi_unbias_nii = dwi_unbias_mif.replace(".mif", ".nii.gz")
-    dwi_bval = dwi_unbias_nii.replace(".nii.gz", ".bval")
-    dwi_bvec = dwi_unbias_nii.replace(".nii.gz", ".bvec")
-
     AD_file = os.path.join(DKI_dir, "dipy_dki_" + "AD" + ".nii.gz")
     print(colored("\n~~DKI starts~~", "cyan"))
 
     if not verify_file(AD_file):
         print("\nDKI recontruction with dipy")
-        data, affine = load_nifti(dwi_unbias_nii)
-        bvals, bvecs = read_bvals_bvecs(dwi_bval, dwi_bvec)
-        gtab = gradient_table(bvals, bvecs)
-        dkimodel = dki.DiffusionKurtosisModel(gtab)
-        mask, affine_mask = load_nifti(dwi_mask_nii)
-        dkifit = dkimodel.fit(data, mask=mask)
-        dki_metrics = {"FA": dkifit.fa,
-                       "MD": dkifit.md,
-                       "AD": dkifit.ad,
-                       "RD": dkifit.rd,
-                       "MK": dkifit.mk(0, 3),
-                       "AK": dkifit.ak(0, 3),
-                       "RK": dkifit.rk(0, 3),
-                       "kFA": dkifit.kfa
-                       }
-
-        for metric in list(dki_metrics.keys()):
-            img = nib.Nifti1Image(dki_metrics[metric], affine)
-            path = os.path.join(DKI_dir, "dipy_dki_" + metric + ".nii.gz")
-            nib.save(img, path)
-
-    info_DKI = {}
+        if max_memory is not None:
+            # Bounded memory: slab by slab, maps written as they are fitted
+            _dki_slabs(dwi_unbias_mif, dwi_mask_nii, DKI_dir, max_memory, n_jobs, chunk_size)
+        else:
+            # MIF read directly (memory-mapped), mask and gradient table shared with the other fits
+            dataset = get_dataset(dwi_unbias_mif, dwi_mask_nii)
+            affine = dataset.affine
+            # Only the voxels of the mask, put back in the volume when saved
+            masked = dataset.masked
+            # FA, MD, AD, RD, MK, AK, RK (0, 3) and kFA
+            dki_metrics = fit_masked(
+                "DKI", masked.signal, dataset.bvals, dataset.bvecs, n_jobs=n_jobs, chunk_size=chunk_size
+            )
+
+            for metric in list(dki_metrics.keys()):
+                img = nib.Nifti1Image(masked.scatter(dki_metrics[metric]), affine)
+                path = os.path.join(DKI_dir, "dipy_dki_" + metric + ".nii.gz")
+                nib.save(img, path)
+
+    info_DKI = {
+        "FA_map": os.path.join(DKI_dir, "dipy_dki_FA.nii.gz"),
+        "MD_map": os.path.join(DKI_dir, "dipy_dki_MD.nii.gz"),
+    }
     msg = "\nDKI done"
     print(colored(msg, "cyan"))
     return 1, msg, info_DKI
@@ -3,6 +3,7 @@ Functions to do "JHU analysis" (registration to MNI)
 
 """
 
+from async_commands import run_commands
 from useful import execute_command, verify_file
 from termcolor import colored
 import csv
@@ -202,25 +203,50 @@ def map_in_MNI_applywarp(map_to_register, T12MNI_warp, b0_to_T1_mat, out_dir):
     - out_dir: output directory path 
 
     """
-    _, map_name = os.path.split(map_to_register)
-    map_name = map_name.replace(".nii.gz", "_in_MNI.nii.gz")
-    map_name = map_name.replace("fit_", "").replace("dipy_", "")
-    map_mni = os.path.join(out_dir, map_name)
+    maps_in_MNI_applywarp([map_to_register], T12MNI_warp, b0_to_T1_mat, out_dir)
 
+
+def maps_in_MNI_applywarp(maps_to_register, T12MNI_warp, b0_to_T1_mat, out_dir,
+                          max_concurrent=None):
+    """
+    Aligning several maps in the MNI space
+    (applywarp commands are run at the same time)
+
+    Parameters:
+    - maps_to_register: list of paths to the maps to register in MNI
+    - T12MNI_warp: path to warp
+    - b0_to_T1_mat: path to prematrice
+    - out_dir: output directory path
+    - max_concurrent: (optionnal) maximum number of applywarp running at
+                      the same time (default: thread budget of the stage)
+
+    Returns:
+    - maps_mni: list of paths to the maps in the MNI space
+    """
     fsl_dir = os.environ.get("FSLDIR")
     template = f"{fsl_dir}/data/standard/MNI152_T1_2mm_brain.nii.gz"
 
-    if not verify_file(map_mni):
-        cmd = [
-            "applywarp",
-            f"--in={map_to_register}",
-            f"--ref={template}",
-            f"--warp={T12MNI_warp}",
-            f"--premat={b0_to_T1_mat}",
-            f"--out={map_mni}",
-            "--interp=trilinear"
-        ]
-        result, stderrl, stdoutl = execute_command(cmd)
+    maps_mni = []
+    commands = []
+    for map_to_register in maps_to_register:
+        _, map_name = os.path.split(map_to_register)
+        map_name = map_name.replace(".nii.gz", "_in_MNI.nii.gz")
+        map_name = map_name.replace("fit_", "").replace("dipy_", "")
+        map_mni = os.path.join(out_dir, map_name)
+        maps_mni.append(map_mni)
+        if not verify_file(map_mni):
+            commands.append([
+                "applywarp",
+                f"--in={map_to_register}",
+                f"--ref={template}",
+                f"--warp={T12MNI_warp}",
+                f"--premat={b0_to_T1_mat}",
+                f"--out={map_mni}",
+                "--interp=trilinear"
+            ])
+
+    results = run_commands(commands, max_concurrent=max_concurrent)
+    for cmd, (result, stderrl, stdoutl) in zip(commands, results):
         if result != 0:
-            print(f"\nCan not pass map in the MNI space (exit code {result}): {stderrl}")
-
+            print(f"\nCan not pass map {cmd[1]} in the MNI space (exit code {result}): {stderrl}")
+    return maps_mni
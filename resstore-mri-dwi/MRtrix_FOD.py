@@ -3,6 +3,7 @@ FOD processing
 """
 
 import os
+from native_tools import execute_native
 from useful import check_file_ext, execute_command, verify_file
 from termcolor import colored
 
@@ -96,7 +97,7 @@ def FOD(in_dwi, mask, FOD_dir, multishell=True, average=True):
             else:
                 print(f"\nVf files succesfully created. Output file: {vf}")
             cmd = ["rm", interm_wm]
-            result, stderrl, sdtoutl = execute_command(cmd)
+            result, stderrl, sdtoutl = execute_native(cmd)
             if result != 0:
                 msg = f"\nCan not remove intermediary file (exit code {result})"
                 return 0, msg, info
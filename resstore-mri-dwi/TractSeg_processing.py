@@ -2,18 +2,25 @@
 Functions to do TractSeg analysis (registration to MNI + run tractseg):
     - run_tractseg
     - replace_dots_with_commas
+    - run_tractometry: Tractometry of several maps at the same time
     - tractometry_postprocess
     - download_template: template for aligning in the MNI space
     - register_to_MNI_FA: align FA and DWI to MNI using TractSeg Template
-    - map_in_MNI_flirt: align any map in the MNI space
+    - map_in_MNI_flirt_applyxfm: align any map in the MNI space
+    - maps_in_MNI_flirt_applyxfm: align several maps at the same time
 
 """
 
 from useful import check_file_ext, execute_command, verify_file, download_subjects_txt, plot_cst_data, convert_mif_to_nifti, convert_nifti_to_mif
+from async_commands import run_commands
+from native_tools import execute_native
+from conversions import get_image
+from brain_mask import compute_brain_mask
 from termcolor import colored
 import csv
 import os
 import pandas as pd
+import tempfile
 import urllib.request
 from termcolor import colored
 
@@ -45,7 +52,7 @@ def run_tractseg(peaks, tract_dir):
     if not verify_file(bundle):
         if not verify_file(peaks_tracto):
             cmd = ["cp", peaks, peaks_tracto]
-            result, stderrl, sdtoutl = execute_command(cmd)
+            result, stderrl, sdtoutl = execute_native(cmd)
             if result != 0:
                 msg = f"\nCan not copy peaks in the tracto directory: {result})"
                 return 0, msg
@@ -61,7 +68,7 @@ def run_tractseg(peaks, tract_dir):
     if not verify_file(bundle):
         cmd = ["TractSeg", "-i", peaks_tracto,
                "--output_type", "tract_segmentation"]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = execute_command(cmd, stream=True)
         if result != 0:
             msg = f"\nCan not run TractSeg tract_segmentation (exit code {result})"
             return 0, msg
@@ -70,28 +77,28 @@ def run_tractseg(peaks, tract_dir):
     if not verify_file(ending_segm):
         cmd = ["TractSeg", "-i", peaks_tracto,
                "--output_type", "endings_segmentation"]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = execute_command(cmd, stream=True)
         if result != 0:
             msg = f"\nCan not run TractSeg endings_segmentation (exit code {result})"
             return 0, msg
 
     if not verify_file(TOM):
         cmd = ["TractSeg", "-i", peaks_tracto, "--output_type", "TOM"]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = execute_command(cmd, stream=True)
         if result != 0:
             msg = f"\nCan not run TractSeg TOM (exit code {result})"
             return 0, msg
 
     if not verify_file(TOM_trackings):
         cmd = ["Tracking", "-i", peaks_tracto, "--tracking_format", "tck"]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = execute_command(cmd, stream=True)
         if result != 0:
             msg = f"\nCan not run TractSeg Tracking (exit code {result})"
             return 0, msg
 
     if not verify_file(uncertainty):
         cmd = ["TractSeg", "-i", peaks_tracto, "--uncertainty"]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = execute_command(cmd, stream=True)
         if result != 0:
             msg = f"\nCan not run TractSeg uncertainty (exit code {result})"
             return 0, msg
@@ -101,6 +108,55 @@ def run_tractseg(peaks, tract_dir):
     return 1, msg
 
 
+def _get_tractometry_csv(map_nii, tractseg_out_dir):
+    """Name of a map and path to its tractometry csv file"""
+    _, map_name_ext = os.path.split(map_nii)
+    map_name, _ = os.path.splitext(map_name_ext)
+    map_name, _ = os.path.splitext(map_name)
+    map_name = map_name.replace("fit_", "")
+    map_name = map_name.replace("dipy_", "")
+    tracto_csv = os.path.join(
+        tractseg_out_dir, "tractometry_" + map_name + ".csv")
+    return map_name, tracto_csv
+
+
+def run_tractometry(maps, tract_dir, max_concurrent=None):
+    """
+    Run Tractometry for several maps at the same time
+    (tractometry_postprocess then only does the plots)
+
+    Parameters:
+    - maps (list of string): paths to maps in NIfTI format
+    - tract_dir (string): path to output directory
+    - max_concurrent (int): (optionnal) maximum number of Tractometry
+                            running at the same time
+
+    Returns:
+    - int: 1 success, 0 failure
+    - msg
+    """
+    tractseg_out_dir = os.path.join(tract_dir, "tractseg_output")
+    ending_segm = os.path.join(tractseg_out_dir, "endings_segmentations")
+    TOM_trackings = os.path.join(tractseg_out_dir, "TOM_trackings")
+    if not (os.path.exists(TOM_trackings) and os.path.exists(ending_segm)):
+        msg = "\nCan not run tractometry: no tracking"
+        return 0, msg
+
+    commands = []
+    for map_nii in maps:
+        _, tracto_csv = _get_tractometry_csv(map_nii, tractseg_out_dir)
+        if not verify_file(tracto_csv):
+            commands.append(["Tractometry", "-i", TOM_trackings, "-o",
+                             tracto_csv, "-e", ending_segm, "-s", map_nii])
+    results = run_commands(commands, max_concurrent=max_concurrent)
+    failed = [cmd[-1] for cmd, res in zip(commands, results) if res[0] != 0]
+    if failed:
+        msg = f"\nCan not run tractometry for: {failed}"
+        return 0, msg
+    msg = "\nTractometry done"
+    return 1, msg
+
+
 def tractometry_postprocess(map, tract_dir):
     """
     Tractometry
@@ -123,14 +179,10 @@ def tractometry_postprocess(map, tract_dir):
             return 0, msg
         else:
             print("\n FA is in mif format.\n")
-            if not verify_file(map_nii):
-                cmd = ["mrconvert", map, map_nii]
-                result, stderrl, sdtoutl = execute_command(cmd)
-                if result != 0:
-                    msg = f"\nCan not convert mif to nii for input map: {result})"
-                    return 0, msg
-            else:
-                print("\n map already exist in nii format.\n")
+            result, msg, map_nii = get_image(map, "nifti", diff=False)
+            if result == 0:
+                msg = f"\nCan not convert mif to nii for input map: {map})"
+                return 0, msg
 
     # Create paths
     tractseg_out_dir = os.path.join(tract_dir, "tractseg_output")
@@ -140,17 +192,11 @@ def tractometry_postprocess(map, tract_dir):
 
     # Run tractometry to create csv file
     if (os.path.exists(TOM_trackings) and os.path.exists(ending_segm)):
-        _, map_name_ext = os.path.split(map_nii)
-        map_name, _ = os.path.splitext(map_name_ext)
-        map_name, _ = os.path.splitext(map_name)
-        map_name = map_name.replace("fit_", "")
-        map_name = map_name.replace("dipy_", "")
-        tracto_csv = os.path.join(
-            tractseg_out_dir, "tractometry_" + map_name + ".csv")
+        map_name, tracto_csv = _get_tractometry_csv(map_nii, tractseg_out_dir)
         if not verify_file(tracto_csv):
             cmd = ["Tractometry", "-i", TOM_trackings, "-o",
                    tracto_csv, "-e", ending_segm, "-s", map_nii]
-            result, stderrl, sdtoutl = execute_command(cmd)
+            result, stderrl, sdtoutl = execute_command(cmd, stream=True)
             if result != 0:
                 msg = f"\nCan not run tractometry: {result})"
                 return 0, msg
@@ -158,7 +204,7 @@ def tractometry_postprocess(map, tract_dir):
 
     if verify_file(peaks_tracto):
         cmd = ["rm", peaks_tracto]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = execute_native(cmd)
         if result != 0:
             msg = f"\nCan not delete peaks copy in the tracto directory: {result})"
             return 0, msg
@@ -211,7 +257,12 @@ def download_template(dir_name):
     if not verify_file(template_path):
         try:
             print("\nDownloading MNI_FA_template.nii.gz...")
-            urllib.request.urlretrieve(github_repo_url, template_path)
+            # Download in a temporary file then rename, so that stages
+            # running at the same time never read a partial template
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix=".nii.gz")
+            os.close(tmp_fd)
+            urllib.request.urlretrieve(github_repo_url, tmp_path)
+            os.replace(tmp_path, template_path)
             print("\nTemplate file downloaded successfully.")
         except Exception as e:
             print(f"\nFailed to download the template file: {e}")
@@ -220,13 +271,16 @@ def download_template(dir_name):
     return template_path
 
 
-def register_to_MNI_FA(in_dwi, in_fa, MNI_dir):
+def register_to_MNI_FA(in_dwi, in_fa, MNI_dir, native_mask=None):
     """
     Aligning image to MNI space
 
     Parameters:
     - in_dwi (string): input file .mif format to be preprocessed, mif format.
     - in_fa (string): input Fractional Anisotropy Map to be preprocessed, mif format.
+    - native_mask (string): (optionnal) brain mask of in_dwi (.nii.gz),
+                            aligned with the FA transform (nearest neighbour)
+                            instead of computing a new mask in the MNI space
 
     """
 
@@ -315,7 +369,7 @@ def register_to_MNI_FA(in_dwi, in_fa, MNI_dir):
     bvals_mni = diffusion_mni.replace(".nii.gz", ".bval")
     if not verify_file(bvals_mni):
         cmd = ["cp", bval, bvals_mni]
-        result, stderrl, stdoutl = execute_command(cmd)
+        result, stderrl, stdoutl = execute_native(cmd)
         if result != 0:
             msg = f"\nCannot copy bvals (exit code {result})"
             return 0, msg, info_mni
@@ -327,47 +381,42 @@ def register_to_MNI_FA(in_dwi, in_fa, MNI_dir):
         diffusion_mni, MNI_dir)
 
     # Brain mask, change after the MNI
-    dwi_mask = diffusion_mni_mif.replace(".mif", "_MNI_mask.mif")
-    dwi_mask_nii = dwi_mask.replace(".mif", ".nii.gz")
-    bzeros_MNI =  diffusion_mni.replace(".nii.gz","_bzero.nii.gz")
-    bzeros_MNI_mean =  diffusion_mni.replace(".nii.gz","_bzero_mean.nii.gz")
-    # Check if the file already exists or not
-    if not verify_file(dwi_mask):
-        # cmd = ["dwi2mask", diffusion_mni_mif, dwi_mask]
-        # result, stderrl, sdtoutl = execute_command(cmd)
-        # if result != 0:
-        #     msg = f"\nCannot launch mask (exit code {result})"
-        #     return 0, msg
-        # else:
-        #     print(f"\nBrain mask completed. Output file: {dwi_mask}")
-
-        if not verify_file(bzeros_MNI_mean):
-            cmd = [
-                "dwiextract", diffusion_mni_mif, bzeros_MNI, "-bzero"
-
-            ]
-            result, stderrl, stdoutl = execute_command(cmd)
-            if result != 0:
-                msg = f"\nCannot launch dwiextract (exit code {result})"
-                return 0, msg
-
+    dwi_mask_nii = diffusion_mni.replace(".nii.gz", "_MNI_mask.nii.gz")
+    if native_mask is not None:
+        # Same transform as the DWI, nearest neighbour to keep a binary mask
+        # (own name, aligned again if the mask or the transform is newer)
+        dwi_mask_nii = diffusion_mni.replace(".nii.gz", "_MNI_mask_warped.nii.gz")
+        if not (
+            verify_file(dwi_mask_nii)
+            and os.path.getmtime(dwi_mask_nii) >= max(
+                os.path.getmtime(native_mask), os.path.getmtime(omat))
+        ):
             cmd = [
-                "mrmath", bzeros_MNI, "mean",  bzeros_MNI_mean,  "-axis",  "3"
+                "flirt",
+                "-ref", template_path,
+                "-in", native_mask,
+                "-out", dwi_mask_nii,
+                "-applyxfm",
+                "-init", omat,
+                "-interp", "nearestneighbour"
             ]
             result, stderrl, stdoutl = execute_command(cmd)
             if result != 0:
-                msg = f"\nCannot launch mrmaths (exit code {result})"
-                return 0, msg
-
-        cmd = [
-            "bet", bzeros_MNI_mean, dwi_mask_nii.replace("_mask.nii.gz",""),  "-m", "-n"
-        ]
-        result, stderrl, stdoutl = execute_command(cmd)
-        if result != 0:
-            msg = f"\nCannot launch bet (exit code {result})"
-            return 0, msg
-        if not verify_file(dwi_mask):
-            convert_nifti_to_mif(dwi_mask_nii, MNI_dir, diff=False)    
+                msg = f"\nCannot launch flirt for brain mask (exit code {result})"
+                return 0, msg, info_mni
+            else:
+                print(
+                    f"\nLinear registration of brain mask completed. Output file: {dwi_mask_nii}")
+        result, msg, dwi_mask = get_image(dwi_mask_nii, "mif", diff=False)
+        if result == 0:
+            return 0, msg, info_mni
+    else:
+        bzeros_MNI_mean = diffusion_mni.replace(".nii.gz", "_bzero_mean.nii.gz")
+        result, msg, info_mask = compute_brain_mask(
+            diffusion_mni, bzeros_MNI_mean, dwi_mask_nii)
+        if result == 0:
+            return 0, msg, info_mni
+        dwi_mask = info_mask["brain_mask"]
 
     # Remove template path
     os.remove(template_path)
@@ -389,26 +438,51 @@ def map_in_MNI_flirt_applyxfm(map_to_register, out_dir, MNI_dir):
     - MNI_dir: directory with the template for MNI registration
 
     """
-    _, map_name = os.path.split(map_to_register)
-    map_name = map_name.replace(".nii.gz", "_MNI.nii.gz")
-    map_name = map_name.replace("fit_", "")
-    map_name = map_name.replace("dipy_", "")
-    map_mni = os.path.join(out_dir, map_name)
+    maps_in_MNI_flirt_applyxfm([map_to_register], out_dir, MNI_dir)
+
+
+def maps_in_MNI_flirt_applyxfm(maps_to_register, out_dir, MNI_dir, max_concurrent=None):
+    """
+    Aligning several maps in the MNI space
+    (flirt commands are run at the same time)
+
+    Parameters:
+    - maps_to_register: list of paths to the maps to register in MNI
+    - out_dir: output directory path
+    - MNI_dir: directory with the template for MNI registration
+    - max_concurrent: (optionnal) maximum number of flirt running at the
+                      same time (default: thread budget of the stage)
+
+    Returns:
+    - maps_mni: list of paths to the maps in the MNI space
+    """
     template = os.path.join(MNI_dir, "MNI_FA_template.nii.gz")
     omat = os.path.join(MNI_dir,  "FA_2_MNI.mat")
     if not os.path.exists(template):
         template = download_template(MNI_dir)
 
-    if not verify_file(map_mni):
-        cmd = [
-            "flirt",
-            "-ref", template,
-            "-in", map_to_register,
-            "-out", map_mni,
-            "-applyxfm",
-            "-init", omat,
-            "-dof", "6"
-        ]
-        result, stderr, stdout = execute_command(cmd)
+    maps_mni = []
+    commands = []
+    for map_to_register in maps_to_register:
+        _, map_name = os.path.split(map_to_register)
+        map_name = map_name.replace(".nii.gz", "_MNI.nii.gz")
+        map_name = map_name.replace("fit_", "")
+        map_name = map_name.replace("dipy_", "")
+        map_mni = os.path.join(out_dir, map_name)
+        maps_mni.append(map_mni)
+        if not verify_file(map_mni):
+            commands.append([
+                "flirt",
+                "-ref", template,
+                "-in", map_to_register,
+                "-out", map_mni,
+                "-applyxfm",
+                "-init", omat,
+                "-dof", "6"
+            ])
+
+    results = run_commands(commands, max_concurrent=max_concurrent)
+    for cmd, (result, stderr, stdout) in zip(commands, results):
         if result != 0:
-            print(f"\nCan not pass map in the MNI space (exit code {result}): {stderr}")
+            print(f"\nCan not pass map {cmd[4]} in the MNI space (exit code {result}): {stderr}")
+    return maps_mni
@@ -0,0 +1,178 @@
+"""
+Run many small commands at the same time (flirt, applywarp,
+Tractometry... on several maps) from one asyncio event loop,
+instead of one after the other with useful.execute_command:
+    - execute_command_async: async counterpart of execute_command
+    - run_commands: run a list of commands with a concurrency limit
+"""
+
+import asyncio
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from termcolor import colored
+
+from resource_manager import apply_thread_budget, get_thread_budget
+from timing import record_command
+from useful import COMMAND_TIMEOUT
+
+# Time given to a command to stop after SIGTERM, before SIGKILL
+KILL_GRACE = 10
+
+
+def _wait_process(p):
+    """
+    Read the outputs of a command, then reap it with wait4 to get its
+    resource usage (run in a thread of the event loop executor)
+    """
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(p.stderr.read()))
+    reader.start()
+    sdtoutl = p.stdout.read()
+    reader.join()
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    return stderr[0], sdtoutl, rusage
+
+
+async def _stop_process(p, waiting):
+    """Stop a command and its children (SIGTERM, then SIGKILL)"""
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        if waiting.done():
+            return
+        try:
+            os.killpg(p.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiting), KILL_GRACE)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def execute_command_async(command, semaphore, timeout=None, n_threads=1):
+    """
+    Execute a command in the event loop
+
+    The command starts once the semaphore is acquired. If the command
+    does not end before its timeout, or if its task is cancelled, the
+    command and its children are killed.
+    The command is reaped with wait4 in a thread of the event loop, so
+    its CPU time and peak memory are recorded (as with execute_command).
+
+    Parameters:
+    - command (list): command to execute
+    - semaphore (asyncio.Semaphore): limit of commands running at the same time
+    - timeout (float): (optionnal) timeout in seconds
+    - n_threads (int): threads given to the command (MRtrix -nthreads,
+                       OMP_NUM_THREADS...)
+
+    Returns:
+    - result: exit code of the command
+    - stderrl
+    - sdtoutl
+    """
+    async with semaphore:
+        command, env = apply_thread_budget(command, n_threads)
+        print("\n", command)
+        start = time.time()
+        p = subprocess.Popen(
+            [str(c) for c in command],
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True,
+            # Own process group, to be able to kill the children
+            start_new_session=True,
+        )
+        waiting = asyncio.get_running_loop().run_in_executor(None, _wait_process, p)
+        rusage = None
+        try:
+            stderrl, sdtoutl, rusage = await asyncio.wait_for(
+                asyncio.shield(waiting), timeout)
+            result = p.returncode
+        except asyncio.TimeoutError:
+            await _stop_process(p, waiting)
+            if waiting.done():
+                rusage = waiting.result()[2]
+            reason = f"Command killed: no end after the timeout of {timeout} s"
+            print(colored(f"{reason} ({command[0]})", "red"))
+            result, stderrl, sdtoutl = p.returncode or 1, reason.encode(), b""
+        except asyncio.CancelledError:
+            await _stop_process(p, waiting)
+            if waiting.done():
+                rusage = waiting.result()[2]
+            record_command(command, start, time.time(), rusage, p.returncode)
+            raise
+        end = time.time()
+
+    record_command(command, start, end, rusage, result)
+    cpu = f", CPU: {rusage.ru_utime + rusage.ru_stime:.1f} s" if rusage else ""
+    print(f"\n{command[0]} (PID {p.pid}) ended with exit code {result}, "
+          f"wall time: {end - start:.1f} s{cpu}")
+    if result != 0 and stderrl:
+        print("stderrl: ", stderrl.decode(errors="replace"))
+    return result, stderrl, sdtoutl
+
+
+async def _run_all(commands, max_concurrent, timeout, n_threads, stop_on_error):
+    """Run all commands, cancel the remaining ones after a failure if asked"""
+    semaphore = asyncio.Semaphore(max_concurrent)
+    # One thread per running command, to read its outputs and reap it
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=max_concurrent))
+    tasks = [
+        asyncio.create_task(execute_command_async(cmd, semaphore, timeout, n_threads))
+        for cmd in commands
+    ]
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        if stop_on_error and any(task.result()[0] != 0 for task in done):
+            print(colored(f"\nA command failed, {len(pending)} commands cancelled", "red"))
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            break
+    return [
+        task.result() if not task.cancelled() else (1, b"Command cancelled", b"")
+        for task in tasks
+    ]
+
+
+def run_commands(commands, max_concurrent=None, timeout=None, stop_on_error=False):
+    """
+    Run several independent commands at the same time
+
+    Parameters:
+    - commands (list of list): commands to execute
+    - max_concurrent (int): maximum number of commands running at the same
+                            time (default: thread budget of the stage)
+    - timeout (float): (optionnal) timeout of each command in seconds
+                       (default: see useful.set_command_timeout)
+    - stop_on_error (boolean): cancel the remaining commands after a failure
+
+    Returns:
+    - results (list): (result, stderrl, sdtoutl) of each command, in the
+                      order of commands
+    """
+    if not commands:
+        return []
+    if timeout is None:
+        timeout = COMMAND_TIMEOUT["seconds"]
+    budget = get_thread_budget()
+    if max_concurrent is None:
+        max_concurrent = budget
+    max_concurrent = max(1, min(max_concurrent, len(commands)))
+    # Threads of the stage are divided between the running commands
+    n_threads = max(1, budget // max_concurrent)
+    print(colored(
+        f"\nRunning {len(commands)} commands, {max_concurrent} at the same time", "yellow"))
+    return asyncio.run(
+        _run_all(commands, max_concurrent, timeout, n_threads, stop_on_error)
+    )
@@ -0,0 +1,240 @@
+"""
+Persistent index of a BIDS directory, used instead of BIDSLayout.
+The index is stored in derivatives/bids_index.json, built once and then
+updated incrementally: only the subject / session directories that
+were added or modified since the last run are scanned again.
+    - parse_bids_filename
+    - load_bids_index
+    - select_subject_session: smaller index for one subject / session
+    - get_files: same filters as BIDSLayout.get(..., return_type="filename")
+    - get_subjects
+    - get_sessions
+Only the entities of the file names are read, so the index is not a
+full replacement of pybids (no longer a dependency):
+    - values are strings (run "01", pybids gives the integer 1)
+    - keys not in ENTITIES (part, mod, desc...) keep their short name
+    - no JSON sidecar metadata (nor inheritance), no .bidsignore, no
+      validation, no files outside the sub-* directories
+The pipeline filters on subject, session, acquisition, direction, suffix
+and extension only.
+"""
+
+import json
+import os
+
+from termcolor import colored
+
+INDEX_VERSION = 1
+INDEX_NAME = "bids_index.json"
+# BIDS keys -> pybids entity names
+ENTITIES = {
+    "sub": "subject",
+    "ses": "session",
+    "acq": "acquisition",
+    "dir": "direction",
+    "run": "run",
+    "task": "task",
+    "rec": "reconstruction",
+    "ce": "ceagent",
+    "echo": "echo",
+}
+
+
+def parse_bids_filename(file_name):
+    """
+    Get BIDS entities from a file name
+
+    Parameters:
+    - file_name (string): ex: sub-013_ses-02_acq-abcd1_dir-PA_dwi.nii.gz
+
+    Returns:
+    - entities (dict): ex: {"subject": "013", "session": "02",
+                            "acquisition": "abcd1", "direction": "PA",
+                            "suffix": "dwi", "extension": "nii.gz"}
+                       None if it is not a BIDS file name
+    """
+    if not file_name.startswith("sub-") or "." not in file_name:
+        return None
+    name, extension = file_name.split(".", 1)
+    parts = name.split("_")
+    entities = {"suffix": parts[-1], "extension": extension}
+    for part in parts[:-1]:
+        if "-" not in part:
+            return None
+        key, value = part.split("-", 1)
+        entities[ENTITIES.get(key, key)] = value
+    return entities
+
+
+def _get_units(bids_path):
+    """List subject / session directories (relative to bids_path)"""
+    units = []
+    for sub_dir in sorted(os.listdir(bids_path)):
+        sub_path = os.path.join(bids_path, sub_dir)
+        if not sub_dir.startswith("sub-") or not os.path.isdir(sub_path):
+            continue
+        ses_dirs = [
+            d for d in sorted(os.listdir(sub_path))
+            if d.startswith("ses-") and os.path.isdir(os.path.join(sub_path, d))
+        ]
+        if ses_dirs:
+            units += [os.path.join(sub_dir, ses_dir) for ses_dir in ses_dirs]
+        else:
+            units.append(sub_dir)
+    return units
+
+
+def _get_signature(unit_path):
+    """Latest modification time of a directory and its sub-directories"""
+    signature = os.stat(unit_path).st_mtime_ns
+    for root, dirs, _ in os.walk(unit_path):
+        for directory in dirs:
+            signature = max(signature, os.stat(os.path.join(root, directory)).st_mtime_ns)
+    return signature
+
+
+def _scan_unit(bids_path, unit):
+    """Index all BIDS files of a subject / session directory"""
+    files = []
+    for root, _, names in os.walk(os.path.join(bids_path, unit)):
+        for name in sorted(names):
+            entities = parse_bids_filename(name)
+            if entities is None:
+                continue
+            entities["path"] = os.path.relpath(os.path.join(root, name), bids_path)
+            files.append(entities)
+    return files
+
+
+def load_bids_index(bids_path, reset=False):
+    """
+    Load the index of a BIDS directory and update it if needed
+
+    Parameters:
+    - bids_path (string): path to the BIDS directory
+    - reset (boolean): rebuild the whole index
+
+    Returns:
+    - index (dict): {"bids_path", "version", "units": {unit: {"signature", "files"}}}
+    """
+    bids_path = os.path.abspath(bids_path)
+    index_path = os.path.join(bids_path, "derivatives", INDEX_NAME)
+
+    index = None
+    if not reset and os.path.exists(index_path):
+        try:
+            with open(index_path, encoding="utf-8") as stream:
+                index = json.load(stream)
+        except (OSError, ValueError):
+            index = None
+        if index is not None and index.get("version") != INDEX_VERSION:
+            index = None
+    if index is None:
+        index = {"version": INDEX_VERSION, "units": {}}
+    index["bids_path"] = bids_path
+
+    # Update index: scan only new / modified directories
+    units = _get_units(bids_path)
+    changed = False
+    scanned = 0
+    for unit in units:
+        signature = _get_signature(os.path.join(bids_path, unit))
+        known = index["units"].get(unit)
+        if known is None or known["signature"] != signature:
+            index["units"][unit] = {
+                "signature": signature,
+                "files": _scan_unit(bids_path, unit),
+            }
+            scanned += 1
+            changed = True
+    removed = set(index["units"]) - set(units)
+    for unit in removed:
+        del index["units"][unit]
+        changed = True
+
+    if changed:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        tmp_path = f"{index_path}.tmp{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as stream:
+            json.dump(index, stream)
+        os.replace(tmp_path, index_path)
+    print(colored(
+        f"\nBIDS index: {len(units)} subject/session directories, "
+        f"{scanned} scanned, {len(removed)} removed ({index_path})", "magenta"))
+    return index
+
+
+def _unit_entities(unit):
+    """Entities of a subject / session directory ({"sub": .., "ses": ..})"""
+    return dict(part.split("-", 1) for part in unit.split(os.sep))
+
+
+def select_subject_session(index, subject, session):
+    """
+    Get the part of the index for one subject / session
+    (small enough to be sent to the processes of the pool)
+
+    Parameters:
+    - index (dict): BIDS index (see load_bids_index)
+    - subject (string): subject name
+    - session (string): session name
+
+    Returns:
+    - index (dict)
+    """
+    units = {}
+    for unit, info in index["units"].items():
+        unit_entities = _unit_entities(unit)
+        if unit_entities.get("sub") == subject and unit_entities.get("ses", session) == session:
+            units[unit] = info
+    return {"version": index["version"], "bids_path": index["bids_path"], "units": units}
+
+
+def get_files(index, return_type="filename", **filters):
+    """
+    Get files of the index
+
+    Parameters:
+    - index (dict): BIDS index (see load_bids_index)
+    - return_type (string): "filename" (absolute paths) or "dict" (entities)
+    - filters: entities to select (subject, session, acquisition,
+               direction, suffix, extension...)
+
+    Returns:
+    - files (list)
+    """
+    if "extension" in filters and filters["extension"] is not None:
+        filters["extension"] = filters["extension"].lstrip(".")
+    subject = filters.get("subject")
+    session = filters.get("session")
+
+    files = []
+    for unit, info in index["units"].items():
+        # Fast selection of the subject / session directory
+        unit_entities = _unit_entities(unit)
+        if subject is not None and unit_entities.get("sub") != subject:
+            continue
+        if session is not None and unit_entities.get("ses", session) != session:
+            continue
+        for entities in info["files"]:
+            if all(entities.get(k) == v for k, v in filters.items() if v is not None):
+                files.append(entities)
+
+    if return_type == "filename":
+        return sorted(os.path.join(index["bids_path"], f["path"]) for f in files)
+    return files
+
+
+def get_subjects(index):
+    """List subjects of the index"""
+    return sorted({
+        f["subject"] for unit in index["units"].values() for f in unit["files"]
+    })
+
+
+def get_sessions(index):
+    """List sessions of the index"""
+    return sorted({
+        f["session"] for unit in index["units"].values()
+        for f in unit["files"] if "session" in f
+    })
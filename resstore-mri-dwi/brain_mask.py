@@ -0,0 +1,119 @@
+"""
+Brain mask of a DWI computed in Python (no dwiextract / mrmath / bet):
+the b0 volumes are selected from the b-values and averaged in one pass
+over the memory-mapped image, then masked with median Otsu (dipy).
+Mean b0 and mask are written once in both formats (.mif and .nii.gz):
+    - save_image: write an array in .mif and .nii.gz
+    - get_mean_bzero
+    - compute_brain_mask
+"""
+
+import os
+
+import nibabel as nib
+import numpy as np
+from dipy.segment.mask import median_otsu
+from termcolor import colored
+
+from conversions import register_conversion
+from mif_io import load_dwi, save_mif
+from native_tools import BZERO_THRESHOLD
+from useful import verify_file
+
+# median_otsu parameters (dipy defaults for DWI)
+MEDIAN_RADIUS = 4
+NUMPASS = 4
+DILATE = 1
+
+
+def save_image(data, affine, out_nii, out_mif):
+    """
+    Write a 3D image in NIfTI and MIF formats (same data, same affine)
+
+    Parameters:
+    - data (3D array)
+    - affine (4x4 array): voxel to scanner transform
+    - out_nii (string): path to the NIfTI (.nii.gz)
+    - out_mif (string): path to the MIF (.mif)
+    """
+    affine = np.asarray(affine, dtype=float)
+    vox = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    transform = np.eye(4)
+    transform[:3, :3] = affine[:3, :3] / vox
+    transform[:3, 3] = affine[:3, 3]
+    nib.save(nib.Nifti1Image(data, affine), out_nii)
+    save_mif(out_mif, data, vox=list(vox), transform=transform)
+    register_conversion(out_nii, out_mif)
+
+
+def get_mean_bzero(in_dwi):
+    """
+    Mean of the b0 volumes of a DWI (one pass, one volume in memory)
+
+    Parameters:
+    - in_dwi (string): path to the DWI (.mif, or .nii.gz with .bval)
+
+    Returns:
+    - mean_b0 (3D array)
+    - affine (4x4 array)
+    """
+    data, affine, bvals, _ = load_dwi(in_dwi)
+    if data.ndim == 3:
+        return np.asarray(data, dtype=np.float32), affine
+    bzeros = np.flatnonzero(bvals <= BZERO_THRESHOLD) if bvals is not None else []
+    if len(bzeros) == 0:
+        raise ValueError(f"No b0 volume in {in_dwi}")
+    mean_b0 = np.zeros(data.shape[:3], dtype=np.float64)
+    for volume in bzeros:
+        mean_b0 += data[..., volume]
+    mean_b0 /= len(bzeros)
+    return mean_b0.astype(np.float32), affine
+
+
+def compute_brain_mask(in_dwi, mean_b0_nii, mask_nii):
+    """
+    Compute the mean b0 and the brain mask of a DWI
+
+    Outputs are not computed again if they are newer than the DWI.
+
+    Parameters:
+    - in_dwi (string): path to the DWI (.mif, or .nii.gz with .bval)
+    - mean_b0_nii (string): path to the mean b0 (.nii.gz), also
+                            written in .mif next to it
+    - mask_nii (string): path to the brain mask (.nii.gz), also written
+                         in .mif next to it
+
+    Returns:
+    - int: 1 success, 0 failure
+    - msg
+    - info (dict): "mean_b0", "mean_b0_mif", "brain_mask", "brain_mask_nii"
+    """
+    mean_b0_mif = mean_b0_nii.replace(".nii.gz", ".mif")
+    mask_mif = mask_nii.replace(".nii.gz", ".mif")
+    info = {"mean_b0": mean_b0_nii, "mean_b0_mif": mean_b0_mif,
+            "brain_mask": mask_mif, "brain_mask_nii": mask_nii}
+    outputs = [mean_b0_nii, mean_b0_mif, mask_nii, mask_mif]
+    if (
+        all(verify_file(path) for path in outputs)
+        and min(os.path.getmtime(path) for path in outputs) >= os.path.getmtime(in_dwi)
+    ):
+        for image in (mean_b0_nii, mask_nii):
+            register_conversion(image, image.replace(".nii.gz", ".mif"))
+        msg = f"\nBrain mask already exists: {mask_nii}"
+        return 1, msg, info
+
+    print(colored("\n~~Brain mask starts~~", "cyan"))
+    try:
+        mean_b0, affine = get_mean_bzero(in_dwi)
+    except (OSError, ValueError) as e:
+        msg = f"\nCannot compute mean b0 of {in_dwi}: {e}"
+        return 0, msg, info
+    _, mask = median_otsu(
+        mean_b0, median_radius=MEDIAN_RADIUS, numpass=NUMPASS, dilate=DILATE
+    )
+    save_image(mean_b0, affine, mean_b0_nii, mean_b0_mif)
+    save_image(mask.astype(np.uint8), affine, mask_nii, mask_mif)
+
+    msg = f"\nBrain mask completed. Output files: {mask_nii}, {mask_mif}"
+    print(colored(msg, "cyan"))
+    return 1, msg, info
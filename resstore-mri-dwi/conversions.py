@@ -0,0 +1,167 @@
+"""
+Registry of the NIfTI / MIF representations of the images.
+A stage asks for an image in a format (get_image): an existing and up to
+date representation is used, otherwise the image is converted once
+(with its bvec / bval files for diffusion data) and the conversion is
+recorded, so the same data is not written again by an other stage:
+    - get_image_format
+    - register_conversion
+    - get_image
+"""
+
+import os
+import threading
+
+from termcolor import colored
+
+FORMATS = {"nifti": ".nii.gz", "mif": ".mif"}
+
+# abs path -> list of conversions {"paths": (source, target), "stamps": {path: mtime_ns}}
+_registry = {}
+_lock = threading.Lock()
+_target_locks = {}
+
+
+def get_image_format(path):
+    """
+    Get the format of an image
+
+    Parameters:
+    - path (string): path to the image
+
+    Returns:
+    - fmt (string): "nifti", "mif" or None
+    """
+    if path.endswith((".nii.gz", ".nii")):
+        return "nifti"
+    if path.endswith(".mif"):
+        return "mif"
+    return None
+
+
+def _stem(path):
+    """File name without the image extension"""
+    name = os.path.basename(path)
+    for ext in [".nii.gz", ".nii", ".mif"]:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def _sidecars(path):
+    """bvec / bval files of a NIfTI image"""
+    base = os.path.join(os.path.dirname(path), _stem(path))
+    return [base + ".bvec", base + ".bval"]
+
+
+def _mtime(path):
+    """Modification time (ns), None if the file does not exist"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def register_conversion(source, target):
+    """
+    Record that target is an other representation of source
+
+    Parameters:
+    - source (string): path to the converted image
+    - target (string): path to the result of the conversion
+    """
+    source, target = os.path.abspath(source), os.path.abspath(target)
+    conversion = {
+        "paths": (source, target),
+        "stamps": {source: _mtime(source), target: _mtime(target)},
+    }
+    with _lock:
+        for path in (source, target):
+            _registry.setdefault(path, []).append(conversion)
+
+
+def _find_registered(path, fmt, diff):
+    """Up to date representation of path in a format, from the registry"""
+    with _lock:
+        conversions = list(_registry.get(path, []))
+    for conversion in reversed(conversions):
+        if any(_mtime(p) != stamp for p, stamp in conversion["stamps"].items()):
+            continue
+        for other in conversion["paths"]:
+            if other == path or get_image_format(other) != fmt:
+                continue
+            if diff and fmt == "nifti" and not all(map(os.path.exists, _sidecars(other))):
+                continue
+            return other
+    return None
+
+
+def _is_up_to_date(source, target, diff):
+    """Target exists and is newer than its source (and sidecars)"""
+    target_mtime = _mtime(target)
+    if target_mtime is None or target_mtime < _mtime(source):
+        return False
+    if diff and get_image_format(target) == "nifti":
+        return all(os.path.exists(p) for p in _sidecars(target))
+    return True
+
+
+def _target_lock(target):
+    """Lock of a target (two stages asking for the same conversion)"""
+    with _lock:
+        return _target_locks.setdefault(target, threading.Lock())
+
+
+def get_image(in_file, fmt, out_directory=None, diff=True):
+    """
+    Get an image in a format, converted only if needed
+
+    Parameters:
+    - in_file (string): path to the image (.nii, .nii.gz or .mif)
+    - fmt (string): "nifti" or "mif"
+    - out_directory (string): (optionnal) directory of the converted image
+                              (default: directory of in_file)
+    - diff (boolean): diffusion image, gradient table is converted too
+                      (bvec / bval files next to the NIfTI)
+
+    Returns:
+    - int: 1 success, 0 failure
+    - msg
+    - out_file: path to the image in the asked format
+    """
+    from useful import execute_command, verify_file
+
+    in_fmt = get_image_format(in_file)
+    if in_fmt is None or fmt not in FORMATS:
+        msg = f"\nCan not convert {in_file} to {fmt}: format not recognized"
+        return 0, msg, None
+    if in_fmt == fmt:
+        return 1, "", in_file
+
+    in_file = os.path.abspath(in_file)
+    registered = _find_registered(in_file, fmt, diff)
+    if registered is not None:
+        return 1, f"\n{registered} already in {fmt} format", registered
+
+    if out_directory is None:
+        out_directory = os.path.dirname(in_file)
+    out_file = os.path.join(os.path.abspath(out_directory), _stem(in_file) + FORMATS[fmt])
+    with _target_lock(out_file):
+        if _is_up_to_date(in_file, out_file, diff) and verify_file(out_file):
+            register_conversion(in_file, out_file)
+            return 1, f"\n{out_file} already in {fmt} format", out_file
+
+        cmd = ["mrconvert", in_file, out_file, "-force"]
+        if diff and fmt == "nifti":
+            cmd += ["-export_grad_fsl"] + _sidecars(out_file)
+        elif diff:
+            cmd += ["-fslgrad"] + _sidecars(in_file)
+        result, stderrl, sdtoutl = execute_command(cmd)
+        if result != 0:
+            msg = f"\nIssue during conversion of {in_file} to {fmt} format"
+            return 0, msg, out_file
+        register_conversion(in_file, out_file)
+
+    msg = f"\nConversion of {in_file} to {fmt} format done"
+    print(colored(msg, "yellow"))
+    return 1, msg, out_file
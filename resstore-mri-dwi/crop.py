@@ -0,0 +1,210 @@
+"""
+Crop of the images to the bounding box of the brain mask (plus a
+margin) before the heavy steps, and uncrop of the maps to the original
+grid. The crop is a shift of the voxel grid, recorded as an affine
+(cropped voxel -> original voxel) in a JSON file next to the images:
+    - CROP_MARGIN: default margin around the brain (voxels)
+    - get_bounding_box
+    - crop_image / uncrop_image: one image (.mif or .nii.gz)
+    - crop_preprocessing: crop the outputs of the preprocessing
+    - uncrop_maps: maps of a directory in the original grid
+"""
+
+import json
+import os
+
+import nibabel as nib
+import numpy as np
+from termcolor import colored
+
+from conversions import register_conversion
+from mif_io import get_affine, load_mif, save_mif
+from useful import convert_mif_to_nifti, verify_file
+
+# Voxels kept around the brain mask
+CROP_MARGIN = 5
+
+
+def get_bounding_box(mask, margin=CROP_MARGIN):
+    """
+    Bounding box of a mask plus a margin (limited to the image)
+
+    Parameters:
+    - mask (3D array)
+    - margin (int): voxels added on each side
+
+    Returns:
+    - start (list of int), stop (list of int): box of each axis
+    """
+    coords = np.nonzero(mask)
+    if len(coords[0]) == 0:
+        raise ValueError("Empty mask")
+    start = [max(0, int(c.min()) - margin) for c in coords]
+    stop = [min(n, int(c.max()) + 1 + margin) for c, n in zip(coords, mask.shape)]
+    return start, stop
+
+
+def _get_crop_affine(start):
+    """Affine of a crop: cropped voxel -> original voxel"""
+    crop_affine = np.eye(4)
+    crop_affine[:3, 3] = start
+    return crop_affine
+
+
+def _load(path):
+    """Data and affine of an image (.mif or .nii.gz), header of a MIF"""
+    if path.endswith(".mif"):
+        data, header = load_mif(path)
+        return data, get_affine(header), header
+    img = nib.load(path)
+    return img.dataobj, img.affine, img.header
+
+
+def _save(path, data, affine, header):
+    """Write an image with a new affine (same format and header as the input)"""
+    if path.endswith(".mif"):
+        vox = np.asarray(header["vox"][:3], dtype=float)
+        transform = np.array(affine, dtype=float)
+        transform[:3, :3] = transform[:3, :3] / vox
+        save_mif(path, data, header=header, transform=transform)
+    else:
+        img = nib.Nifti1Image(np.asarray(data), affine)
+        img.set_data_dtype(header.get_data_dtype())
+        img.header.set_xyzt_units(*header.get_xyzt_units())
+        nib.save(img, path)
+
+
+def crop_image(in_file, out_file, crop_affine, shape):
+    """
+    Crop an image (3D or 4D) to a box
+
+    Parameters:
+    - in_file (string): path to the image (.mif or .nii.gz)
+    - out_file (string): path to the cropped image (same format)
+    - crop_affine (4x4 array): cropped voxel -> original voxel
+    - shape (list of int): spatial shape of the cropped image
+    """
+    data, affine, header = _load(in_file)
+    start = np.asarray(crop_affine)[:3, 3].astype(int)
+    box = tuple(slice(s, s + n) for s, n in zip(start, shape))
+    _save(out_file, data[box], affine @ crop_affine, header)
+
+
+def uncrop_image(in_file, out_file, crop_file):
+    """
+    Put a cropped image (3D or 4D) back in the original grid (0 outside)
+
+    Parameters:
+    - in_file (string): path to the cropped image (.mif or .nii.gz)
+    - out_file (string): path to the image in the original grid
+    - crop_file (string): crop JSON (see crop_preprocessing)
+    """
+    with open(crop_file, encoding="utf-8") as stream:
+        crop = json.load(stream)
+    crop_affine = np.asarray(crop["crop_affine"])
+    data, affine, header = _load(in_file)
+    data = np.asarray(data)
+    start = crop_affine[:3, 3].astype(int)
+    box = tuple(slice(s, s + n) for s, n in zip(start, data.shape[:3]))
+    image = np.zeros(tuple(crop["shape"]) + data.shape[3:], dtype=data.dtype)
+    image[box] = data
+    _save(out_file, image, affine @ np.linalg.inv(crop_affine), header)
+
+
+def crop_preprocessing(info_preproc, margin=CROP_MARGIN):
+    """
+    Crop the preprocessed DWI, brain mask and mean b0 to the bounding box
+    of the brain mask plus a margin. The next steps (fits, registrations,
+    FOD) then use the cropped images. Outputs are not computed again if
+    they are newer than the inputs.
+
+    Parameters:
+    - info_preproc (dict): see preprocessing.run_preproc_dwi
+    - margin (int): (optionnal) voxels kept around the brain mask
+
+    Returns:
+    - int: 1 success, 0 failure
+    - msg
+    - info_crop (dict): "dwi_preproc", "dwi_preproc_nii", "brain_mask",
+                        "brain_mask_nii", "mean_b0" (cropped images) and
+                        "crop" (JSON with the crop affine and the
+                        original shape, for uncrop_image)
+    """
+    images = {
+        name: info_preproc[name]
+        for name in ["dwi_preproc", "brain_mask", "brain_mask_nii", "mean_b0"]
+    }
+    info_crop = {}
+    for name, image in images.items():
+        for ext in (".nii.gz", ".mif"):
+            if image.endswith(ext):
+                info_crop[name] = image[:-len(ext)] + "_crop" + ext
+    crop_file = os.path.join(os.path.dirname(images["dwi_preproc"]), "crop.json")
+    info_crop["crop"] = crop_file
+
+    outputs = list(info_crop.values())
+    if not (
+        all(verify_file(path) for path in outputs)
+        and min(map(os.path.getmtime, outputs)) >= max(map(os.path.getmtime, images.values()))
+    ):
+        print(colored("\n~~Crop starts~~", "cyan"))
+        mask = np.asarray(nib.load(images["brain_mask_nii"]).dataobj) > 0
+        try:
+            start, stop = get_bounding_box(mask, margin)
+        except ValueError as e:
+            msg = f"\nCan not crop to {images['brain_mask_nii']}: {e}"
+            return 0, msg, info_crop
+        shape = [b - a for a, b in zip(start, stop)]
+        crop_affine = _get_crop_affine(start)
+        for name, image in images.items():
+            crop_image(image, info_crop[name], crop_affine, shape)
+        with open(crop_file, "w", encoding="utf-8") as stream:
+            json.dump({
+                "shape": list(mask.shape),
+                "start": start,
+                "stop": stop,
+                "margin": margin,
+                "crop_affine": crop_affine.tolist(),
+            }, stream, indent=4)
+        print(f"\nCropped from {list(mask.shape)} to {shape} voxels")
+    register_conversion(info_crop["brain_mask_nii"], info_crop["brain_mask"])
+
+    # NIfTI (and bvec / bval) of the cropped DWI
+    result, msg, dwi_crop_nii = convert_mif_to_nifti(
+        info_crop["dwi_preproc"], os.path.dirname(crop_file), diff=True)
+    if result == 0:
+        return 0, msg, info_crop
+    info_crop["dwi_preproc_nii"] = dwi_crop_nii
+
+    msg = f"\nCrop done: {crop_file}"
+    print(colored(msg, "cyan"))
+    return 1, msg, info_crop
+
+
+def uncrop_maps(map_dir, out_dir, crop_file):
+    """
+    Put the maps of a directory (.nii.gz and .mif) back in the original
+    grid (maps already uncropped and newer are skipped)
+
+    Parameters:
+    - map_dir (string): directory of the cropped maps
+    - out_dir (string): output directory
+    - crop_file (string): crop JSON (see crop_preprocessing)
+
+    Returns:
+    - maps (list of string): paths to the maps in the original grid
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    maps = []
+    for file_name in sorted(os.listdir(map_dir)):
+        if not file_name.endswith((".nii.gz", ".mif")):
+            continue
+        in_file = os.path.join(map_dir, file_name)
+        out_file = os.path.join(out_dir, file_name)
+        if not (
+            os.path.exists(out_file)
+            and os.path.getmtime(out_file) >= os.path.getmtime(in_file)
+        ):
+            uncrop_image(in_file, out_file, crop_file)
+        maps.append(out_file)
+    return maps
@@ -0,0 +1,99 @@
+"""
+Concatenation of DWI series in Python (instead of dwicat): the b=0
+intensities of each series are matched to the first one, then all the
+volumes are written in one pass over the memory-mapped inputs:
+    - get_bzero_scaling
+    - concatenate_dwi
+"""
+
+import numpy as np
+from termcolor import colored
+
+from brain_mask import get_mean_bzero
+from mif_io import load_mif, write_mif_volumes
+
+
+def _get_mask(mean_b0s):
+    """Voxels with signal in the mean b0 of all the series"""
+    mask = np.ones(mean_b0s[0].shape, dtype=bool)
+    for mean_b0 in mean_b0s:
+        mask &= mean_b0 > 0.1 * np.percentile(mean_b0, 99)
+    return mask
+
+
+def get_bzero_scaling(in_files):
+    """
+    Scaling factors matching the b=0 intensities of each series to the
+    first one (as dwicat: histogram matching of the mean b0, scale only,
+    in the voxels with signal in all the series)
+
+    Parameters:
+    - in_files (list of string): paths to the DWI (.mif)
+
+    Returns:
+    - scales (list of float): one per series (1 for the first one)
+    """
+    mean_b0s = [get_mean_bzero(in_file)[0] for in_file in in_files]
+    mask = _get_mask(mean_b0s)
+    if not mask.any():
+        raise ValueError("No voxel with signal in all the series")
+    reference = np.sort(mean_b0s[0][mask].astype(np.float64))
+    scales = [1.0]
+    for mean_b0 in mean_b0s[1:]:
+        values = np.sort(mean_b0[mask].astype(np.float64))
+        scales.append(float(np.dot(reference, values) / np.dot(values, values)))
+    return scales
+
+
+def concatenate_dwi(in_files, out_file):
+    """
+    Concatenate DWI series (dwicat)
+
+    Parameters:
+    - in_files (list of string): paths to the DWI (.mif), same grid
+    - out_file (string): path to the concatenated DWI (.mif)
+
+    Returns:
+    - int: 1 success, 0 failure
+    - msg
+    """
+    print(colored("\n~~Concatenation of DWI starts~~", "cyan"))
+    images = [load_mif(in_file) for in_file in in_files]
+    first_data, first_header = images[0]
+    for in_file, (data, header) in zip(in_files, images):
+        if data.ndim not in (3, 4) or data.shape[:3] != first_data.shape[:3]:
+            msg = f"\nCan not concatenate {in_file}: not the same grid as {in_files[0]}"
+            return 0, msg
+        if not np.allclose(header["transform"], first_header["transform"], atol=1e-3):
+            msg = f"\nCan not concatenate {in_file}: not the same transform as {in_files[0]}"
+            return 0, msg
+        if header["dw_scheme"] is None:
+            msg = f"\nCan not concatenate {in_file}: no gradient table"
+            return 0, msg
+    try:
+        scales = get_bzero_scaling(in_files)
+    except ValueError as e:
+        msg = f"\nCan not concatenate {in_files}: {e}"
+        return 0, msg
+    print(f"\nb=0 scaling factors: {scales}")
+
+    def volumes():
+        """Volumes of all the series, scaled"""
+        for (data, _), scale in zip(images, scales):
+            data = data[..., None] if data.ndim == 3 else data
+            for volume in range(data.shape[3]):
+                yield np.asarray(data[..., volume], dtype=np.float32) * np.float32(scale)
+
+    n_volumes = sum(1 if data.ndim == 3 else data.shape[3] for data, _ in images)
+    dw_scheme = np.concatenate([header["dw_scheme"] for _, header in images])
+    header = dict(first_header)
+    header["keyval"] = dict(first_header["keyval"])
+    header["keyval"]["bzero_scaling"] = [",".join(f"{scale:.6g}" for scale in scales)]
+    write_mif_volumes(
+        out_file, first_data.shape[:3] + (n_volumes,), np.float32, volumes(),
+        header=header, dw_scheme=dw_scheme
+    )
+
+    msg = f"\nConcatenation done ({n_volumes} volumes): {out_file}"
+    print(colored(msg, "cyan"))
+    return 1, msg
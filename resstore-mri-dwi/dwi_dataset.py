@@ -0,0 +1,174 @@
+"""
+DWI of an acquisition shared by the model fits (dipy DTI, dipy DKI,
+AMICO NODDI): the DWI (float32, memory-mapped when possible), the brain
+mask and the gradient table are loaded once and the same buffers are
+given to every stage of the process. The fits work on the voxels of
+the mask only (MaskedDWI: one row of signal per voxel), maps are put
+back in the volume when they are written:
+    - MaskedDWI: signal of the voxels of a mask (n_voxels x n_volumes)
+    - DWIDataset
+    - get_dataset: dataset of a DWI / mask, loaded at the first call
+"""
+
+import os
+import threading
+
+import nibabel as nib
+import numpy as np
+from dipy.core.gradients import gradient_table
+
+from mif_io import load_dwi
+
+# (dwi, mask) -> (stamps, DWIDataset)
+_datasets = {}
+_lock = threading.Lock()
+
+
+def _stamp(path):
+    """Modification time (ns) of a file, None if no file"""
+    return None if path is None else os.stat(path).st_mtime_ns
+
+
+class MaskedDWI:
+    """
+    Signal of the voxels of a mask, built in one pass over the volumes
+
+    Attributes:
+    - signal (2D array): n_voxels x n_volumes, float32, one contiguous
+                         row per voxel (voxels in C order of the volume)
+    - indices (tuple of 3 arrays): coordinates of the voxels (np.nonzero)
+    - shape (tuple): shape of a volume
+    """
+
+    def __init__(self, data, mask=None):
+        self.shape = tuple(data.shape[:3])
+        if mask is None:
+            mask = np.ones(self.shape, dtype=bool)
+        mask = np.asarray(mask, dtype=bool)
+        self.indices = np.nonzero(mask)
+        n_volumes = data.shape[3] if data.ndim == 4 else 1
+        self.signal = np.empty((len(self.indices[0]), n_volumes), dtype=np.float32)
+        if data.ndim == 3:
+            self.signal[:, 0] = data[mask]
+        else:
+            # Volume by volume (data may be a memmap)
+            for volume in range(n_volumes):
+                self.signal[:, volume] = data[..., volume][mask]
+
+    @property
+    def n_voxels(self):
+        """Number of voxels of the mask"""
+        return self.signal.shape[0]
+
+    def scatter(self, values, fill=0):
+        """
+        Put values of the voxels back in the volume
+
+        Parameters:
+        - values (array): n_voxels (map) or n_voxels x N (4D image)
+        - fill: value outside the mask
+
+        Returns:
+        - image (3D or 4D array): same dtype as values
+        """
+        values = np.asarray(values)
+        image = np.full(self.shape + values.shape[1:], fill, dtype=values.dtype)
+        image[self.indices] = values
+        return image
+
+
+class DWIDataset:
+    """
+    DWI, brain mask and gradient table of an acquisition
+
+    Attributes:
+    - dwi (string): path to the DWI (.mif or .nii.gz)
+    - data (4D array): DWI, float32 (memmap of the .mif if stored in float32)
+    - affine (4x4 array)
+    - bvals (array), bvecs (N x 3 array): FSL convention
+    - mask (3D boolean array): None if no mask was given
+    - gtab: dipy gradient table (built at the first use)
+    - masked: MaskedDWI of the mask (built at the first use, all the
+              voxels if no mask was given)
+    """
+
+    def __init__(self, dwi, mask=None):
+        self.dwi = os.path.abspath(dwi)
+        self.mask_file = None if mask is None else os.path.abspath(mask)
+        data, self.affine, self.bvals, self.bvecs = load_dwi(self.dwi)
+        if data.dtype != np.float32:
+            data = np.asarray(data, dtype=np.float32)
+        self.data = data
+        self.mask = None
+        if mask is not None:
+            self.mask = np.asarray(nib.load(mask).dataobj) > 0
+        self._gtab = None
+        self._masked = None
+        self._lock = threading.Lock()
+
+    @property
+    def gtab(self):
+        """dipy gradient table"""
+        if self._gtab is None:
+            self._gtab = gradient_table(self.bvals, self.bvecs)
+        return self._gtab
+
+    @property
+    def masked(self):
+        """Signal of the voxels of the mask"""
+        with self._lock:
+            if self._masked is None:
+                self._masked = MaskedDWI(self.data, self.mask)
+        return self._masked
+
+    def get_nifti(self):
+        """
+        Uncompressed NIfTI of the DWI for the tools reading files (AMICO),
+        written once next to the DWI with its .bval / .bvec files
+
+        Returns:
+        - path (string): path to the .nii
+        """
+        base = self.dwi
+        for ext in (".nii.gz", ".mif", ".nii"):
+            if base.endswith(ext):
+                base = base[:-len(ext)]
+                break
+        out_file = base + ".nii"
+        with self._lock:
+            if not (
+                os.path.exists(out_file)
+                and os.path.getmtime(out_file) >= os.path.getmtime(self.dwi)
+            ):
+                tmp_file = os.path.join(
+                    os.path.dirname(out_file), f".tmp{os.getpid()}_{os.path.basename(out_file)}")
+                nib.save(nib.Nifti1Image(self.data, self.affine), tmp_file)
+                os.replace(tmp_file, out_file)
+            if not os.path.exists(base + ".bval"):
+                np.savetxt(base + ".bval", self.bvals[None], fmt="%g")
+            if not os.path.exists(base + ".bvec"):
+                np.savetxt(base + ".bvec", self.bvecs.T, fmt="%.10g")
+        return out_file
+
+
+def get_dataset(dwi, mask=None):
+    """
+    Get the dataset of a DWI, loaded only once per process
+    (loaded again if the DWI or the mask was modified)
+
+    Parameters:
+    - dwi (string): path to the DWI (.mif or .nii.gz with .bval / .bvec)
+    - mask (string): (optionnal) path to the brain mask (.nii.gz)
+
+    Returns:
+    - dataset (DWIDataset)
+    """
+    key = (os.path.abspath(dwi), None if mask is None else os.path.abspath(mask))
+    stamps = (_stamp(dwi), _stamp(mask))
+    with _lock:
+        cached = _datasets.get(key)
+        if cached is not None and cached[0] == stamps:
+            return cached[1]
+        dataset = DWIDataset(dwi, mask)
+        _datasets[key] = (stamps, dataset)
+    return dataset
@@ -1,8 +1,11 @@
 """
 Main code to launch to process RESSTORE diffusion data
 
-python main.py --bids folder_bids_path 
+python main.py --bids folder_bids_path
 --subjects 01001 01002 --sessions V2 V5 --acquisitions abcd hermes
+
+Use --jobs N to process N subject / session / acquisition at the same time
+and --stage_workers N to run N independent stages of one acquisition at the same time
 """
 
 import argparse
@@ -10,20 +13,205 @@ import json
 import os
 import sys
 import csv
+from concurrent.futures import ThreadPoolExecutor
 
-from bids import BIDSLayout
+from bids_index import get_files, get_sessions, get_subjects, load_bids_index, select_subject_session
 from termcolor import colored
 from prepare_acquisitions import prepare_abcd_acquistions, prepare_hermes_acquistions
-from useful import convert_nifti_to_mif, convert_mif_to_nifti, execute_command, get_shell, verify_file
-from preprocessing import run_preproc_dwi
-from MRtrix_FOD import FOD
-from MRtrix_DTI import mrtrix_DTI
-from T1_preproc import t1_bet
-from TractSeg_processing import run_tractseg, tractometry_postprocess, map_in_MNI_flirt_applyxfm, register_to_MNI_FA
-from JHU_analysis import register_to_MNI_using_T1w, map_in_MNI_applywarp
-from remove_volume import remove_volumes
-from DIPY_DKI_DTI import dipy_DKI, dipy_DTI
-from AMICO_NODDI import NODDI
+from useful import convert_nifti_to_mif, get_shell, set_command_timeout
+from remove_volume import read_volumes_to_remove, remove_volumes
+from volume_qc import detect_outlier_volumes
+from pipeline_stages import TENSOR_BACKENDS, get_processing_stages
+from preprocessing import DENOISE_BACKENDS, DISCARDABLE_INTERMEDIATES
+from crop import CROP_MARGIN
+from scheduler import get_analysis_directory, get_timeline_path, print_summary, run_units
+from stage_graph import run_stage_graph
+from timing import timed_stage, write_cohort_report
+
+
+def _prepare_acquisition(bids_path, sub, ses, acq, preproc_directory, in_t1w_nifti,
+                         volumes, index):
+    """
+    Convert T1w, DWI and pepolar to MIF, merge DWI and remove volumes if needed
+
+    Returns:
+    - int 1 success, 0 failure
+    - msg
+    - (in_dwi, in_dwi_json, in_pepolar_AP, in_pepolar_PA)
+    """
+    if "abcd" in acq:
+        prepare = prepare_abcd_acquistions
+    elif "hermes" in acq:
+        prepare = prepare_hermes_acquistions
+    else:
+        msg = f"\nAcquisition {acq} is not supported (abcd, hermes)"
+        return 0, msg, None
+
+    # T1w converted to MIF while DWI and pepolar are prepared
+    # (DWI and pepolar are also converted at the same time)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        if in_t1w_nifti:
+            t1w_future = executor.submit(
+                convert_nifti_to_mif, in_t1w_nifti, preproc_directory, False
+            )
+        else:
+            print(
+                f"\nNo T1w data found for subject {sub} in session {ses}."
+                "Proceeding without T1w data."
+            )
+            t1w_future = None
+        # Get DWI and pepolar, convert to MIF, merge DWI and get info
+        result, msg, acquisitions = prepare(
+            bids_path, sub, ses, preproc_directory, index=index)
+        if t1w_future is not None:
+            t1w_result, t1w_msg, in_t1w = t1w_future.result()
+            if t1w_result == 0:
+                return 0, t1w_msg, None
+    if result == 0:
+        return 0, msg, None
+    in_dwi, in_dwi_json, in_pepolar_AP, in_pepolar_PA = acquisitions
+
+    # Volumes to remove found by the QC (eddy QC of the run with all volumes)
+    if volumes == ["auto"]:
+        qc_directory = os.path.join(
+            get_analysis_directory(bids_path, sub, ses, acq), "preprocessing", "qc_text"
+        )
+        result, msg, volumes_file = detect_outlier_volumes(in_dwi, preproc_directory, qc_directory)
+        if result == 0:
+            return 0, msg, None
+        # No outlier: in_dwi is used as it is (no copy of the DWI)
+        volumes = read_volumes_to_remove(volumes_file)
+
+    # Remove volume from dwi if needed
+    # (in_dwi keeps all volumes, so a new run does not remove them twice)
+    if volumes:
+        in_dwi_rm_vol = in_dwi.replace(".mif", "_removed_vol.mif")
+        result, msg = remove_volumes(in_dwi, in_dwi_rm_vol, volumes)
+        if result == 0:
+            return 0, msg, None
+        in_dwi = in_dwi_rm_vol
+
+    msg = "\nAcquisitions prepared"
+    return 1, msg, (in_dwi, in_dwi_json, in_pepolar_AP, in_pepolar_PA)
+
+
+def process_acquisition(
+    bids_path, sub, ses, acq, analysis_directory, in_t1w_nifti=None,
+    volumes=None, average_fod=False, stage_workers=1, index=None,
+    command_timeout=None, discard_intermediate=(), denoise_backend="dwidenoise",
+    mni_mask="recompute", tensor_backend="all", crop_margin=None, fit_memory=None
+):
+    """
+    Process one acquisition of one subject / session
+
+    Parameters:
+    - bids_path (string): path to the BIDS directory
+    - sub (string): subject name
+    - ses (string): session name
+    - acq (string): acquisition name (abcd, hermes)
+    - analysis_directory (string): output directory for this acquisition
+    - in_t1w_nifti (string): (optionnal) path to the T1w (.nii.gz)
+    - volumes (list): (optionnal) volumes to remove (indices, or text file
+                      with the indices, or ["auto"] to detect them)
+    - average_fod (boolean): use average response function
+    - stage_workers (int): number of independent stages (DTI, NODDI, DKI,
+                           registrations...) run at the same time
+    - index (dict): (optionnal) BIDS index (see bids_index)
+    - command_timeout (float): (optionnal) maximum duration of one external
+                               command in seconds
+    - discard_intermediate (list): (optionnal) intermediate images of the
+                                   preprocessing that are not kept
+                                   (see preprocessing.run_preproc_dwi)
+    - denoise_backend (string): (optionnal) "dwidenoise" or "mppca"
+    - mni_mask (string): (optionnal) brain mask in the MNI space (FA
+                         template): "recompute" from the DWI in the MNI
+                         space, or "warp" the native mask
+    - tensor_backend (string): (optionnal) tensor fit giving the FA / MD
+                               maps of the MNI steps and of the tractometry
+                               ("all": every fit, dipy DTI maps used;
+                               see pipeline_stages.TENSOR_BACKENDS)
+    - crop_margin (int): (optionnal) crop the preprocessed images to the
+                         brain plus this margin (voxels), native maps put
+                         back in the original grid at the end
+                         (None: no crop)
+    - fit_memory (int): (optionnal) memory cap of the DKI fit (bytes), the
+                        DWI is then fitted slab by slab (None: no cap)
+
+    Returns:
+    - int 1 success, 0 failure
+    - msg
+    """
+    print(colored(f"\nSubject: {sub} Session: {ses} Acquisition: {acq}", "magenta"))
+    set_command_timeout(command_timeout)
+    preproc_directory = os.path.join(
+        analysis_directory, "preprocessing"
+    )
+    if not os.path.exists(analysis_directory):
+        os.makedirs(analysis_directory)
+    if not os.path.exists(preproc_directory):
+        os.makedirs(preproc_directory)
+
+    with timed_stage("prepare_acquisitions"):
+        result, msg, res = _prepare_acquisition(
+            bids_path, sub, ses, acq, preproc_directory, in_t1w_nifti, volumes, index
+        )
+    if result == 0:
+        print(msg)
+        return 0, msg
+    in_dwi, in_dwi_json, in_pepolar_AP, in_pepolar_PA = res
+
+    # Get info fot future processing
+    # Get readout time
+    with open(in_dwi_json, encoding="utf-8") as my_json:
+        data = json.load(my_json)
+        try:
+            readout_time = str(data["TotalReadoutTime"])
+        except Exception:
+            # For Philips data
+            readout_time = str(data["EstimatedTotalReadoutTime"])
+        pe_dir = str(data["PhaseEncodingDirection"])
+    # Check if it is multishell data
+    result, msg, shell_res = get_shell(in_dwi)
+    shell = [bval for bval in shell_res if float(bval) >= 5 and bval != ""]
+    print("Shell: ", shell)
+    if len(shell) > 1:
+        SHELL = True
+    else:
+        SHELL = False
+
+    print(f"\nMain phase encoding dir: {pe_dir}")
+
+    print(colored("\n \n===== PREPROCESSING AND PROCESSING =====\n", "cyan"))
+
+    # Stages are run as soon as their inputs are available
+    context = {
+        "analysis_directory": analysis_directory,
+        "in_dwi": in_dwi,
+        "pe_dir": pe_dir,
+        "readout_time": readout_time,
+        "shell": SHELL,
+        "in_pepolar_AP": in_pepolar_AP,
+        "in_pepolar_PA": in_pepolar_PA,
+        "in_t1w_nifti": in_t1w_nifti,
+        "average_fod": average_fod,
+        "discard_intermediate": discard_intermediate or (),
+        "denoise_backend": denoise_backend,
+        "mni_mask": mni_mask,
+        "tensor_backend": tensor_backend,
+        "crop_margin": crop_margin,
+        "fit_memory": fit_memory,
+    }
+    stages = get_processing_stages(
+        SHELL, t1w=in_t1w_nifti is not None, tensor_backend=tensor_backend,
+        crop=crop_margin is not None)
+    result, msg, status = run_stage_graph(stages, context, max_workers=stage_workers)
+    if result == 0:
+        print(msg)
+        return 0, msg
+
+    msg = f"\nProcessing of sub-{sub} ses-{ses} {acq} done"
+    return 1, msg
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -45,303 +233,167 @@ if __name__ == "__main__":
         help="diffusion acquisition to process (abcd, hermes)"
     )
     parser.add_argument(
-        "--volumes", required=None,
-        help="list of volumes to remove (.txt)"
+        "--volumes", required=None, nargs="+",
+        help="volumes to remove: indices (ex: 3 10 25), text file (.txt) "
+        "with the indices, or auto to detect corrupted volumes"
     )
     parser.add_argument(
         "--average_fod", required=None,
         action="store_true",
         help="used average FOD"
     )
+    parser.add_argument(
+        "--jobs", type=int, default=1,
+        help="number of subject / session / acquisition processed at the same time "
+        "(default: 1). With more than 1 job, each one writes its log in "
+        "<analysis directory>/logs/pipeline.log"
+    )
+    parser.add_argument(
+        "--stage_workers", type=int, default=1,
+        help="number of independent processing stages of one acquisition "
+        "(DTI, NODDI, DKI, registrations...) run at the same time (default: 1)"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=os.cpu_count(),
+        help="number of threads of the node, shared between jobs and stages "
+        "(default: all CPUs)"
+    )
+    parser.add_argument(
+        "--reset_index", required=None,
+        action="store_true",
+        help="rebuild the whole BIDS index (derivatives/bids_index.json)"
+    )
+    parser.add_argument(
+        "--command_timeout", type=float, default=None,
+        help="maximum duration of one external command in seconds, "
+        "the command is killed after it (default: no timeout)"
+    )
+    parser.add_argument(
+        "--discard_intermediate", nargs="+", default=[],
+        choices=DISCARDABLE_INTERMEDIATES,
+        help="intermediate images of the preprocessing that are not kept: "
+        "denoise (dwidenoise piped into mrdegibbs, the denoised DWI is only "
+        "written in MRTRIX_TMPFILE_DIR)"
+    )
+    parser.add_argument(
+        "--denoise", default="dwidenoise", choices=DENOISE_BACKENDS,
+        help="denoising of the DWI: dwidenoise (MRtrix) or mppca (same method "
+        "in Python, parallel over slabs, noise map saved) (default: dwidenoise)"
+    )
+    parser.add_argument(
+        "--mni_mask", default="recompute", choices=["recompute", "warp"],
+        help="brain mask in the MNI space (TractSeg): recompute it from the DWI "
+        "in the MNI space, or warp the native mask with the FA transform "
+        "(default: recompute)"
+    )
+    parser.add_argument(
+        "--tensor_backend", default="all", choices=TENSOR_BACKENDS,
+        help="tensor fit giving the FA / MD maps of the MNI steps and of the "
+        "tractometry, each model is then fitted only once: dipy_dti (dipy WLS), "
+        "dipy_dki (tensor of the DKI fit, multishell data), mrtrix (dwi2tensor); "
+        "all: MRtrix, dipy DTI and DKI fits, dipy DTI maps used (default: all)"
+    )
+    parser.add_argument(
+        "--crop", nargs="?", type=int, const=CROP_MARGIN, default=None,
+        metavar="MARGIN",
+        help="crop the preprocessed images to the brain mask bounding box plus "
+        f"a margin in voxels (default margin: {CROP_MARGIN}) before the fits, "
+        "registrations and FOD; native maps are put back in the original grid "
+        "in native_grid (default: no crop)"
+    )
+    parser.add_argument(
+        "--fit_memory", type=float, default=None, metavar="GB",
+        help="memory cap of the DKI fit in GB: the DWI is read, fitted and "
+        "written slab by slab so the memory does not depend on the size of "
+        "the image (default: no cap, all the voxels of the mask at once)"
+    )
 
     # Set path
     args = parser.parse_args()
-    bids_path = args.bids
+    bids_path = os.path.abspath(args.bids)
     subjects = args.subjects
     sessions = args.sessions
     acquisitions = args.acquisitions
     volumes = args.volumes
+    if volumes is not None and len(volumes) == 1 and os.path.isfile(volumes[0]):
+        volumes = [os.path.abspath(volumes[0])]
     average_fod = args.average_fod
-    layout = BIDSLayout(bids_path)
+    # Index is built once, then only new / modified sessions are scanned
+    index = load_bids_index(bids_path, reset=args.reset_index)
 
     if subjects == ["all"]:
         # Get all subjects in BIDS directory
-        subjects = layout.get_subjects()
+        subjects = get_subjects(index)
 
     if sessions == ["all"]:
         # Get all sessions in BIDS directory
-        sessions = layout.get_sessions()
+        sessions = get_sessions(index)
 
     print(colored(f"\nSubjects to process: {subjects}", "magenta"))
     print(colored(f"Sessions to process: {sessions}", "magenta"))
     print(colored("\n \n===== PREPARATION OF ACQUISITIONS =====\n", "cyan"))
+    units = []
     for sub in subjects:
-        print(colored("\nSubject: " + sub, "magenta"))
-        # print("\nSubject: ", sub)
         for ses in sessions:
-            print(colored("Session: " + ses, "magenta"))
             # Check if sub / session exist
-            check = layout.get(subject=sub, session=ses)
+            check = get_files(index, subject=sub, session=ses)
             if check == []:
                 print(f"\nNo data for {sub} for session {ses}")
                 continue
+            # Get T1w
+            all_sequences_t1 = get_files(
+                index, subject=sub, session=ses,
+                extension="nii.gz", suffix="T1w", return_type="filename")
+            if all_sequences_t1:
+                in_t1w_nifti = all_sequences_t1[0]
+            else:
+                in_t1w_nifti = None
             for acq in acquisitions:
                 # Check if acquistion exist for this subject
-                check = layout.get(subject=sub, session=ses, acquisition=acq)
+                check = get_files(index, subject=sub, session=ses, acquisition=acq)
                 if check == []:
                     print(f"\nNo data for {sub} for session {ses} for {acq}")
                     continue
-
-                if volumes is None:
-                    # Create analysis directory
-                    analysis_directory = os.path.join(
-                        bids_path,
-                        "derivatives",
-                        "sub-" + sub,
-                        "ses-" + ses,
-                        "dwi-" + acq
-                    )
-                else:
-                    # Create analysis directory
-                    analysis_directory = os.path.join(
-                        bids_path,
-                        "derivatives",
-                        "sub-" + sub,
-                        "ses-" + ses,
-                        "dwi-" + acq + "_removed_volumes",
-                    )
-
-                preproc_directory = os.path.join(
-                    analysis_directory, "preprocessing"
-                )
-                if not os.path.exists(analysis_directory):
-                    os.makedirs(analysis_directory)
-                if not os.path.exists(preproc_directory):
-                    os.makedirs(preproc_directory)
-
-                # Change working directory
-                # (mrtriw will create temp directory in it)
-                os.chdir(analysis_directory)
-
-                session_path = os.path.join(
-                    bids_path, "sub-" + sub, "ses-" + ses
+                analysis_directory = get_analysis_directory(
+                    bids_path, sub, ses, acq, volumes
                 )
+                units.append({
+                    "name": f"sub-{sub}_ses-{ses}_{acq}",
+                    "analysis_directory": analysis_directory,
+                    "kwargs": {
+                        "bids_path": bids_path,
+                        "sub": sub,
+                        "ses": ses,
+                        "acq": acq,
+                        "analysis_directory": analysis_directory,
+                        "in_t1w_nifti": in_t1w_nifti,
+                        "volumes": volumes,
+                        "average_fod": average_fod,
+                        "stage_workers": args.stage_workers,
+                        "index": select_subject_session(index, sub, ses),
+                        "command_timeout": args.command_timeout,
+                        "discard_intermediate": args.discard_intermediate,
+                        "denoise_backend": args.denoise,
+                        "mni_mask": args.mni_mask,
+                        "tensor_backend": args.tensor_backend,
+                        "crop_margin": args.crop,
+                        "fit_memory": (
+                            None if args.fit_memory is None
+                            else int(args.fit_memory * 1024 ** 3)
+                        ),
+                    },
+                })
 
-                # Get T1w and convert to MIF
-                all_sequences_t1 = layout.get(
-                    subject=sub, session=ses,
-                    extension="nii.gz", suffix="T1w", return_type="filename")
-                if all_sequences_t1:
-                    in_t1w_nifti = all_sequences_t1[0]
-                    result, msg, in_t1w = convert_nifti_to_mif(
-                        in_t1w_nifti, preproc_directory, diff=False
-                    )
-                    if result == 0:
-                        print(msg)
-                        sys.exit(1)
-                else:
-                    print(
-                        f"\nNo T1w data found for subject {sub} in session {ses}."
-                        "Proceeding without T1w data."
-                    )
-                    in_t1w = None
-                    in_t1w_nifti = None
-
-                # Get DWI and pepolar, convert to MIF, merge DWI and get info
-                if "abcd" in acq:
-                    in_dwi, in_dwi_json, in_pepolar_AP, in_pepolar_PA = prepare_abcd_acquistions(
-                        bids_path, sub, ses, preproc_directory)
-
-                elif "hermes" in acq:
-                    in_dwi, in_dwi_json, in_pepolar_AP, in_pepolar_PA = prepare_hermes_acquistions(
-                        bids_path, sub, ses, preproc_directory)
-
-                # Remove volume from dwi if needed
-                if volumes:
-                    in_dwi_rm_vol = in_dwi.replace(".mif", "_removed_vol.mif")
-                    remove_volumes(in_dwi, in_dwi_rm_vol, volumes)
-                    cmd = ["mv", in_dwi_rm_vol, in_dwi]
-                    result, stderrl, sdtoutl = execute_command(cmd)
-                    if result != 0:
-                        msg = f"\nCan not move dwi_rm_vol file (exit code {result})"
-                    cmd = ["rm", in_dwi_rm_vol]
-                    result, stderrl, sdtoutl = execute_command(cmd)
-                    if result != 0:
-                        msg = f"\nCan not delete dwi_rm_vol file (exit code {result})"
-
-                # Get info fot future processing
-                # Get readout time
-                with open(in_dwi_json, encoding="utf-8") as my_json:
-                    data = json.load(my_json)
-                    try:
-                        readout_time = str(data["TotalReadoutTime"])
-                    except Exception:
-                        # For Philips data
-                        readout_time = str(data["EstimatedTotalReadoutTime"])
-                    pe_dir = str(data["PhaseEncodingDirection"])
-                # Check if it is multishell data
-                result, msg, shell_res = get_shell(in_dwi)
-                shell = [bval for bval in shell_res if float(bval) >= 5 and bval != ""]
-                print("Shell: ", shell)
-                if len(shell) > 1:
-                    SHELL = True
-                else:
-                    SHELL = False
-
-                print(f"\nMain phase encoding dir: {pe_dir}")
-
-                print(colored("\n \n===== PREPROCESSING =====\n", "cyan"))
-
-                # Launch preprocessing
-                main_return, main_msg, info_preproc = run_preproc_dwi(
-                    in_dwi, pe_dir,
-                    readout_time,
-                    shell=SHELL,
-                    in_pepolar_PA=in_pepolar_PA,
-                    in_pepolar_AP=in_pepolar_AP
-                )
-
-                print(colored("\n \n===== PROCESSING =====\n", "cyan"))
-
-                # Compute FA map (mtrix)
-                FA_dir = os.path.join(analysis_directory, "FA")
-                if not os.path.exists(FA_dir):
-                    os.mkdir(FA_dir)
-                fa_return, fa_msg, info_fa = mrtrix_DTI(
-                    info_preproc["dwi_preproc"], info_preproc["brain_mask"], FA_dir)
-                
-                # Compute FA map dipy
-                DTI_dir = os.path.join(analysis_directory, "DTI_dipy")
-                if not os.path.exists(DTI_dir):
-                    os.mkdir(DTI_dir)
-                DTI_return, DTI_msg, info_DTI = dipy_DTI(
-                    info_preproc["dwi_preproc"], info_preproc["brain_mask_nii"], DTI_dir)
-
-                # NODDI maps, only valid for multishell data
-                if SHELL:
-                    mask_nii = info_preproc["brain_mask_nii"]
-                    AMICO_dir = os.path.join(analysis_directory, "AMICO")
-                    print(colored("\n~~NOODI starts~~", "cyan"))
-                    if not verify_file(AMICO_dir):
-                        dwi_preproc_nii = info_preproc["dwi_preproc_nii"]
-                        NODDI_dir = NODDI(dwi_preproc_nii, mask_nii)
-                    else:
-                        base_dir = os.path.dirname(os.path.dirname(mask_nii))
-                        NODDI_dir = os.path.join(base_dir, "AMICO", "NODDI")
-                        print(colored("\nNOODI ends", "cyan"))
-                else:
-                    AMICO_dir = None
-                    NODDI_dir = None
-
-                # DKI maps, (requires 3 b values)
-                if SHELL:
-                    DKI_dir = os.path.join(analysis_directory, "DKI")
-                    if not os.path.exists(DKI_dir):
-                        os.mkdir(DKI_dir)
-                    DKI_return, DKI_msg, info_DKI = dipy_DKI(
-                        info_preproc["dwi_preproc"], info_preproc["brain_mask_nii"], DKI_dir)
-                else:
-                    DKI_dir = None
-                
-                ## Tractseg analysis
-                # Aligning in the MNI space for tractseg
-                tractseg_dir = os.path.join(analysis_directory, "analysis_tractseg")
-                if not os.path.exists(tractseg_dir):
-                    os.mkdir(tractseg_dir)
-                MNI_dir = os.path.join(tractseg_dir, "Results_MNI")
-                if not os.path.exists(MNI_dir):
-                    os.mkdir(MNI_dir)
-                mni_return, mni_msg, info_mni = register_to_MNI_FA(
-                    info_preproc["dwi_preproc"], info_DTI["FA_map"], MNI_dir)
-                
-                # MD in MNI
-                map_md = info_DTI["FA_map"].replace("FA", "MD")
-                if ".mif" in map_md:
-                    nii_return, nii_msg, map_md_nii = convert_mif_to_nifti(map_md, FA_dir, diff=False)
-                else:
-                    map_md_nii = map_md
-                map_in_MNI_flirt_applyxfm(map_md_nii, MNI_dir, MNI_dir)
-                if SHELL:
-                    # NODDI and DKI maps in the MNI
-                    NODDI_MNI = os.path.join(MNI_dir, "NODDI_MNI")
-                    DKI_MNI = os.path.join(MNI_dir, "DKI_MNI")
-                    if not os.path.exists(NODDI_MNI):
-                        os.mkdir(NODDI_MNI)
-                    if not os.path.exists(DKI_MNI):
-                        os.mkdir(DKI_MNI)
-                    print(colored("\n~~Map in MNI step starts~~", "cyan"))
-                    for file_name in os.listdir(NODDI_dir):
-                        if file_name.endswith(".nii.gz"):
-                            map_noddi = os.path.join(NODDI_dir, file_name)
-                            map_in_MNI_flirt_applyxfm(map_noddi, NODDI_MNI, MNI_dir)
-                    for file_name in os.listdir(DKI_dir):
-                        if file_name.endswith(".nii.gz"):
-                            map_dki = os.path.join(DKI_dir, file_name)
-                            map_in_MNI_flirt_applyxfm(map_dki, DKI_MNI, MNI_dir)
-                print(colored("\nMap in MNI step ends", "cyan"))
-
-                # Doing FOD estimations
-                FOD_dir = os.path.join(tractseg_dir, "FOD")
-                if not os.path.exists(FOD_dir):
-                    os.mkdir(FOD_dir)
-                _, msg, peaks = FOD(
-                    info_mni["dwi_preproc_mni"],
-                    info_mni["dwi_mask_mni"],
-                    FOD_dir,
-                    multishell=SHELL,
-                    average=average_fod
-                )
-
-                # Tractography
-                Tract_dir = os.path.join(tractseg_dir, "Tracto")
-                if not os.path.exists(Tract_dir):
-                    os.mkdir(Tract_dir)
-                run_tractseg(peaks, Tract_dir)
-
-                # Tractometry (map must be in the MNI space)
-                map_path = info_mni["FA_MNI"]
-                print(colored("\n~~Tractometry starts~~", "cyan"))
-                tractometry_postprocess(map_path, Tract_dir)
-                map_path_MD =  info_mni["FA_MNI"].replace("FA_MNI", "dti_MD_MNI")
-                tractometry_postprocess(map_path_MD, Tract_dir)
-                if SHELL:
-                    map_path_ODI = os.path.join(NODDI_MNI, "ODI_MNI.nii.gz")
-                    map_path_NDI = os.path.join(NODDI_MNI, "NDI_MNI.nii.gz")
-                    map_path_KFA = os.path.join(DKI_MNI, "dki_kFA_MNI.nii.gz")
-                    map_path_MK = os.path.join(DKI_MNI, "dki_MK_MNI.nii.gz")
-                    tractometry_postprocess(map_path_NDI, Tract_dir)
-                    tractometry_postprocess(map_path_KFA, Tract_dir)
-                    tractometry_postprocess(map_path_MK, Tract_dir)
-                    tractometry_postprocess(map_path_ODI, Tract_dir)
-                else:
-                    map_path_KFA = None
-                    map_path_MK = None
-                    map_path_NDI = None
-                    map_path_ODI = None
-                print(colored("\nTractometry done.", "cyan"))
-
-                ## Jhu analysis (registration to MNI space)
-                jhu_dir = os.path.join(analysis_directory, "analysis_jhu")
-                if not os.path.exists(jhu_dir):
-                    os.mkdir(jhu_dir)
-                bet_return, bet_msg, info_bet = t1_bet(in_t1w_nifti, jhu_dir)
-                fa_nii = info_DTI["FA_map"]
-                mni_jhu_return, mni_jhu_msg, info_mni_jhu = register_to_MNI_using_T1w(
-                    in_t1w_nifti, info_bet["t1_brain"], 
-                    info_preproc["mean_b0"], fa_nii, jhu_dir
-                )
-        
-                print(colored("\n~~Map in MNI step starts~~", "cyan"))
-                map_in_MNI_applywarp(map_md_nii, info_mni_jhu["T12MNI_warp"], info_mni_jhu["b0_to_T1_mat"], jhu_dir)
-                for file_name in os.listdir(NODDI_dir):
-                    if file_name.endswith(".nii.gz"):
-                        map_noddi = os.path.join(NODDI_dir, file_name)
-                        map_in_MNI_applywarp(map_noddi, info_mni_jhu["T12MNI_warp"], info_mni_jhu["b0_to_T1_mat"], jhu_dir)
-                for file_name in os.listdir(DKI_dir):
-                    if file_name.endswith(".nii.gz"):
-                        map_dki = os.path.join(DKI_dir, file_name)
-                        map_in_MNI_applywarp(map_dki, info_mni_jhu["T12MNI_warp"], info_mni_jhu["b0_to_T1_mat"], jhu_dir)
-                print(colored("\nMap in MNI step ends", "cyan"))
+    results = run_units(process_acquisition, units, jobs=args.jobs, threads=args.threads)
+    failed = print_summary(results)
 
+    # Timing of all units
+    timelines = {
+        unit["name"]: get_timeline_path(unit["analysis_directory"]) for unit in units
+    }
+    report = write_cohort_report(timelines, os.path.join(bids_path, "derivatives", "timing"))
+    print(colored(f"\nTiming report saved to {report}", "magenta"))
 
-            print(colored("\n \n===== THE END =====\n\n", "cyan"))
+    print(colored("\n \n===== THE END =====\n\n", "cyan"))
+    if failed:
+        sys.exit(1)
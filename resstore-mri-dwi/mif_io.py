@@ -0,0 +1,349 @@
+"""
+Read and write MRtrix images (.mif) in Python, without mrconvert.
+Data are given as a NumPy memmap (no copy) in the voxel order of the
+image, the gradient table (dw_scheme) is read from the header:
+    - load_mif
+    - save_mif
+    - write_mif_volumes: write an image volume by volume
+    - get_affine: voxel to scanner transform (as NIfTI affine)
+    - get_fsl_gradients: bvals / bvecs (FSL convention) from dw_scheme
+    - load_dwi: data, affine, bvals and bvecs of a .mif or .nii(.gz)
+"""
+
+import os
+
+import numpy as np
+
+from native_tools import read_mif_header
+
+# MRtrix datatypes (without endianness suffix) -> NumPy types
+MIF_DATATYPES = {
+    "Int8": "i1", "UInt8": "u1",
+    "Int16": "i2", "UInt16": "u2",
+    "Int32": "i4", "UInt32": "u4",
+    "Int64": "i8", "UInt64": "u8",
+    "Float32": "f4", "Float64": "f8",
+    "CFloat32": "c8", "CFloat64": "c16",
+}
+# Keys written by save_mif, not copied from an other header
+MIF_KEYS = ["dim", "vox", "layout", "datatype", "transform", "file", "scaling", "dw_scheme"]
+
+
+def _get_dtype(datatype):
+    """NumPy dtype of a MRtrix datatype (ex: Float32LE)"""
+    endian = "<"
+    name = datatype
+    if datatype.endswith(("LE", "BE")):
+        endian = "<" if datatype.endswith("LE") else ">"
+        name = datatype[:-2]
+    if name not in MIF_DATATYPES:
+        raise ValueError(f"MIF datatype {datatype} is not supported")
+    return np.dtype(endian + MIF_DATATYPES[name])
+
+
+def _get_datatype(dtype):
+    """MRtrix datatype of a NumPy dtype"""
+    dtype = np.dtype(dtype)
+    if dtype == np.bool_:
+        dtype = np.dtype("u1")
+    for name, code in MIF_DATATYPES.items():
+        if np.dtype(code).kind == dtype.kind and np.dtype(code).itemsize == dtype.itemsize:
+            return name if dtype.itemsize == 1 else name + "LE"
+    raise ValueError(f"Data type {dtype} can not be written in MIF")
+
+
+def _parse_header(path):
+    """Header of a MIF image, with the values converted"""
+    keyval = read_mif_header(path)
+    if keyval is None:
+        raise ValueError(f"{path} is not a MIF image")
+    dim = [int(d) for d in keyval["dim"][0].split(",")]
+    layout = keyval.get("layout", [",".join(f"+{i}" for i in range(len(dim)))])[0]
+    layout = [s.strip() for s in layout.split(",")]
+    transform = np.eye(4)
+    if "transform" in keyval:
+        transform[:3] = [[float(v) for v in row.split(",")] for row in keyval["transform"][:3]]
+    dw_scheme = None
+    if "dw_scheme" in keyval:
+        dw_scheme = np.array(
+            [[float(v) for v in row.split(",")] for row in keyval["dw_scheme"]]
+        )
+    if len(keyval.get("file", [])) != 1:
+        raise ValueError(f"{path}: images with several data files are not supported")
+    file_name, offset = keyval["file"][0].rsplit(" ", 1)
+    if file_name.strip() == ".":
+        file_name = path
+    else:
+        file_name = os.path.join(os.path.dirname(path), file_name.strip())
+    return {
+        "dim": dim,
+        "vox": [float(v) for v in keyval["vox"][0].split(",")],
+        "layout": layout,
+        "datatype": keyval["datatype"][0],
+        "transform": transform,
+        "dw_scheme": dw_scheme,
+        "scaling": [float(v) for v in keyval.get("scaling", ["0,1"])[0].split(",")],
+        "file": file_name,
+        "offset": int(offset),
+        "keyval": {k: v for k, v in keyval.items() if k not in MIF_KEYS},
+    }
+
+
+def load_mif(path, mmap=True):
+    """
+    Load a MIF image
+
+    The voxel axes are those of the NIfTI image written by mrconvert:
+    spatial axes in their order on disk, none of them reversed (the
+    transform of the header is adjusted), so the data array is the same
+    as with a NIfTI of the image. With mmap, data are not read: the
+    array is a view of the file (read only).
+
+    Parameters:
+    - path (string): path to the image (.mif, .mih or .mif.gz)
+    - mmap (boolean): memory-map the data (not possible for .mif.gz
+                      or scaled data)
+
+    Returns:
+    - data (numpy array)
+    - header (dict): "dim", "vox", "layout", "datatype", "transform" (4x4),
+                     "dw_scheme" (N x 4 or None), "keyval" (other keys)
+    """
+    header = _parse_header(path)
+    dtype = _get_dtype(header["datatype"])
+    dim = header["dim"]
+    order = [int(s.lstrip("+-")) for s in header["layout"]]
+    # Axes sorted from the slowest to the fastest in the file
+    axes = sorted(range(len(dim)), key=lambda axis: order[axis], reverse=True)
+    file_shape = tuple(dim[axis] for axis in axes)
+
+    if mmap and not header["file"].endswith(".gz"):
+        data = np.memmap(
+            header["file"], dtype=dtype, mode="r",
+            offset=header["offset"], shape=file_shape
+        )
+    else:
+        if header["file"].endswith(".gz"):
+            import gzip
+            with gzip.open(header["file"], "rb") as stream:
+                stream.seek(header["offset"])
+                raw = stream.read(int(np.prod(file_shape)) * dtype.itemsize)
+        else:
+            with open(header["file"], "rb") as stream:
+                stream.seek(header["offset"])
+                raw = stream.read(int(np.prod(file_shape)) * dtype.itemsize)
+        data = np.frombuffer(raw, dtype=dtype).reshape(file_shape)
+
+    # Image axes order, then spatial axes in their order on disk
+    # (as File::NIfTI::adjust_transform in MRtrix)
+    data = data.transpose(np.argsort(axes))
+    spatial = sorted(range(min(3, len(dim))), key=lambda axis: order[axis])
+    perm = spatial + list(range(len(spatial), len(dim)))
+    data = data.transpose(perm)
+    transform = header["transform"].copy()
+    for axis, stride in enumerate(header["layout"][:3]):
+        if stride.startswith("-"):
+            transform[:3, 3] += transform[:3, axis] * header["vox"][axis] * (dim[axis] - 1)
+            transform[:3, axis] = -transform[:3, axis]
+    transform[:3, :len(spatial)] = transform[:3, spatial]
+    header["transform"] = transform
+    header["dim"] = [dim[axis] for axis in perm]
+    header["vox"] = [header["vox"][axis] for axis in perm]
+    header["layout"] = [f"+{i}" for i in range(len(dim))]
+
+    offset, scale = header["scaling"]
+    if (offset, scale) != (0.0, 1.0):
+        data = data * scale + offset
+    return data, header
+
+
+def save_mif(path, data, header=None, vox=None, transform=None, dw_scheme=None,
+             volumes=None):
+    """
+    Write a MIF image from an array
+
+    Parameters:
+    - path (string): path to the output image (.mif)
+    - data (numpy array): image data (x, y, z[, volume])
+    - header (dict): (optionnal) header to copy (see load_mif): voxel
+                     size, transform, gradient table and other keys
+    - vox (list): (optionnal) voxel size (default: from header or 1)
+    - transform (4x4 array): (optionnal) default: from header or identity
+    - dw_scheme (N x 4 array): (optionnal) gradient table (default: from
+                               header if the number of volumes did not
+                               change)
+    - volumes (list of int): (optionnal) volumes of a 4D data to write,
+                             read one at a time (ex: a memmap is never
+                             copied whole in memory)
+
+    Returns:
+    - path (string)
+    """
+    header = header or {}
+    data = np.asarray(data)
+    ndim = data.ndim
+    shape = data.shape
+    if volumes is not None:
+        if ndim != 4:
+            raise ValueError("Volumes can only be selected in a 4D image")
+        volumes = [int(v) for v in volumes]
+        shape = data.shape[:3] + (len(volumes),)
+        if dw_scheme is None and header.get("dw_scheme") is not None:
+            dw_scheme = np.asarray(header["dw_scheme"])[volumes]
+    # Volume by volume, to keep the memory low
+    if ndim == 4:
+        blocks = data
+    elif ndim > 4:
+        blocks = data.reshape(data.shape[:3] + (-1,), order="F")
+    else:
+        blocks = data[..., None]
+    return write_mif_volumes(
+        path, shape, data.dtype,
+        (blocks[..., volume] for volume in (
+            volumes if volumes is not None else range(blocks.shape[-1]))),
+        header=header, vox=vox, transform=transform, dw_scheme=dw_scheme
+    )
+
+
+def write_mif_volumes(path, shape, dtype, volumes, header=None, vox=None, transform=None,
+                      dw_scheme=None):
+    """
+    Write a MIF image volume by volume (only one volume in memory)
+
+    Parameters:
+    - path (string): path to the output image (.mif)
+    - shape (tuple): shape of the image (x, y, z[, volume...])
+    - dtype: data type of the image
+    - volumes (iterable): 3D arrays, in the order of the volumes
+    - header, vox, transform, dw_scheme: see save_mif
+
+    Returns:
+    - path (string)
+    """
+    header = header or {}
+    ndim = len(shape)
+    if vox is None:
+        vox = list(header.get("vox", []))[:ndim]
+        vox += [1.0] * (ndim - len(vox))
+    if transform is None:
+        transform = header.get("transform", np.eye(4))
+    if dw_scheme is None:
+        dw_scheme = header.get("dw_scheme")
+        if dw_scheme is not None and (ndim < 4 or len(dw_scheme) != shape[3]):
+            dw_scheme = None
+    datatype = _get_datatype(dtype)
+    dtype = _get_dtype(datatype)
+
+    lines = ["mrtrix image"]
+    lines.append("dim: " + ",".join(str(d) for d in shape))
+    lines.append("vox: " + ",".join(f"{v:g}" for v in vox))
+    # First axis fastest, as written below
+    lines.append("layout: " + ",".join(f"+{i}" for i in range(ndim)))
+    lines.append("datatype: " + datatype)
+    for row in np.asarray(transform)[:3]:
+        lines.append("transform: " + ",".join(f"{v:.10g}" for v in row))
+    for key, values in header.get("keyval", {}).items():
+        lines += [f"{key}: {value}" for value in values]
+    if dw_scheme is not None:
+        for row in np.asarray(dw_scheme):
+            lines.append("dw_scheme: " + ",".join(f"{v:.10g}" for v in row))
+    text = "\n".join(lines) + "\n"
+    # Data offset after the header, aligned on 16 bytes
+    offset = len(text) + len("file: . \nEND\n") + 1
+    while True:
+        end = f"file: . {offset}\nEND\n"
+        if len(text) + len(end) <= offset:
+            break
+        offset += 1
+    offset += -offset % 16
+    end = f"file: . {offset}\nEND\n"
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        with open(tmp_path, "wb") as stream:
+            stream.write((text + end).encode())
+            stream.write(b"\0" * (offset - len(text) - len(end)))
+            for volume in volumes:
+                block = np.asarray(volume, dtype=dtype)
+                stream.write(block.tobytes(order="F"))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+def get_affine(header):
+    """
+    Voxel to scanner transform of a MIF image (NIfTI affine)
+
+    Parameters:
+    - header (dict): see load_mif
+
+    Returns:
+    - affine (4x4 array)
+    """
+    affine = np.array(header["transform"], dtype=float)
+    affine[:3, :3] = affine[:3, :3] * np.asarray(header["vox"][:3])
+    return affine
+
+
+def get_fsl_gradients(header):
+    """
+    Get bvals / bvecs of a MIF image (as mrconvert -export_grad_fsl)
+
+    dw_scheme directions are in scanner space, FSL bvecs are in the
+    voxel axes (x axis flipped if the transform is not left-handed).
+
+    Parameters:
+    - header (dict): see load_mif
+
+    Returns:
+    - bvals (array): None if there is no gradient table
+    - bvecs (N x 3 array)
+    """
+    dw_scheme = header.get("dw_scheme")
+    if dw_scheme is None:
+        return None, None
+    rotation = np.asarray(header["transform"], dtype=float)[:3, :3]
+    bvecs = dw_scheme[:, :3] @ rotation
+    if np.linalg.det(rotation) > 0:
+        bvecs[:, 0] = -bvecs[:, 0]
+    return dw_scheme[:, 3].copy(), bvecs
+
+
+def load_dwi(path, mmap=True, proxy=False):
+    """
+    Load a diffusion image and its gradient table
+
+    For a .mif, the gradient table is read in the header; for a NIfTI,
+    in the .bval / .bvec files next to it.
+
+    Parameters:
+    - path (string): path to the image (.mif or .nii.gz)
+    - mmap (boolean): memory-map the data if possible
+    - proxy (boolean): for a NIfTI, return the array proxy of nibabel
+                       (data read only when sliced, seeks in a .nii.gz
+                       with indexed_gzip if installed)
+
+    Returns:
+    - data (numpy array)
+    - affine (4x4 array)
+    - bvals (array)
+    - bvecs (N x 3 array)
+    """
+    if path.endswith((".mif", ".mif.gz", ".mih")):
+        data, header = load_mif(path, mmap=mmap)
+        bvals, bvecs = get_fsl_gradients(header)
+        return data, get_affine(header), bvals, bvecs
+
+    import nibabel as nib
+
+    img = nib.load(path, mmap=mmap)
+    base = path[:-len(".nii.gz")] if path.endswith(".nii.gz") else os.path.splitext(path)[0]
+    bvals = np.loadtxt(base + ".bval", ndmin=1)
+    bvecs = np.loadtxt(base + ".bvec", ndmin=2)
+    if bvecs.shape[0] == 3 and bvecs.shape[1] != 3:
+        bvecs = bvecs.T
+    data = img.dataobj if proxy else np.asanyarray(img.dataobj)
+    return data, img.affine, bvals, bvecs
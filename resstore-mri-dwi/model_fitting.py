@@ -0,0 +1,314 @@
+"""
+Chunked fit of the dipy models (DTI, DKI) on a pool of processes.
+The signal of the voxels of the mask (n_voxels x n_volumes, see
+dwi_dataset.MaskedDWI) is put in shared memory, split in
+chunks of voxels fitted by the workers; each worker writes the metrics
+of its chunk in a shared output, then the maps are rebuilt. Voxels are
+fitted independently, so the maps are the same as with a serial fit:
+    - MODEL_METRICS: metrics of each model
+    - fit_masked: metrics of a model for the voxels of a masked signal
+    - fit_model: maps of the metrics of a model
+    - get_slabs: slabs of slices read at a time within a memory cap
+    - fit_model_slabs: maps of the metrics of a model, fitted slab by slab
+                       with a bounded memory (maps written in given arrays)
+"""
+
+from multiprocessing import shared_memory
+
+import dipy.reconst.dki as dki
+import dipy.reconst.dti as dti
+import numpy as np
+from dipy.core.gradients import gradient_table
+
+from dwi_dataset import MaskedDWI
+from resource_manager import get_process_pool, get_thread_budget
+
+# Voxels fitted by a worker at a time
+CHUNK_SIZE = 10000
+# Memory used by the dipy fit of a voxel, in number of float64 per volume
+# (signal, log signal, design matrix products, model parameters)
+FIT_MEMORY_FACTOR = 8
+
+MODEL_METRICS = {
+    "DTI": ["FA", "MD", "AD", "RD"],
+    "DKI": ["FA", "MD", "AD", "RD", "MK", "AK", "RK", "kFA"],
+}
+
+# Shared inputs / outputs of a worker (set by _init_worker)
+_worker = {}
+
+
+def _make_model(model_name, bvals, bvecs):
+    """dipy model (same options as the serial fits)"""
+    gtab = gradient_table(bvals, bvecs)
+    if model_name == "DTI":
+        return dti.TensorModel(gtab, fit_method="WLS")
+    if model_name == "DKI":
+        return dki.DiffusionKurtosisModel(gtab)
+    raise ValueError(f"Model {model_name} is not supported ({list(MODEL_METRICS)})")
+
+
+def _get_metric(fit, metric):
+    """Value of a metric of a dipy fit"""
+    if metric in ("MK", "AK", "RK"):
+        return getattr(fit, metric.lower())(0, 3)
+    if metric == "kFA":
+        return fit.kfa
+    return getattr(fit, metric.lower())
+
+
+def _fit_voxels(model, signal, output, metrics, start, stop):
+    """Fit the voxels start:stop of signal, metrics written in output"""
+    fit = model.fit(signal[start:stop])
+    for index, metric in enumerate(metrics):
+        output[start:stop, index] = _get_metric(fit, metric)
+    return stop - start
+
+
+def _fit_chunk(start, stop):
+    """Fit the voxels start:stop of the shared signal (run in a worker)"""
+    return _fit_voxels(
+        _worker["model"], _worker["signal"], _worker["output"], _worker["metrics"],
+        start, stop
+    )
+
+
+def _init_worker(model_name, bvals, bvecs, metrics, signal_spec, output_spec):
+    """Attach the shared memory and build the model once per worker"""
+    arrays = []
+    for name, shape, dtype in (signal_spec, output_spec):
+        shm = shared_memory.SharedMemory(name=name)
+        _worker.setdefault("shm", []).append(shm)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    _worker["signal"], _worker["output"] = arrays
+    _worker["metrics"] = metrics
+    _worker["model"] = _make_model(model_name, bvals, bvecs)
+
+
+def _shared_array(shape, dtype):
+    """Array in a new shared memory block"""
+    dtype = np.dtype(dtype)
+    size = max(1, int(np.prod(shape)) * dtype.itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _get_chunks(n_voxels, chunk_size):
+    """Chunks (start, stop) of voxels"""
+    return [
+        (start, min(start + chunk_size, n_voxels))
+        for start in range(0, n_voxels, chunk_size)
+    ]
+
+
+def fit_masked(model_name, signal, bvals, bvecs, metrics=None, n_jobs=None,
+               chunk_size=CHUNK_SIZE):
+    """
+    Fit a dipy model on the signal of voxels, by chunks on a pool of processes
+
+    Parameters:
+    - model_name (string): "DTI" (WLS) or "DKI"
+    - signal (2D array): n_voxels x n_volumes (see dwi_dataset.MaskedDWI)
+    - bvals (array), bvecs (N x 3 array): gradient table
+    - metrics (list of string): (optionnal) metrics to compute
+                                (default: MODEL_METRICS[model_name])
+    - n_jobs (int): (optionnal) number of processes (default: thread budget
+                    of the stage), 1: fit in the current process
+    - chunk_size (int): number of voxels of a chunk
+
+    Returns:
+    - values (dict): {metric: array of n_voxels values (float64)}
+    """
+    if metrics is None:
+        metrics = MODEL_METRICS[model_name]
+    if n_jobs is None:
+        n_jobs = get_thread_budget()
+    n_voxels = signal.shape[0]
+    chunks = _get_chunks(n_voxels, chunk_size)
+    n_jobs = max(1, min(n_jobs, len(chunks)))
+
+    if n_jobs == 1:
+        output = np.zeros((n_voxels, len(metrics)), dtype=np.float64)
+        model = _make_model(model_name, bvals, bvecs)
+        for start, stop in chunks:
+            _fit_voxels(model, signal, output, metrics, start, stop)
+        return {metric: output[:, index] for index, metric in enumerate(metrics)}
+
+    signal_shm, shared_signal = _shared_array(signal.shape, signal.dtype)
+    output_shm, output = _shared_array((n_voxels, len(metrics)), np.float64)
+    try:
+        shared_signal[:] = signal
+        signal_spec = (signal_shm.name, shared_signal.shape, shared_signal.dtype.str)
+        output_spec = (output_shm.name, output.shape, output.dtype.str)
+        with get_process_pool(
+            n_jobs, _init_worker,
+            (model_name, bvals, bvecs, metrics, signal_spec, output_spec)
+        ) as executor:
+            futures = [executor.submit(_fit_chunk, start, stop) for start, stop in chunks]
+            for future in futures:
+                future.result()
+        values = {metric: output[:, index].copy() for index, metric in enumerate(metrics)}
+    finally:
+        del shared_signal, output
+        for shm in (signal_shm, output_shm):
+            shm.close()
+            shm.unlink()
+    return values
+
+
+def fit_model(model_name, data, mask, bvals, bvecs, metrics=None, n_jobs=None,
+              chunk_size=CHUNK_SIZE):
+    """
+    Fit a dipy model on the voxels of a mask, by chunks on a pool of processes
+
+    Parameters:
+    - model_name (string): "DTI" (WLS) or "DKI"
+    - data (4D array): DWI (memmap, read only once)
+    - mask (3D array): voxels to fit
+    - bvals (array), bvecs (N x 3 array): gradient table
+    - metrics (list of string): (optionnal) metrics to compute
+                                (default: MODEL_METRICS[model_name])
+    - n_jobs (int): (optionnal) number of processes (default: thread budget
+                    of the stage), 1: fit in the current process
+    - chunk_size (int): number of voxels of a chunk
+
+    Returns:
+    - maps (dict): {metric: 3D array (float64), 0 outside the mask}
+    """
+    masked = MaskedDWI(data, mask)
+    values = fit_masked(
+        model_name, masked.signal, bvals, bvecs, metrics=metrics, n_jobs=n_jobs,
+        chunk_size=chunk_size
+    )
+    return {metric: masked.scatter(value) for metric, value in values.items()}
+
+
+def get_slabs(slice_memory, max_memory):
+    """
+    Group the slices (z) in slabs using at most max_memory each
+    (at least one slice per slab)
+
+    Parameters:
+    - slice_memory (array): memory needed by each slice (bytes)
+    - max_memory (int): memory of a slab (bytes)
+
+    Returns:
+    - slabs (list of tuple): (first slice, last slice + 1)
+    """
+    slabs = []
+    start = 0
+    used = 0
+    for index, memory in enumerate(slice_memory):
+        if index > start and used + memory > max_memory:
+            slabs.append((start, index))
+            start, used = index, 0
+        used += memory
+    if start < len(slice_memory):
+        slabs.append((start, len(slice_memory)))
+    return slabs
+
+
+def fit_model_slabs(model_name, data, mask, bvals, bvecs, outputs, max_memory,
+                    n_jobs=None, chunk_size=CHUNK_SIZE):
+    """
+    Fit a dipy model slab by slab (slices along z) with a bounded memory:
+    only the signal of the voxels of the mask of one slab is in memory,
+    the metrics of a slab are written in the outputs before the next one
+    is read. Half of max_memory is given to the signal of a slab, half to
+    the fits of the workers (chunk size reduced if needed). The memory of
+    the interpreters of the workers is not counted.
+
+    Parameters:
+    - model_name (string): "DTI" (WLS) or "DKI"
+    - data (4D array): DWI read slab by slab (memmap or NIfTI array proxy)
+    - mask (3D array): voxels to fit
+    - bvals (array), bvecs (N x 3 array): gradient table
+    - outputs (dict): {metric: 3D array written slab by slab (ex: memmap
+                      on disk), 0 must be the value outside the mask}
+    - max_memory (int): memory cap (bytes)
+    - n_jobs (int): (optionnal) number of processes (default: thread budget
+                    of the stage), 1: fit in the current process
+    - chunk_size (int): (optionnal) maximum number of voxels of a chunk
+
+    Returns:
+    - slabs (list of tuple): slabs fitted (first slice, last slice + 1)
+    """
+    metrics = list(outputs)
+    if n_jobs is None:
+        n_jobs = get_thread_budget()
+    n_jobs = max(1, n_jobs)
+    mask = np.asarray(mask, dtype=bool)
+    n_volumes = data.shape[3]
+
+    # Fits: one chunk per worker at a time
+    voxel_fit = n_volumes * 8 * FIT_MEMORY_FACTOR
+    chunk_size = int(max(1, min(chunk_size, max_memory // 2 // (n_jobs * voxel_fit))))
+    # Signal of a slab: masked signal (+ its copy in shared memory), metrics,
+    # and the whole slices if they are read from a compressed NIfTI
+    voxel_signal = n_volumes * 4 * (1 if n_jobs == 1 else 2) + len(metrics) * 8
+    slice_memory = mask.sum(axis=(0, 1)) * voxel_signal
+    if not isinstance(data, np.ndarray):
+        slice_memory = slice_memory + (
+            mask.shape[0] * mask.shape[1] * n_volumes * np.dtype(data.dtype).itemsize)
+    slabs = get_slabs(slice_memory, max_memory // 2)
+    max_voxels = max(
+        1, max(int(mask[:, :, start:stop].sum()) for start, stop in slabs))
+    print(f"\n{model_name} fit in {len(slabs)} slabs of at most {max_voxels} "
+          f"voxels (chunks of {chunk_size} voxels, {n_jobs} processes)")
+
+    def fit_slabs(fit_signal):
+        """Read each slab, fit it with fit_signal(signal), write its metrics"""
+        for start, stop in slabs:
+            slab_mask = mask[:, :, start:stop]
+            if not slab_mask.any():
+                continue
+            # Only this slab is read (whole slab of a NIfTI proxy)
+            slab = data[:, :, start:stop, :]
+            masked = MaskedDWI(slab, slab_mask)
+            del slab
+            values = fit_signal(masked.signal)
+            for index, metric in enumerate(metrics):
+                outputs[metric][:, :, start:stop][masked.indices] = values[:, index]
+            del masked, values
+
+    if n_jobs == 1:
+        model = _make_model(model_name, bvals, bvecs)
+
+        def fit_signal(signal):
+            output = np.zeros((signal.shape[0], len(metrics)), dtype=np.float64)
+            for start, stop in _get_chunks(signal.shape[0], chunk_size):
+                _fit_voxels(model, signal, output, metrics, start, stop)
+            return output
+
+        fit_slabs(fit_signal)
+        return slabs
+
+    # Shared buffers of the largest slab, workers started once for all slabs
+    signal_shm, shared_signal = _shared_array((max_voxels, n_volumes), np.float32)
+    output_shm, output = _shared_array((max_voxels, len(metrics)), np.float64)
+    try:
+        signal_spec = (signal_shm.name, shared_signal.shape, shared_signal.dtype.str)
+        output_spec = (output_shm.name, output.shape, output.dtype.str)
+        with get_process_pool(
+            n_jobs, _init_worker,
+            (model_name, bvals, bvecs, metrics, signal_spec, output_spec)
+        ) as executor:
+
+            def fit_signal(signal):
+                n_voxels = signal.shape[0]
+                shared_signal[:n_voxels] = signal
+                futures = [
+                    executor.submit(_fit_chunk, start, stop)
+                    for start, stop in _get_chunks(n_voxels, chunk_size)
+                ]
+                for future in futures:
+                    future.result()
+                return output[:n_voxels]
+
+            fit_slabs(fit_signal)
+    finally:
+        del shared_signal, output
+        for shm in (signal_shm, output_shm):
+            shm.close()
+            shm.unlink()
+    return slabs
@@ -0,0 +1,321 @@
+"""
+Marchenko-Pastur PCA denoising of DWI (same method as MRtrix dwidenoise,
+Veraart et al. 2016, "Exp2" noise estimator), run in Python:
+    - the image is split in slabs along z, processed by a pool of
+      processes reading the input as a memmap
+    - in a slab, the patches of the voxels of the (rough) brain mask are
+      decomposed by batches (eigen decomposition of stacked matrices),
+      the size of a batch is bounded by BATCH_MEMORY
+    - denoised data and noise map are written in memmaps on disk, so the
+      memory used does not depend on the size of the image
+Functions:
+    - get_default_extent
+    - get_rough_mask
+    - denoise_mppca: denoised DWI and noise map
+    - compare_with_dwidenoise: speed and difference with dwidenoise
+"""
+
+import math
+import os
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import ndimage
+from termcolor import colored
+
+from mif_io import get_fsl_gradients, load_mif, save_mif
+from native_tools import BZERO_THRESHOLD, read_mif_header
+from resource_manager import get_process_pool, get_thread_budget
+from useful import execute_command, verify_file
+
+# Maximum memory (bytes) of the patches decomposed at the same time in a process
+BATCH_MEMORY = 256 * 1024 * 1024
+# Number of slabs per process (smaller slabs: better balance, more overlap read)
+SLABS_PER_WORKER = 4
+
+
+def get_default_extent(n_volumes):
+    """
+    Default patch size (as dwidenoise): smallest odd size (at least 5)
+    with more voxels in the patch than volumes
+
+    Parameters:
+    - n_volumes (int): number of volumes of the DWI
+
+    Returns:
+    - extent (int)
+    """
+    extent = 5
+    while extent ** 3 <= n_volumes:
+        extent += 2
+    return extent
+
+
+def get_rough_mask(data, bvals, dilation=2):
+    """
+    Rough head mask (threshold of the mean b0, dilated) to restrict the
+    denoising to the voxels with signal
+
+    Parameters:
+    - data (4D array): DWI
+    - bvals (array): b-values (None: first volume used as b0)
+    - dilation (int): number of dilations of the mask
+
+    Returns:
+    - mask (3D boolean array)
+    """
+    b0_volumes = [0] if bvals is None else np.flatnonzero(bvals <= BZERO_THRESHOLD)
+    if len(b0_volumes) == 0:
+        b0_volumes = [0]
+    reference = np.zeros(data.shape[:3], dtype=np.float64)
+    for volume in b0_volumes:
+        reference += data[..., volume]
+    reference /= len(b0_volumes)
+    mask = reference > 0.1 * np.percentile(reference, 99)
+    mask = ndimage.binary_fill_holes(mask)
+    if dilation > 0:
+        mask = ndimage.binary_dilation(mask, iterations=dilation)
+    return mask
+
+
+def _denoise_patches(patches, center):
+    """
+    Denoise the center voxel of a batch of patches
+
+    Parameters:
+    - patches (B x m x n array): m volumes, n voxels per patch
+    - center (B array): index of the center voxel in each patch
+
+    Returns:
+    - denoised (B x m array)
+    - sigma (B array): noise level
+    """
+    n_batch, m, n = patches.shape
+    r, q = min(m, n), max(m, n)
+    batch = np.arange(n_batch)
+    if m <= n:
+        gram = patches @ patches.transpose(0, 2, 1)
+    else:
+        gram = patches.transpose(0, 2, 1) @ patches
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+
+    # Marchenko-Pastur: the p smallest eigenvalues are noise while their
+    # mean is larger than the MP estimate of the noise variance
+    lam = np.maximum(eigenvalues, 0) / q
+    p = np.arange(r)
+    gamma = (p + 1) / (q - (r - p - 1))
+    sigsq1 = np.cumsum(lam, axis=1) / (p + 1)
+    sigsq2 = (lam - lam[:, :1]) / (4 * np.sqrt(gamma))
+    is_noise = sigsq2 < sigsq1
+    has_noise = is_noise.any(axis=1)
+    last = r - 1 - np.argmax(is_noise[:, ::-1], axis=1)
+    cutoff = np.where(has_noise, last + 1, 0)
+    sigma2 = np.where(has_noise, sigsq1[batch, last], 0.0)
+    keep = (p[None, :] >= cutoff[:, None]).astype(patches.dtype)
+
+    # Signal of the center voxel, projected on the kept components
+    if m <= n:
+        signal = patches[batch, :, center]
+        coefficients = np.einsum("bkj,bk->bj", eigenvectors, signal) * keep
+        denoised = np.einsum("bij,bj->bi", eigenvectors, coefficients)
+    else:
+        weights = np.einsum("bij,bj->bi", eigenvectors, eigenvectors[batch, center] * keep)
+        denoised = np.einsum("bmn,bn->bm", patches, weights)
+    return denoised, np.sqrt(sigma2)
+
+
+def _denoise_slab(in_dwi, out_raw, noise_raw, shape, z_range, mask_slab, extent):
+    """
+    Denoise the slices z_range of the DWI (run in a worker process)
+
+    The slab and its neighbour slices (half of the patch) are read in the
+    input memmap, the result is written in the output memmaps.
+    """
+    z0, z1 = z_range
+    data, _ = load_mif(in_dwi)
+    n_x, n_y, n_z, m = shape
+    ext = [min(extent, d) for d in (n_x, n_y, n_z)]
+    half = [e // 2 for e in ext]
+    n = ext[0] * ext[1] * ext[2]
+
+    # Patch of a voxel: centered, shifted to stay in the image (as dwidenoise)
+    zs = max(0, min(z0 - half[2], n_z - ext[2]))
+    ze = min(n_z, max(z1 + half[2], zs + ext[2]))
+    local = np.asarray(data[:, :, zs:ze, :], dtype=np.float32)
+    windows = sliding_window_view(local, ext, axis=(0, 1, 2))
+
+    out_slab = np.array(local[:, :, z0 - zs:z1 - zs, :])
+    noise_slab = np.zeros((n_x, n_y, z1 - z0), dtype=np.float32)
+    voxels = np.argwhere(mask_slab)
+    batch_size = max(1, BATCH_MEMORY // (8 * (3 * m * n + 2 * min(m, n) ** 2)))
+    for start in range(0, len(voxels), batch_size):
+        x, y, z = voxels[start:start + batch_size].T
+        z_image = z + z0
+        sx = np.clip(x - half[0], 0, n_x - ext[0])
+        sy = np.clip(y - half[1], 0, n_y - ext[1])
+        sz = np.clip(z_image - half[2], 0, n_z - ext[2])
+        patches = windows[sx, sy, sz - zs].reshape(len(x), m, n).astype(np.float64)
+        center = ((x - sx) * ext[1] + (y - sy)) * ext[2] + (z_image - sz)
+        denoised, sigma = _denoise_patches(patches, center)
+        out_slab[x, y, z] = denoised
+        noise_slab[x, y, z] = sigma
+
+    out = np.memmap(out_raw, dtype=np.float32, mode="r+", shape=shape, order="F")
+    out[:, :, z0:z1, :] = out_slab
+    out.flush()
+    noise = np.memmap(noise_raw, dtype=np.float32, mode="r+", shape=shape[:3], order="F")
+    noise[:, :, z0:z1] = noise_slab
+    noise.flush()
+    return int(len(voxels))
+
+
+def denoise_mppca(in_dwi, out_dwi, noise_map, mask=None, extent=None, n_workers=None):
+    """
+    Denoise a DWI with MP-PCA (alternative to dwidenoise)
+
+    Only the voxels of the mask are denoised (other voxels are copied, their
+    noise is 0). The outputs are not computed again if they are newer than
+    the input and were computed with the same patch size.
+
+    Parameters:
+    - in_dwi (string): path to the DWI (.mif)
+    - out_dwi (string): path to the denoised DWI (.mif)
+    - noise_map (string): path to the noise map (.mif)
+    - mask (string): (optionnal) path to a mask (.mif), default: rough
+                     head mask (see get_rough_mask)
+    - extent (int): (optionnal) patch size (default: see get_default_extent)
+    - n_workers (int): (optionnal) number of processes (default: thread
+                       budget of the stage)
+
+    Returns:
+    - int: 1 success, 0 failure
+    - msg
+    """
+    data, header = load_mif(in_dwi)
+    if data.ndim != 4:
+        msg = f"\nCan not denoise {in_dwi}: not a 4D image"
+        return 0, msg
+    shape = data.shape
+    if extent is None:
+        extent = get_default_extent(shape[3])
+    parameters = [f"extent={extent}" + (f",mask={os.path.abspath(mask)}" if mask else "")]
+    if (
+        verify_file(out_dwi) and verify_file(noise_map)
+        and min(os.path.getmtime(out_dwi), os.path.getmtime(noise_map))
+        >= os.path.getmtime(in_dwi)
+        and (read_mif_header(out_dwi) or {}).get("denoise_mppca") == parameters
+    ):
+        msg = f"\nDenoised image already exists: {out_dwi}"
+        print(msg)
+        return 1, msg
+
+    print(colored("\n~~MP-PCA denoising starts~~", "cyan"))
+    start = time.time()
+    if mask is None:
+        bvals, _ = get_fsl_gradients(header)
+        mask_data = get_rough_mask(data, bvals, dilation=extent // 2)
+    else:
+        mask_data, _ = load_mif(mask)
+        mask_data = np.asarray(mask_data).reshape(shape[:3]) > 0
+    if n_workers is None:
+        n_workers = get_thread_budget()
+    n_workers = max(1, min(n_workers, shape[2]))
+    thickness = max(1, math.ceil(shape[2] / (n_workers * SLABS_PER_WORKER)))
+    slabs = [(z, min(z + thickness, shape[2])) for z in range(0, shape[2], thickness)]
+
+    out_directory = os.path.dirname(os.path.abspath(out_dwi))
+    out_raw = os.path.join(out_directory, f".tmp{os.getpid()}_mppca_dwi.raw")
+    noise_raw = os.path.join(out_directory, f".tmp{os.getpid()}_mppca_noise.raw")
+    try:
+        np.memmap(out_raw, dtype=np.float32, mode="w+", shape=shape, order="F").flush()
+        np.memmap(noise_raw, dtype=np.float32, mode="w+", shape=shape[:3], order="F").flush()
+        with get_process_pool(n_workers) as executor:
+            futures = [
+                executor.submit(
+                    _denoise_slab, os.path.abspath(in_dwi), out_raw, noise_raw, shape,
+                    (z0, z1), mask_data[:, :, z0:z1], extent
+                )
+                for z0, z1 in slabs
+            ]
+            n_voxels = sum(future.result() for future in futures)
+
+        header["keyval"]["denoise_mppca"] = parameters
+        out = np.memmap(out_raw, dtype=np.float32, mode="r", shape=shape, order="F")
+        save_mif(out_dwi, out, header=header)
+        noise_header = {k: v for k, v in header.items() if k != "dw_scheme"}
+        noise = np.memmap(noise_raw, dtype=np.float32, mode="r", shape=shape[:3], order="F")
+        save_mif(noise_map, noise, header=noise_header)
+    except (OSError, ValueError, MemoryError) as e:
+        msg = f"\nMP-PCA denoising of {in_dwi} failed: {e}"
+        return 0, msg
+    finally:
+        for path in (out_raw, noise_raw):
+            if os.path.exists(path):
+                os.remove(path)
+
+    msg = (f"\nMP-PCA denoising done ({n_voxels} voxels, extent {extent}, "
+           f"{n_workers} processes, {time.time() - start:.1f} s): {out_dwi}")
+    print(colored(msg, "cyan"))
+    return 1, msg
+
+
+def compare_with_dwidenoise(in_dwi, out_directory, extent=None):
+    """
+    Run denoise_mppca and dwidenoise on the same DWI and compare them
+
+    Parameters:
+    - in_dwi (string): path to the DWI (.mif)
+    - out_directory (string): directory of the outputs of both methods
+    - extent (int): (optionnal) patch size given to both methods
+
+    Returns:
+    - int: 1 success, 0 failure
+    - msg
+    - report (dict): wall time of each method (s), relative RMS difference
+                     of the denoised DWI and of the noise maps (in the mask),
+                     correlation of the noise maps
+    """
+    os.makedirs(out_directory, exist_ok=True)
+    data, header = load_mif(in_dwi)
+    if extent is None:
+        extent = get_default_extent(data.shape[3])
+    outputs = {
+        method: (os.path.join(out_directory, f"dwi_{method}.mif"),
+                 os.path.join(out_directory, f"noise_{method}.mif"))
+        for method in ["mppca", "dwidenoise"]
+    }
+    report = {}
+
+    start = time.time()
+    result, msg = denoise_mppca(in_dwi, *outputs["mppca"], extent=extent)
+    if result == 0:
+        return 0, msg, report
+    report["time_mppca"] = time.time() - start
+
+    start = time.time()
+    cmd = ["dwidenoise", in_dwi, outputs["dwidenoise"][0], "-noise", outputs["dwidenoise"][1],
+           "-extent", str(extent), "-force"]
+    result, stderrl, sdtoutl = execute_command(cmd)
+    if result != 0:
+        msg = f"\nCannot launch dwidenoise (exit code {result})"
+        return 0, msg, report
+    report["time_dwidenoise"] = time.time() - start
+
+    bvals, _ = get_fsl_gradients(header)
+    mask = get_rough_mask(data, bvals, dilation=0)
+    dwi = {m: load_mif(paths[0])[0][mask] for m, paths in outputs.items()}
+    noise = {m: load_mif(paths[1])[0][mask] for m, paths in outputs.items()}
+    report["dwi_relative_rms"] = float(
+        np.sqrt(np.mean((dwi["mppca"] - dwi["dwidenoise"]) ** 2))
+        / np.sqrt(np.mean(dwi["dwidenoise"] ** 2))
+    )
+    report["noise_relative_rms"] = float(
+        np.sqrt(np.mean((noise["mppca"] - noise["dwidenoise"]) ** 2))
+        / np.sqrt(np.mean(noise["dwidenoise"] ** 2))
+    )
+    report["noise_correlation"] = float(np.corrcoef(noise["mppca"], noise["dwidenoise"])[0, 1])
+
+    msg = "\nMP-PCA vs dwidenoise: " + ", ".join(f"{k}: {v:.4g}" for k, v in report.items())
+    print(colored(msg, "cyan"))
+    return 1, msg, report
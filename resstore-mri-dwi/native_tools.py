@@ -0,0 +1,296 @@
+"""
+In-process replacements for small external commands (no fork):
+    - copy_file, move_file, remove_path: instead of cp, mv, rm
+    - link_file: symbolic link instead of a copy
+    - execute_native: run cp / mv / rm commands in-process, others with
+      useful.execute_command
+    - read_mif_header
+    - get_ndim: instead of mrinfo -ndim (NIfTI and MIF headers)
+    - get_bvalues: b-values of a MIF (dw_scheme) or of its .bval file
+    - get_shell_bvalues: instead of mrinfo -shell_bvalues
+Functions return None when the file can not be read natively, the
+caller then uses the external tool.
+"""
+
+import gzip
+import os
+import shutil
+import struct
+
+# Same defaults as MRtrix (BZeroThreshold and BValueEpsilon)
+BZERO_THRESHOLD = 10.0
+BVALUE_EPSILON = 80.0
+
+
+def copy_file(src, dst):
+    """
+    Copy a file (cp)
+
+    Parameters:
+    - src (string): file to copy
+    - dst (string): destination file or directory
+
+    Returns:
+    - result: 0 success, 1 failure
+    - msg
+    """
+    try:
+        shutil.copy2(src, dst)
+    except OSError as e:
+        return 1, f"\nCan not copy {src} to {dst}: {e}"
+    return 0, f"\nCopy of {src} to {dst} done"
+
+
+def link_file(src, dst):
+    """
+    Make dst a symbolic link to src (relative if in the same directory),
+    copy src if links are not supported
+
+    Parameters:
+    - src (string): file to link
+    - dst (string): link to create (replaced if it exists)
+
+    Returns:
+    - result: 0 success, 1 failure
+    - msg
+    """
+    src, dst = os.path.abspath(src), os.path.abspath(dst)
+    target = src
+    if os.path.dirname(src) == os.path.dirname(dst):
+        target = os.path.basename(src)
+    try:
+        if os.path.islink(dst) and os.readlink(dst) == target:
+            return 0, f"\n{dst} already links to {src}"
+        if os.path.lexists(dst):
+            os.remove(dst)
+        os.symlink(target, dst)
+    except OSError:
+        return copy_file(src, dst)
+    return 0, f"\nLink {dst} to {src} done"
+
+
+def move_file(src, dst):
+    """
+    Move or rename a file (mv)
+
+    Parameters:
+    - src (string): file to move
+    - dst (string): destination file or directory
+
+    Returns:
+    - result: 0 success, 1 failure
+    - msg
+    """
+    try:
+        shutil.move(src, dst)
+    except OSError as e:
+        return 1, f"\nCan not move {src} to {dst}: {e}"
+    return 0, f"\nMove of {src} to {dst} done"
+
+
+def remove_path(path):
+    """
+    Remove a file or a directory (rm / rm -r)
+
+    Parameters:
+    - path (string): file or directory to remove
+
+    Returns:
+    - result: 0 success, 1 failure
+    - msg
+    """
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError as e:
+        return 1, f"\nCan not remove {path}: {e}"
+    return 0, f"\n{path} removed"
+
+
+def execute_native(command):
+    """
+    Execute a command, in-process for cp / mv / rm
+
+    Commands with options (ex: cp -r) or other tools are run with
+    useful.execute_command.
+
+    Parameters:
+    - command: command to execute (a list)
+
+    Returns:
+    - result: exit code (0 success)
+    - stderrl
+    - sdtoutl
+    """
+    tool = os.path.basename(str(command[0]))
+    args = [str(arg) for arg in command[1:]]
+    if not any(arg.startswith("-") for arg in args):
+        print("\n", command, "(in-process)")
+        result = None
+        if tool == "cp" and len(args) == 2:
+            result, msg = copy_file(*args)
+        elif tool == "mv" and len(args) == 2:
+            result, msg = move_file(*args)
+        elif tool == "rm" and len(args) >= 1:
+            result, msg = 0, ""
+            for path in args:
+                res, msg_path = remove_path(path)
+                if res != 0:
+                    result, msg = res, msg_path
+        if result is not None:
+            stderrl = msg.encode() if result != 0 else b""
+            if result != 0:
+                print("stderrl: ", msg)
+            return result, stderrl, b""
+
+    from useful import execute_command
+    return execute_command(command)
+
+
+def _open_image(path):
+    """Open an image file, gzip compressed or not"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def read_mif_header(path):
+    """
+    Read the header of a MIF image (.mif or .mif.gz)
+
+    Parameters:
+    - path (string): path to the image
+
+    Returns:
+    - header (dict): {key: list of values (strings)}, None if the file is
+                     not a valid MIF image
+    """
+    header = {}
+    try:
+        with _open_image(path) as stream:
+            if stream.readline().strip() != b"mrtrix image":
+                return None
+            for line in stream:
+                line = line.decode("utf-8", errors="replace").strip()
+                if line == "END":
+                    return header
+                if ":" not in line:
+                    continue
+                key, value = line.split(":", 1)
+                header.setdefault(key.strip(), []).append(value.strip())
+    except (OSError, EOFError):
+        return None
+    return None
+
+
+def _nifti_dims(path):
+    """Dimensions of a NIfTI-1 / NIfTI-2 image, from its header"""
+    with _open_image(path) as stream:
+        raw = stream.read(540)
+    for endian in ["<", ">"]:
+        if len(raw) >= 348 and struct.unpack(endian + "i", raw[:4])[0] == 348:
+            dims = struct.unpack(endian + "8h", raw[40:56])
+            break
+        if len(raw) >= 540 and struct.unpack(endian + "i", raw[:4])[0] == 540:
+            dims = struct.unpack(endian + "8q", raw[16:80])
+            break
+    else:
+        return None
+    if not 1 <= dims[0] <= 7:
+        return None
+    return list(dims[1:dims[0] + 1])
+
+
+def get_ndim(path):
+    """
+    Get the number of dimensions of an image (as mrinfo -ndim)
+
+    Trailing axes of size 1 (after the third) are not counted, as MRtrix.
+
+    Parameters:
+    - path (string): path to the image (.mif, .mif.gz, .nii, .nii.gz)
+
+    Returns:
+    - ndim (int): None if the header can not be read natively
+    """
+    try:
+        if path.endswith((".mif", ".mif.gz")):
+            header = read_mif_header(path)
+            if header is None or "dim" not in header:
+                return None
+            dims = [int(d) for d in header["dim"][0].split(",")]
+        elif path.endswith((".nii", ".nii.gz")):
+            dims = _nifti_dims(path)
+            if dims is None:
+                return None
+        else:
+            return None
+    except (OSError, EOFError, ValueError, struct.error):
+        return None
+    while len(dims) > 3 and dims[-1] == 1:
+        dims.pop()
+    return len(dims)
+
+
+def get_bvalues(path):
+    """
+    Get the b-value of each volume of a diffusion image
+
+    Read in the dw_scheme of a MIF image, or in the .bval file next to
+    a NIfTI image.
+
+    Parameters:
+    - path (string): path to the image
+
+    Returns:
+    - bvalues (list of float): None if there is no gradient table
+    """
+    try:
+        if path.endswith((".mif", ".mif.gz")):
+            header = read_mif_header(path)
+            if header is None or "dw_scheme" not in header:
+                return None
+            return [float(row.split(",")[3]) for row in header["dw_scheme"]]
+        for ext in [".nii.gz", ".nii"]:
+            if path.endswith(ext):
+                bval = path[:-len(ext)] + ".bval"
+                if not os.path.exists(bval):
+                    return None
+                with open(bval, encoding="utf-8") as stream:
+                    return [float(b) for b in stream.read().split()]
+    except (OSError, ValueError, IndexError):
+        return None
+    return None
+
+
+def get_shell_bvalues(path):
+    """
+    Get the mean b-value of each shell (as mrinfo -shell_bvalues)
+
+    b-values lower than BZERO_THRESHOLD are b=0 volumes, other b-values
+    are grouped in shells when they are closer than BVALUE_EPSILON.
+
+    Parameters:
+    - path (string): path to the image
+
+    Returns:
+    - shell (list of strings): mean b-values, None if the gradient table
+                               can not be read natively
+    """
+    bvalues = get_bvalues(path)
+    if not bvalues:
+        return None
+    shells = []
+    previous = None
+    for b in sorted(b for b in bvalues if b > BZERO_THRESHOLD):
+        if previous is not None and b - previous <= BVALUE_EPSILON:
+            shells[-1].append(b)
+        else:
+            shells.append([b])
+        previous = b
+    bzeros = [b for b in bvalues if b <= BZERO_THRESHOLD]
+    if bzeros:
+        shells.insert(0, bzeros)
+    return [f"{sum(s) / len(s):g}" for s in shells]
@@ -0,0 +1,444 @@
+"""
+Stages of the processing of one acquisition (see stage_graph):
+    - TENSOR_BACKENDS: tensor fits giving the FA / MD maps of the MNI
+                       steps and of the tractometry
+    - get_processing_stages: declare the stage graph
+    - stage_*: one function per stage, called with its inputs and
+               returning (int, msg, outputs)
+
+Stages graph (-> = "needed by"):
+
+    preprocessing -> mrtrix_DTI
+                  -> dipy_DTI -> register_to_MNI_FA -> FOD -> TractSeg -> tractometry
+                  -> NODDI (multishell)                                      ^
+                  -> dipy_DKI (multishell)                                   |
+    NODDI, DKI, dipy_DTI + register_to_MNI_FA -> maps in MNI (FA template) --+
+    t1_bet -> register_to_MNI_using_T1w (+ preprocessing, dipy_DTI)
+           -> maps in MNI (T1w)
+
+With a crop margin, the preprocessing crops the images to the brain and
+the uncrop_maps stage puts the native maps back in the original grid
+(native_grid directory) once the fits are done.
+
+With a tensor backend other than "all", each model is fitted once: only
+the stage of the backend (mrtrix_DTI, dipy_DTI or dipy_DKI) gives the
+FA / MD maps ("info_DTI", "map_md_nii") used after it.
+"""
+
+import os
+
+from termcolor import colored
+
+from AMICO_NODDI import NODDI
+from DIPY_DKI_DTI import dipy_DKI, dipy_DTI
+from dwi_dataset import get_dataset
+from JHU_analysis import maps_in_MNI_applywarp, register_to_MNI_using_T1w
+from MRtrix_DTI import mrtrix_DTI
+from MRtrix_FOD import FOD
+from preprocessing import run_preproc_dwi
+from stage_graph import make_stage
+from T1_preproc import t1_bet
+from TractSeg_processing import (
+    maps_in_MNI_flirt_applyxfm,
+    register_to_MNI_FA,
+    run_tractometry,
+    run_tractseg,
+    tractometry_postprocess,
+)
+from conversions import get_image
+from crop import uncrop_maps
+from useful import convert_mif_to_nifti, verify_file
+
+# "all": mrtrix, dipy DTI and dipy DKI fits, dipy DTI maps used after them
+TENSOR_BACKENDS = ["all", "dipy_dti", "dipy_dki", "mrtrix"]
+# Stage giving the FA / MD maps for each tensor backend
+_TENSOR_STAGES = {
+    "all": "dipy_DTI",
+    "dipy_dti": "dipy_DTI",
+    "dipy_dki": "dipy_DKI",
+    "mrtrix": "mrtrix_DTI",
+}
+
+
+def _make_dir(*paths):
+    """Create (if needed) and return a directory"""
+    directory = os.path.join(*paths)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _list_maps(map_dir):
+    """List the NIfTI maps of a directory"""
+    return sorted(
+        os.path.join(map_dir, file_name)
+        for file_name in os.listdir(map_dir)
+        if file_name.endswith(".nii.gz")
+    )
+
+
+def stage_preprocessing(in_dwi, pe_dir, readout_time, shell, in_pepolar_AP, in_pepolar_PA,
+                        discard_intermediate, denoise_backend, crop_margin):
+    """Preprocessing of the DWI (denoise, degibbs, eddy, bias, mask)"""
+    result, msg, info_preproc = run_preproc_dwi(
+        in_dwi, pe_dir,
+        readout_time,
+        shell=shell,
+        in_pepolar_PA=in_pepolar_PA,
+        in_pepolar_AP=in_pepolar_AP,
+        discard_intermediate=discard_intermediate,
+        denoise_backend=denoise_backend,
+        crop_margin=crop_margin
+    )
+    return result, msg, {"info_preproc": info_preproc}
+
+
+def stage_mrtrix_DTI(info_preproc, analysis_directory, tensor_backend):
+    """Compute FA map with MRtrix"""
+    FA_dir = _make_dir(analysis_directory, "FA")
+    result, msg, info_fa = mrtrix_DTI(
+        info_preproc["dwi_preproc"], info_preproc["brain_mask"], FA_dir)
+    if result == 0 or tensor_backend != "mrtrix":
+        return result, msg, {"info_fa": info_fa}
+
+    # FA and MD (ADC) maps used for the MNI steps (NIfTI)
+    maps_nii = []
+    for map_mif in [info_fa["FA_map"], os.path.join(FA_dir, "ADC_map.mif")]:
+        result, msg, map_nii = get_image(map_mif, "nifti", diff=False)
+        if result == 0:
+            return result, msg, {}
+        maps_nii.append(map_nii)
+    return 1, "\nFA_map done", {
+        "info_fa": info_fa, "info_DTI": {"FA_map": maps_nii[0]}, "map_md_nii": maps_nii[1]
+    }
+
+
+def stage_dipy_DTI(info_preproc, analysis_directory):
+    """Compute DTI maps with dipy"""
+    DTI_dir = _make_dir(analysis_directory, "DTI_dipy")
+    result, msg, info_DTI = dipy_DTI(
+        info_preproc["dwi_preproc"], info_preproc["brain_mask_nii"], DTI_dir)
+    if result == 0:
+        return result, msg, {}
+
+    # MD map used for the MNI steps
+    FA_dir = _make_dir(analysis_directory, "FA")
+    map_md = info_DTI["FA_map"].replace("FA", "MD")
+    if ".mif" in map_md:
+        nii_return, nii_msg, map_md_nii = convert_mif_to_nifti(map_md, FA_dir, diff=False)
+        if nii_return == 0:
+            return 0, nii_msg, {}
+    else:
+        map_md_nii = map_md
+    return result, msg, {"info_DTI": info_DTI, "map_md_nii": map_md_nii}
+
+
+def stage_NODDI(info_preproc, analysis_directory):
+    """Compute NODDI maps with AMICO (multishell data)"""
+    mask_nii = info_preproc["brain_mask_nii"]
+    AMICO_dir = os.path.join(analysis_directory, "AMICO")
+    print(colored("\n~~NODDI starts~~", "cyan"))
+    if not verify_file(AMICO_dir):
+        # Same dataset as the dipy fits, AMICO reads it from an uncompressed NIfTI
+        dataset = get_dataset(info_preproc["dwi_preproc"], mask_nii)
+        NODDI_dir = NODDI(dataset.get_nifti(), mask_nii)
+    else:
+        base_dir = os.path.dirname(os.path.dirname(mask_nii))
+        NODDI_dir = os.path.join(base_dir, "AMICO", "NODDI")
+        print(colored("\nNODDI ends", "cyan"))
+    if not os.path.isdir(NODDI_dir):
+        msg = f"\nNODDI failed: no NODDI maps in {NODDI_dir}"
+        return 0, msg, {}
+    return 1, "\nNODDI done", {"NODDI_dir": NODDI_dir}
+
+
+def stage_dipy_DKI(info_preproc, analysis_directory, tensor_backend, fit_memory):
+    """Compute DKI maps with dipy (multishell data)"""
+    DKI_dir = _make_dir(analysis_directory, "DKI")
+    result, msg, info_DKI = dipy_DKI(
+        info_preproc["dwi_preproc"], info_preproc["brain_mask_nii"], DKI_dir,
+        max_memory=fit_memory)
+    if result == 0 or tensor_backend != "dipy_dki":
+        return result, msg, {"DKI_dir": DKI_dir}
+
+    # FA and MD of the diffusion tensor of the DKI fit used for the MNI steps
+    info_DTI = {"FA_map": info_DKI["FA_map"]}
+    return result, msg, {
+        "DKI_dir": DKI_dir, "info_DTI": info_DTI, "map_md_nii": info_DKI["MD_map"]
+    }
+
+
+def stage_uncrop_maps(info_preproc, analysis_directory, info_fa=None, info_DTI=None,
+                      NODDI_dir=None, DKI_dir=None):
+    """Native maps in the original grid (preprocessing with crop)"""
+    print(colored("\n~~Uncrop starts~~", "cyan"))
+    map_dirs = [DKI_dir, NODDI_dir]
+    for info in [info_fa, info_DTI]:
+        if info is not None:
+            map_dirs.append(os.path.dirname(info["FA_map"]))
+    native_dir = _make_dir(analysis_directory, "native_grid")
+    maps = []
+    for map_dir in sorted(set(d for d in map_dirs if d is not None)):
+        maps += uncrop_maps(
+            map_dir, os.path.join(native_dir, os.path.basename(map_dir)),
+            info_preproc["crop"])
+    msg = f"\nUncrop done: {native_dir}"
+    print(colored(msg, "cyan"))
+    return 1, msg, {"maps_native_grid": maps}
+
+
+def stage_register_to_MNI_FA(info_preproc, info_DTI, analysis_directory, mni_mask):
+    """Align DWI and FA in the MNI space for TractSeg"""
+    MNI_dir = _make_dir(analysis_directory, "analysis_tractseg", "Results_MNI")
+    native_mask = info_preproc["brain_mask_nii"] if mni_mask == "warp" else None
+    result, msg, info_mni = register_to_MNI_FA(
+        info_preproc["dwi_preproc"], info_DTI["FA_map"], MNI_dir, native_mask=native_mask)
+    return result, msg, {"info_mni": info_mni, "MNI_dir": MNI_dir}
+
+
+def stage_MD_to_MNI_FA(map_md_nii, MNI_dir):
+    """MD map in the MNI space (FA template)"""
+    MD_MNI = maps_in_MNI_flirt_applyxfm([map_md_nii], MNI_dir, MNI_dir)[0]
+    return 1, "\nMD in MNI done", {"MD_MNI": MD_MNI}
+
+
+def stage_NODDI_to_MNI_FA(NODDI_dir, MNI_dir):
+    """NODDI maps in the MNI space (FA template)"""
+    NODDI_MNI = _make_dir(MNI_dir, "NODDI_MNI")
+    maps_in_MNI_flirt_applyxfm(_list_maps(NODDI_dir), NODDI_MNI, MNI_dir)
+    return 1, "\nNODDI maps in MNI done", {"NODDI_MNI": NODDI_MNI}
+
+
+def stage_DKI_to_MNI_FA(DKI_dir, MNI_dir):
+    """DKI maps in the MNI space (FA template)"""
+    DKI_MNI = _make_dir(MNI_dir, "DKI_MNI")
+    maps_in_MNI_flirt_applyxfm(_list_maps(DKI_dir), DKI_MNI, MNI_dir)
+    # MD of the DKI fit (tensor backend "dipy_dki": no MD_to_MNI_FA stage)
+    MD_MNI = os.path.join(DKI_MNI, "dki_MD_MNI.nii.gz")
+    return 1, "\nDKI maps in MNI done", {"DKI_MNI": DKI_MNI, "MD_MNI": MD_MNI}
+
+
+def stage_FOD(info_mni, analysis_directory, shell, average_fod):
+    """FOD estimations and peaks extraction"""
+    FOD_dir = _make_dir(analysis_directory, "analysis_tractseg", "FOD")
+    result, msg, peaks = FOD(
+        info_mni["dwi_preproc_mni"],
+        info_mni["dwi_mask_mni"],
+        FOD_dir,
+        multishell=shell,
+        average=average_fod
+    )
+    return result, msg, {"peaks": peaks}
+
+
+def stage_tractseg(peaks, analysis_directory):
+    """Tractography (TractSeg)"""
+    Tract_dir = _make_dir(analysis_directory, "analysis_tractseg", "Tracto")
+    result, msg = run_tractseg(peaks, Tract_dir)
+    return result, msg, {"Tract_dir": Tract_dir}
+
+
+def stage_tractometry(Tract_dir, info_mni, MD_MNI, NODDI_MNI=None, DKI_MNI=None):
+    """
+    Tractometry (maps must be in the MNI space).
+    Tractometry commands of all maps are run at the same time, then
+    plots are done one after the other (tractometry_postprocess
+    updates a shared subjects.txt file).
+    """
+    print(colored("\n~~Tractometry starts~~", "cyan"))
+    maps = [info_mni["FA_MNI"], MD_MNI]
+    if NODDI_MNI is not None:
+        maps.append(os.path.join(NODDI_MNI, "NDI_MNI.nii.gz"))
+    if DKI_MNI is not None:
+        maps.append(os.path.join(DKI_MNI, "dki_kFA_MNI.nii.gz"))
+        maps.append(os.path.join(DKI_MNI, "dki_MK_MNI.nii.gz"))
+    if NODDI_MNI is not None:
+        maps.append(os.path.join(NODDI_MNI, "ODI_MNI.nii.gz"))
+    result, msg = run_tractometry(maps, Tract_dir)
+    if result == 0:
+        print(colored(msg, "red"))
+        return result, msg, {}
+    for map_path in maps:
+        tractometry_postprocess(map_path, Tract_dir)
+    msg = "\nTractometry done."
+    print(colored(msg, "cyan"))
+    return 1, msg, {"tractometry": maps}
+
+
+def stage_t1_bet(in_t1w_nifti, analysis_directory):
+    """Brain extraction of the T1w (JHU analysis)"""
+    jhu_dir = _make_dir(analysis_directory, "analysis_jhu")
+    result, msg, info_bet = t1_bet(in_t1w_nifti, jhu_dir)
+    return result, msg, {"info_bet": info_bet}
+
+
+def stage_register_to_MNI_using_T1w(in_t1w_nifti, info_bet, info_preproc, info_DTI,
+                                    analysis_directory):
+    """Registration to the MNI space using T1w (JHU analysis)"""
+    jhu_dir = _make_dir(analysis_directory, "analysis_jhu")
+    res = register_to_MNI_using_T1w(
+        in_t1w_nifti, info_bet["t1_brain"],
+        info_preproc["mean_b0"], info_DTI["FA_map"], jhu_dir
+    )
+    if res[0] == 0:
+        return 0, res[1], {}
+    return res[0], res[1], {"info_mni_jhu": res[2], "jhu_dir": jhu_dir}
+
+
+def stage_maps_to_MNI_T1w(info_mni_jhu, jhu_dir, map_md_nii, NODDI_dir=None, DKI_dir=None):
+    """Maps in the MNI space (JHU analysis)"""
+    print(colored("\n~~Map in MNI step starts~~", "cyan"))
+    maps = [map_md_nii]
+    for map_dir in [NODDI_dir, DKI_dir]:
+        if map_dir is not None:
+            maps += _list_maps(map_dir)
+    # MD map already in DKI_dir with the tensor backend "dipy_dki"
+    maps = list(dict.fromkeys(maps))
+    maps_in_MNI_applywarp(
+        maps, info_mni_jhu["T12MNI_warp"], info_mni_jhu["b0_to_T1_mat"], jhu_dir)
+    print(colored("\nMap in MNI step ends", "cyan"))
+    return 1, "\nMaps in MNI (JHU) done", {"maps_MNI_jhu": maps}
+
+
+def get_processing_stages(shell, t1w=True, tensor_backend="all", crop=False):
+    """
+    Declare the stages of the processing of one acquisition
+
+    Parameters:
+    - shell (boolean): multishell data (NODDI and DKI stages)
+    - t1w (boolean): T1w available (JHU analysis stages)
+    - tensor_backend (string): (optionnal) see TENSOR_BACKENDS, "dipy_dki"
+                               needs multishell data (else "dipy_dti")
+    - crop (boolean): (optionnal) the preprocessing crops the images
+                      (uncrop stage of the native maps)
+
+    Returns:
+    - stages (list of dict): see stage_graph.make_stage
+    """
+    if tensor_backend == "dipy_dki" and not shell:
+        print(colored(
+            "\nDKI can not be fitted on single shell data, DTI fitted with dipy",
+            "yellow"))
+        tensor_backend = "dipy_dti"
+
+    def fit_outputs(name, outputs):
+        """Outputs of a fit stage (+ FA / MD maps for the tensor backend)"""
+        if name == _TENSOR_STAGES[tensor_backend]:
+            return outputs + ["info_DTI", "map_md_nii"]
+        return outputs
+
+    stages = [
+        make_stage(
+            "preprocessing", stage_preprocessing,
+            inputs=["in_dwi", "pe_dir", "readout_time", "shell",
+                    "in_pepolar_AP", "in_pepolar_PA", "discard_intermediate",
+                    "denoise_backend", "crop_margin"],
+            outputs=["info_preproc"],
+        ),
+    ]
+    if tensor_backend in ("all", "mrtrix"):
+        stages.append(make_stage(
+            "mrtrix_DTI", stage_mrtrix_DTI,
+            inputs=["info_preproc", "analysis_directory", "tensor_backend"],
+            outputs=fit_outputs("mrtrix_DTI", ["info_fa"]),
+        ))
+    if tensor_backend in ("all", "dipy_dti"):
+        stages.append(make_stage(
+            "dipy_DTI", stage_dipy_DTI,
+            inputs=["info_preproc", "analysis_directory"],
+            outputs=fit_outputs("dipy_DTI", []),
+        ))
+    if shell:
+        stages += [
+            make_stage(
+                "NODDI", stage_NODDI,
+                inputs=["info_preproc", "analysis_directory"],
+                outputs=["NODDI_dir"],
+            ),
+            make_stage(
+                "dipy_DKI", stage_dipy_DKI,
+                inputs=["info_preproc", "analysis_directory", "tensor_backend",
+                        "fit_memory"],
+                outputs=fit_outputs("dipy_DKI", ["DKI_dir"]),
+            ),
+        ]
+    if crop:
+        # After all the fits of the native maps
+        native_maps = [
+            output for stage in stages[1:] for output in stage["outputs"]
+            if output in ("info_fa", "info_DTI", "NODDI_dir", "DKI_dir")
+        ]
+        stages.append(make_stage(
+            "uncrop_maps", stage_uncrop_maps,
+            inputs=["info_preproc", "analysis_directory"] + native_maps,
+            outputs=["maps_native_grid"],
+        ))
+    stages += [
+        make_stage(
+            "register_to_MNI_FA", stage_register_to_MNI_FA,
+            inputs=["info_preproc", "info_DTI", "analysis_directory", "mni_mask"],
+            outputs=["info_mni", "MNI_dir"],
+        ),
+    ]
+    # With "dipy_dki", the MD map is aligned with the other DKI maps
+    if tensor_backend != "dipy_dki":
+        stages.append(make_stage(
+            "MD_to_MNI_FA", stage_MD_to_MNI_FA,
+            inputs=["map_md_nii", "MNI_dir"],
+            outputs=["MD_MNI"],
+        ))
+    if shell:
+        stages += [
+            make_stage(
+                "NODDI_to_MNI_FA", stage_NODDI_to_MNI_FA,
+                inputs=["NODDI_dir", "MNI_dir"],
+                outputs=["NODDI_MNI"],
+            ),
+            make_stage(
+                "DKI_to_MNI_FA", stage_DKI_to_MNI_FA,
+                inputs=["DKI_dir", "MNI_dir"],
+                outputs=["DKI_MNI"] + (["MD_MNI"] if tensor_backend == "dipy_dki" else []),
+            ),
+        ]
+    tractometry_inputs = ["Tract_dir", "info_mni", "MD_MNI"]
+    if shell:
+        tractometry_inputs += ["NODDI_MNI", "DKI_MNI"]
+    stages += [
+        make_stage(
+            "FOD", stage_FOD,
+            inputs=["info_mni", "analysis_directory", "shell", "average_fod"],
+            outputs=["peaks"],
+        ),
+        make_stage(
+            "TractSeg", stage_tractseg,
+            inputs=["peaks", "analysis_directory"],
+            outputs=["Tract_dir"],
+        ),
+        make_stage(
+            "tractometry", stage_tractometry,
+            inputs=tractometry_inputs,
+            outputs=["tractometry"],
+        ),
+    ]
+    if t1w:
+        maps_jhu_inputs = ["info_mni_jhu", "jhu_dir", "map_md_nii"]
+        if shell:
+            maps_jhu_inputs += ["NODDI_dir", "DKI_dir"]
+        stages += [
+            make_stage(
+                "t1_bet", stage_t1_bet,
+                inputs=["in_t1w_nifti", "analysis_directory"],
+                outputs=["info_bet"],
+            ),
+            make_stage(
+                "register_to_MNI_using_T1w", stage_register_to_MNI_using_T1w,
+                inputs=["in_t1w_nifti", "info_bet", "info_preproc", "info_DTI",
+                        "analysis_directory"],
+                outputs=["info_mni_jhu", "jhu_dir"],
+            ),
+            make_stage(
+                "maps_to_MNI_T1w", stage_maps_to_MNI_T1w,
+                inputs=maps_jhu_inputs,
+                outputs=["maps_MNI_jhu"],
+            ),
+        ]
+    return stages
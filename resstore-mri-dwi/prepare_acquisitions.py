@@ -1,261 +1,251 @@
-""" 
-Functions to get sequences and prepare 
+"""
+Functions to get sequences and prepare
 sequences for processing:
+    - convert_acquisitions: convert several NIfTI to MIF at the same time
     - prepare_abcd_acquistions
     - prepare_hermes_acquistions
 
 """
-import sys
 import os
-import shutil
-from bids import BIDSLayout
+from concurrent.futures import ThreadPoolExecutor
+from bids_index import get_files, load_bids_index
+from dwi_concat import concatenate_dwi
+from native_tools import execute_native, link_file
 from useful import convert_nifti_to_mif, execute_command, get_shell, verify_file
 
+# Maximum number of conversions run at the same time
+MAX_CONVERSION_WORKERS = 4
+
+
+def _get_first(index, sub, ses, suffix, acquisition, direction=None):
+    """First NIfTI of a sequence, None if not found"""
+    query = {"direction": direction} if direction else {}
+    files = get_files(
+        index, subject=sub, session=ses, extension="nii.gz",
+        suffix=suffix, acquisition=acquisition, return_type="filename", **query
+    )
+    return files[0] if files else None
+
+
+def _run_parallel(tasks, max_workers=MAX_CONVERSION_WORKERS):
+    """
+    Run independent tasks in a small thread pool
+
+    :param tasks: {name: (function, args)}, each function returns
+                  (1|0, msg, out)
 
-def prepare_abcd_acquistions(bids_directory, sub, ses, preproc_directory):
+    :returns:
+        - int: 1 success, 0 failure (of any task)
+        - msg: messages of the failed tasks
+        - outputs: {name: out}
     """
-    Get acquistions to process for abdc protocol 
+    if not tasks:
+        return 1, "", {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+        futures = {
+            name: executor.submit(function, *args)
+            for name, (function, args) in tasks.items()
+        }
+        results = {name: future.result() for name, future in futures.items()}
+    errors = [msg for result, msg, _ in results.values() if result == 0]
+    if errors:
+        return 0, "".join(errors), {}
+    return 1, "", {name: out for name, (_, _, out) in results.items()}
+
+
+def convert_acquisitions(niftis, preproc_directory):
+    """
+    Convert several NIfTI to MIF at the same time
+
+    :param niftis: {name: (path to the NIfTI, diff)}, None paths are skipped
+    :param preproc_directory: out directory (a string)
+
+    :returns:
+        - int: 1 success, 0 failure
+        - msg
+        - mifs: {name: path to the MIF (None if the NIfTI was None)}
+    """
+    tasks = {
+        name: (convert_nifti_to_mif, (nifti, preproc_directory, diff))
+        for name, (nifti, diff) in niftis.items()
+        if nifti is not None
+    }
+    result, msg, mifs = _run_parallel(tasks)
+    if result == 0:
+        return 0, msg, {}
+    return 1, "\nConversions done", {name: mifs.get(name) for name in niftis}
+
+
+def prepare_abcd_acquistions(bids_directory, sub, ses, preproc_directory, index=None):
+    """
+    Get acquistions to process for abdc protocol
     and do some preprocessings
 
     :param bids_directory: file name (a string)
     :param sub: subject name (a string)
     :param ses: session name (a string)
     :param preproc_directory: out directory (a string)
+    :param index: BIDS index (see bids_index.load_bids_index),
+                  loaded from the BIDS directory if not given
 
     :returns:
-        - dwi: main diffusion to use for next steps (.mif)
-        - dwi_json: diffusion json (.json) 
-        - pepolar_ap: pepolar AP sequence to use for next steps (.mif)
-        - pepolar_pa: pepolar PA sequence to use for next steps (.mif)
+        - int: 1 success, 0 failure
+        - msg
+        - acquisitions: (dwi, dwi_json, pepolar_ap, pepolar_pa)
+            - dwi: main diffusion to use for next steps (.mif)
+            - dwi_json: diffusion json (.json)
+            - pepolar_ap: pepolar AP sequence to use for next steps (.mif)
+            - pepolar_pa: pepolar PA sequence to use for next steps (.mif)
     """
 
-    layout = BIDSLayout(bids_directory)
+    if index is None:
+        index = load_bids_index(bids_directory)
     acq = "abcd"
+    acq1 = acq + "1"
+    acq2 = acq + "2"
     # For ABCD, 1 DWI (Siemens, GE)
-    all_sequences_dwi_concatenated = layout.get(
-        subject=sub, session=ses, extension="nii.gz",
-        suffix="dwi", acquisition=acq, return_type="filename"
-    )
-    if all_sequences_dwi_concatenated:
-        dwi_nifti = all_sequences_dwi_concatenated[0]
-        result, msg, dwi = convert_nifti_to_mif(
-            dwi_nifti, preproc_directory, diff=True
-        )
-        if result == 0:
-            print(msg)
-            sys.exit(1)
-        print("\nDWI processing successful")
+    # or 2 DWI (Philips), in some case only one acquired
+    dwi_nifti = _get_first(index, sub, ses, "dwi", acq)
+    niftis = {
+        "dwi": (dwi_nifti, True),
+        "dwi_1": (None if dwi_nifti else _get_first(index, sub, ses, "dwi", acq1), True),
+        "dwi_2": (None if dwi_nifti else _get_first(index, sub, ses, "dwi", acq2), True),
+        # Both pepolar sequences
+        "pepolar_ap": (_get_first(index, sub, ses, "epi", acq, direction="AP"), False),
+        "pepolar_pa": (_get_first(index, sub, ses, "epi", acq, direction="PA"), False),
+    }
+    if not any(niftis[name][0] for name in ["dwi", "dwi_1", "dwi_2"]):
+        msg = f"\nNo ABCD DWI found for sub-{sub} ses-{ses}"
+        return 0, msg, None
+
+    # All conversions at the same time
+    result, msg, mifs = convert_acquisitions(niftis, preproc_directory)
+    if result == 0:
+        return 0, msg, None
+    dwi_1, dwi_2 = mifs["dwi_1"], mifs["dwi_2"]
+
+    if dwi_nifti:
+        dwi = mifs["dwi"]
         dwi_json = dwi_nifti.replace("nii.gz", "json")
-    else:
-        # For ABCD, 2 DWI (Philips)
-        # In some case only one acquired
-        acq1 = acq + "1"
-        all_sequences_dwi1 = layout.get(
-            subject=sub, session=ses, extension="nii.gz",
-            suffix="dwi", acquisition=acq1, return_type="filename"
-        )
-        if all_sequences_dwi1:
-            dwi_1_nifti = all_sequences_dwi1[0]
-            result, msg, dwi_1 = convert_nifti_to_mif(
-                dwi_1_nifti, preproc_directory, diff=True
-            )
-            if result == 0:
-                print(msg)
-                sys.exit(1)
-        acq2 = acq + "2"
-        all_sequences_dwi2 = layout.get(
-            subject=sub, session=ses, extension="nii.gz",
-            suffix="dwi", acquisition=acq2, return_type="filename"
-        )
-        if all_sequences_dwi2:
-            dwi_2_nifti = all_sequences_dwi2[0]
-            result, msg, dwi_2 = convert_nifti_to_mif(
-                dwi_2_nifti, preproc_directory, diff=True
-            )
+        print("\nDWI processing successful")
+    elif dwi_1 and dwi_2:
+        dwi = dwi_1.replace(f"acq-{acq1}", "acq-abcd")
+        # Use DTI1 to get info
+        dwi_json = niftis["dwi_1"][0].replace("nii.gz", "json")
+        # Merge DTI1 and DTI2 (b=0 intensities matched, as dwicat)
+        if not (
+            verify_file(dwi)
+            and os.path.getmtime(dwi) >= max(map(os.path.getmtime, [dwi_1, dwi_2]))
+        ):
+            result, msg = concatenate_dwi([dwi_1, dwi_2], dwi)
             if result == 0:
-                print(msg)
-                sys.exit(1)
-        if all_sequences_dwi1 and all_sequences_dwi2:
-            dwi = dwi_1.replace(f"acq-{acq1}", "acq-abcd")
-            # Use DTI1 to get info
-            dwi_json = dwi_1_nifti.replace("nii.gz", "json")
-            # Merge DTI1 and DTI2
-            if not verify_file(dwi):
-                cmd = ["dwicat", dwi_1, dwi_2, dwi]
-                result, stderrl, sdtoutl = execute_command(cmd)
-                if result != 0:
-                    msg = f"\nCan not lunch dwicat (exit code {result})"
-                else:
-                    print("\nExtraction successfull")
-        elif all_sequences_dwi1 and not all_sequences_dwi2:
-            # Only dti1 acquired
-            dwi = dwi_1.replace(f"acq-{acq1}", "acq-abcd")
-            shutil.copyfile(dwi_1, dwi)
-            dwi_json = dwi_1_nifti.replace("nii.gz", "json")
-        elif all_sequences_dwi2 and not all_sequences_dwi1:
-            # Only dti2 acquired
-            dwi = dwi_2.replace(f"acq-{acq2}", "acq-abcd")
-            dwi_json = dwi_2_nifti.replace("nii.gz", "json")
-            shutil.copyfile(dwi_2, dwi)
-
-    # Get both pepolar sequences
-    all_sequences_pepolar_ap = layout.get(
-        subject=sub, session=ses, extension="nii.gz",
-        suffix="epi", acquisition=acq, direction="AP",
-        return_type="filename"
-    )
-    if len(all_sequences_pepolar_ap) != 0:
-        pepolar_ap_nifti = all_sequences_pepolar_ap[0]
-        result, msg, pepolar_ap = convert_nifti_to_mif(
-            pepolar_ap_nifti, preproc_directory, diff=False
-        )
-        if result == 0:
-            print(msg)
-            sys.exit(1)
+                return 0, msg, None
+    elif dwi_1:
+        # Only dti1 acquired, no copy
+        dwi = dwi_1.replace(f"acq-{acq1}", "acq-abcd")
+        result, msg = link_file(dwi_1, dwi)
+        if result != 0:
+            return 0, msg, None
+        dwi_json = niftis["dwi_1"][0].replace("nii.gz", "json")
     else:
-        pepolar_ap_nifti = None
-        pepolar_ap = None
+        # Only dti2 acquired, no copy
+        dwi = dwi_2.replace(f"acq-{acq2}", "acq-abcd")
+        dwi_json = niftis["dwi_2"][0].replace("nii.gz", "json")
+        result, msg = link_file(dwi_2, dwi)
+        if result != 0:
+            return 0, msg, None
 
-    all_sequences_pepolar_pa = layout.get(
-        subject=sub, session=ses, extension="nii.gz",
-        suffix="epi", acquisition=acq, direction="PA",
-        return_type="filename"
-    )
+    msg = "\nABCD acquisitions prepared"
+    return 1, msg, (dwi, dwi_json, mifs["pepolar_ap"], mifs["pepolar_pa"])
 
-    if len(all_sequences_pepolar_pa) != 0:
-        pepolar_pa_nifti = all_sequences_pepolar_pa[0]
-        result, msg, pepolar_pa = convert_nifti_to_mif(
-            pepolar_pa_nifti, preproc_directory, diff=False
-        )
-        if result == 0:
-            print(msg)
-            sys.exit(1)
-    else:
-        pepolar_pa_nifti = None
-        pepolar_pa = None
 
-    return dwi, dwi_json, pepolar_ap, pepolar_pa
+def _get_pepolar_bzero(pepolar):
+    """
+    b0 of a HERMES pepolar sequence (may contain b1000 and b0)
+
+    :param pepolar: pepolar sequence (.mif)
+
+    :returns:
+        - int: 1 success, 0 failure
+        - msg
+        - pepolar_bzero: pepolar with only b0 (.mif)
+    """
+    _, msg, shell = get_shell(pepolar)
+    shell = [bval for bval in shell if bval != "" and float(bval) >= 5]
+    pepolar_bzero = pepolar.replace(".mif", "_bzero.mif")
+
+    # If pepolar contain b0 and b1000, extract b0
+    if len(shell) > 0:
+        print("\n Hermes fmaps contain b1000 and b0. b0 must be extracted")
+        if not os.path.exists(pepolar_bzero):
+            cmd = ["dwiextract", pepolar, pepolar_bzero, "-bzero"]
+            result, stderrl, sdtoutl = execute_command(cmd)
+            if result != 0:
+                msg = f"\nCan not launch dwiextract (exit code {result})"
+                return 0, msg, None
+            print("\nExtraction successfull")
+        else:
+            print(f"\nFile already exists: {pepolar_bzero}")
+    # If pepolar contain only b0, rename the file
+    else:
+        cmd = ["mv", pepolar, pepolar_bzero]
+        result, stderrl, sdtoutl = execute_native(cmd)
+        if result != 0:
+            msg = f"\nCan not rename {pepolar} (exit code {result})"
+            return 0, msg, None
+    return 1, "", pepolar_bzero
 
 
-def prepare_hermes_acquistions(bids_directory, sub, ses, preproc_directory):
+def prepare_hermes_acquistions(bids_directory, sub, ses, preproc_directory, index=None):
     """
-    Get acquistions to process for hermes protocol 
+    Get acquistions to process for hermes protocol
     and do some preprocessings
 
     :param bids_directory: file name (a string)
     :param sub: subject name (a string)
     :param ses: session name (a string)
     :param preproc_directory: out directory (a string)
+    :param index: BIDS index (see bids_index.load_bids_index),
+                  loaded from the BIDS directory if not given
 
     :returns:
-        - dwi: main diffusion to use for next steps (.mif)
-        - dwi_json: diffusion json (.json) 
-        - pepolar_ap: pepolar AP sequence to use for next steps (.mif)
-        - pepolar_pa: pepolar PA sequence to use for next steps (.mif)
+        - int: 1 success, 0 failure
+        - msg
+        - acquisitions: (dwi, dwi_json, pepolar_ap, pepolar_pa)
+            - dwi: main diffusion to use for next steps (.mif)
+            - dwi_json: diffusion json (.json)
+            - pepolar_ap: pepolar AP sequence to use for next steps (.mif)
+            - pepolar_pa: pepolar PA sequence to use for next steps (.mif)
     """
 
-    layout = BIDSLayout(bids_directory)
+    if index is None:
+        index = load_bids_index(bids_directory)
     acq = "hermes"
-    # Get DWI
-    all_sequences_dwi = layout.get(
-        subject=sub, session=ses, extension="nii.gz",
-        suffix="dwi", acquisition=acq, return_type="filename"
-    )
-    dwi_nifti = all_sequences_dwi[0]
+    # Get DWI and both pepolar sequences
+    dwi_nifti = _get_first(index, sub, ses, "dwi", acq)
+    if dwi_nifti is None:
+        msg = f"\nNo HERMES DWI found for sub-{sub} ses-{ses}"
+        return 0, msg, None
     dwi_json = dwi_nifti.replace("nii.gz", "json")
-    result, msg, dwi = convert_nifti_to_mif(
-        dwi_nifti, preproc_directory, diff=True
-    )
+    niftis = {
+        "dwi": (dwi_nifti, True),
+        "pepolar_ap": (_get_first(index, sub, ses, "epi", acq, direction="AP"), True),
+        "pepolar_pa": (_get_first(index, sub, ses, "epi", acq, direction="PA"), True),
+    }
+    result, msg, mifs = convert_acquisitions(niftis, preproc_directory)
     if result == 0:
-        print(msg)
-        sys.exit(1)
-    # Get both pepolar sequences
-    all_sequences_pepolar_ap = layout.get(
-        subject=sub, session=ses, extension="nii.gz",
-        suffix="epi", acquisition=acq, direction="AP",
-        return_type="filename"
-    )
-    pepolar_ap_nifti = None
-    pepolar_ap = None
-    if len(all_sequences_pepolar_ap) > 0:
-        pepolar_ap_nifti = all_sequences_pepolar_ap[0]
-        result, msg, pepolar_ap = convert_nifti_to_mif(
-            pepolar_ap_nifti, preproc_directory, diff=True
-        )
-    if result == 0:
-        print(msg)
-        sys.exit(1)
-
-    all_sequences_pepolar_pa = layout.get(
-        subject=sub, session=ses, extension="nii.gz",
-        suffix="epi", acquisition=acq, direction="PA",
-        return_type="filename"
-    )
-    pepolar_pa_nifti = None
-    pepolar_pa = None
-    if len(all_sequences_pepolar_pa) > 0:
-        pepolar_pa_nifti = all_sequences_pepolar_pa[0]
-        result, msg, pepolar_pa = convert_nifti_to_mif(
-            pepolar_pa_nifti, preproc_directory, diff=True
-        )
-    if result == 0:
-        print(msg)
-        sys.exit(1)
+        return 0, msg, None
 
     # For HERMES, pepolar sequences may contain b1000 and b0
-    # Check if pepolar contain only b0 or not
-    if pepolar_ap is not None:
-        _, msg, shell_ap = get_shell(pepolar_ap)
-        shell_ap = [bval for bval in shell_ap if float(bval) >= 5 and bval != ""]
-        pepolar_ap_bzero = pepolar_ap.replace(".mif", "_bzero.mif")
-
-        # If pepolar contain b0 and b1000, extract b0
-        if len(shell_ap) > 0:
-            print("\n Hermes fmaps contain b1000 and b0. b0 must be extracted")
-            # Extraction b0 AP
-            if not os.path.exists(pepolar_ap_bzero):
-                cmd = ["dwiextract", pepolar_ap, pepolar_ap_bzero, "-bzero"]
-                result, stderrl, sdtoutl = execute_command(cmd)
-                if result != 0:
-                    msg = f"\nCan not launch dwicat (exit code {result})"
-                else:
-                    print("\nExtraction successfull")
-            else:
-                print(f"\nFile already exists: {pepolar_ap_bzero}")
-        # If pepolar contain only b0, rename the file
-        else:
-            cmd = ["mv", pepolar_ap, pepolar_ap_bzero]
-            result, stderrl, sdtoutl = execute_command(cmd)
-            if result != 0:
-                msg = f"\nCan not rename pepolar_ap images (exit code {result})"
-    else:
-        pepolar_ap_bzero = None
-
-    if pepolar_pa is not None:
-        _, msg, shell_pa = get_shell(pepolar_pa)
-        shell_pa = [bval for bval in shell_pa if float(bval) >= 5 and bval != ""]
-        pepolar_pa_bzero = pepolar_pa.replace(".mif", "_bzero.mif")
-
-        if len(shell_pa) > 0:
-            # Extraction b0 PA
-            if not os.path.exists(pepolar_pa_bzero):
-                cmd = ["dwiextract", pepolar_pa, pepolar_pa.replace(
-                    ".mif", "_bzero.mif"), "-bzero"]
-                result, stderrl, sdtoutl = execute_command(cmd)
-                if result != 0:
-                    msg = f"\nCan not lunch dwicat (exit code {result})"
-                else:
-                    print("\nExtraction successfull")
-            else:
-                print(
-                    f"\nSkipping extraction step, file alreeady exists: {pepolar_pa_bzero}")
-        # If pepolar contain only b0, rename the file
-        else:
-            cmd = ["mv", pepolar_pa, pepolar_pa_bzero]
-            result, stderrl, sdtoutl = execute_command(cmd)
-            if result != 0:
-                msg = f"\nCan not rename pepolar_pa images (exit code {result})"
-    else:
-        pepolar_pa_bzero = None
+    # Check if pepolar contain only b0 or not (both pepolar at the same time)
+    tasks = {
+        name: (_get_pepolar_bzero, (mifs[name],))
+        for name in ["pepolar_ap", "pepolar_pa"]
+        if mifs[name] is not None
+    }
+    result, msg, bzeros = _run_parallel(tasks)
+    if result == 0:
+        return 0, msg, None
 
-    return dwi, dwi_json, pepolar_ap_bzero, pepolar_pa_bzero
+    msg = "\nHERMES acquisitions prepared"
+    return 1, msg, (mifs["dwi"], dwi_json, bzeros.get("pepolar_ap"), bzeros.get("pepolar_pa"))
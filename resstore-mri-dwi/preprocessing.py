@@ -6,12 +6,28 @@ Functions for preprocessing DWI data:
 """
 
 import os
-from useful import check_file_ext, convert_mif_to_nifti, execute_command, verify_file, convert_nifti_to_mif
+import tempfile
+from useful import check_file_ext, convert_mif_to_nifti, execute_command, verify_file
+from stage_cache import is_stage_up_to_date, run_cached_command
+from native_tools import get_ndim, remove_path
+from mppca import denoise_mppca
+from brain_mask import compute_brain_mask
+from crop import crop_preprocessing
 from termcolor import colored
 
 EXT = {"NIFTI_GZ": "nii.gz", "NIFTI": "nii"}
 
 
+def _get_ndim(in_file):
+    """Number of dimensions of an image (header, or mrinfo -ndim)"""
+    dim = get_ndim(in_file)
+    if dim is None:
+        cmd = ["mrinfo", "-ndim", in_file]
+        result, stderrl, sdtoutl = execute_command(cmd)
+        dim = int(sdtoutl.decode("utf-8").replace("\n", ""))
+    return dim
+
+
 def get_dwifslpreproc_command(
     in_dwi, dwi_out, pe_dir, readout_time, qc_directory, b0_pair=None, rpe=None, shell=False
 ):
@@ -61,8 +77,15 @@ def get_dwifslpreproc_command(
     return command
 
 
+DENOISE_BACKENDS = ["dwidenoise", "mppca"]
+# Intermediate images that can be piped to the next command instead of
+# being written in the output directory
+DISCARDABLE_INTERMEDIATES = ["denoise"]
+
+
 def run_preproc_dwi(
-    in_dwi, pe_dir, readout_time, shell=True, in_pepolar_PA=None, in_pepolar_AP=None
+    in_dwi, pe_dir, readout_time, shell=True, in_pepolar_PA=None, in_pepolar_AP=None,
+    discard_intermediate=(), denoise_backend="dwidenoise", crop_margin=None
 ):
     """
     Run preproc for whole brain diffusion using MRtrix command and an optional FOD estimation 
@@ -74,6 +97,15 @@ def run_preproc_dwi(
     - shell: (default:True) info was given on the b-values
     - in_pepolar_PA: (optionnal), fmap PA in .mif format
     - in_pepolar_AP: (optionnal), fmap AP in .mif format
+    - discard_intermediate: (optionnal) intermediate images not kept
+                            (see DISCARDABLE_INTERMEDIATES), "denoise":
+                            dwidenoise is piped into mrdegibbs
+    - denoise_backend: (default: "dwidenoise") "mppca": denoising in
+                       Python (see mppca.denoise_mppca), with noise map
+    - crop_margin: (optionnal) crop the outputs to the bounding box of the
+                   brain mask plus this margin (voxels), "crop" of the
+                   info gives the crop (see crop.crop_preprocessing),
+                   None: no crop
 
     Returns: 
     - int 1 success, 0 failure 
@@ -86,24 +118,66 @@ def run_preproc_dwi(
     dir_name = os.path.dirname(in_dwi)
     valid_bool, in_ext, file_name = check_file_ext(in_dwi, {"MIF": "mif"})
 
-    # Denoise
     dwi_denoise = os.path.join(dir_name, file_name + "_denoise.mif")
-    # Check if the file already exists or not
-    if not verify_file(dwi_denoise):
+    dwi_degibbs = dwi_denoise.replace("_denoise.mif", "_denoise_degibbs.mif")
+    if denoise_backend == "mppca":
+        # Denoise in Python (noise map kept), then DeGibbs / Unringing
+        dwi_noise = os.path.join(dir_name, file_name + "_noise.mif")
+        info_prepoc["noise_map"] = dwi_noise
+        discard = "denoise" in discard_intermediate
+        if discard:
+            dwi_denoise = os.path.join(
+                os.environ.get("MRTRIX_TMPFILE_DIR", tempfile.gettempdir()),
+                file_name + "_denoise.mif"
+            )
+        cmd = ["mrdegibbs", dwi_denoise, dwi_degibbs]
+        inputs = [in_dwi] if discard else [dwi_denoise]
+        if not (discard and is_stage_up_to_date("mrdegibbs", cmd, inputs, [dwi_degibbs])[0]):
+            result, msg = denoise_mppca(in_dwi, dwi_denoise, dwi_noise)
+            if result == 0:
+                return 0, msg, info_prepoc
+        result, stderrl, sdtoutl = run_cached_command(
+            "mrdegibbs", cmd, inputs=inputs, outputs=[dwi_degibbs]
+        )
+        if discard:
+            remove_path(dwi_denoise)
+        if result != 0:
+            msg = f"\nCannot launch mrdegibbs (exit code {result})"
+            return 0, msg, info_prepoc
+        else:
+            print(f"\nUnringing completed. Output file: {dwi_degibbs}")
+    elif "denoise" in discard_intermediate:
+        # Denoise and DeGibbs / Unringing in one pipeline: the denoised
+        # image is only written in MRTRIX_TMPFILE_DIR (default /tmp)
+        cmd = [["dwidenoise", in_dwi, "-"], ["mrdegibbs", "-", dwi_degibbs]]
+        result, stderrl, sdtoutl = run_cached_command(
+            "dwidenoise_mrdegibbs", cmd, inputs=[in_dwi], outputs=[dwi_degibbs],
+            stream=True
+        )
+        if result != 0:
+            msg = f"\nCannot launch dwidenoise | mrdegibbs (exit code {result})"
+            return 0, msg, info_prepoc
+        else:
+            print(f"\nDenoise and unringing completed. Output file: {dwi_degibbs}")
+    else:
+        # Denoise
+        # Run only if the output is missing or stale
         cmd = ["dwidenoise", in_dwi, dwi_denoise]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = run_cached_command(
+            "dwidenoise", cmd, inputs=[in_dwi], outputs=[dwi_denoise], stream=True
+        )
         if result != 0:
             msg = f"\nCannot launch dwidenoise (exit code {result})"
             return 0, msg, info_prepoc
         else:
             print(f"\nDenoise completed. Output file: {dwi_denoise}")
 
-    # DeGibbs / Unringing
-    dwi_degibbs = dwi_denoise.replace("_denoise.mif", "_denoise_degibbs.mif")
-    # Check if the file already exists or not
-    if not verify_file(dwi_degibbs):
+        # DeGibbs / Unringing
+        # Run only if the output is missing or stale
         cmd = ["mrdegibbs", dwi_denoise, dwi_degibbs]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = run_cached_command(
+            "mrdegibbs", cmd, inputs=[dwi_denoise], outputs=[dwi_degibbs]
+        )
         if result != 0:
             msg = f"\nCannot launch mrdegibbs (exit code {result})"
             return 0, msg, info_prepoc
@@ -112,151 +186,148 @@ def run_preproc_dwi(
 
     # Motion and distortion correction
     dwi_preproc = dwi_degibbs.replace("_degibbs.mif", "_degibbs_preproc.mif")
-    # Check if the file already exists or not
-    if not verify_file(dwi_preproc):
-        # Create b0_pair if possible
-        # and choose rpe option for dwifslpreproc cmd
-        b0_pair = os.path.join(dir_name, "b0_pair.mif")
-        # If pe_dir=PA (j) and fmap AP exist
-        if pe_dir == "j" and in_pepolar_AP:
-            rpe = "pair"
-            if not verify_file(b0_pair):
-                # No fmap files in the encoding direction (PA) is given
-                if in_pepolar_PA is None:
-                    # Extract b0 (PA) from main dwi
-                    in_pepolar_PA = in_dwi.replace(".mif", "_bzero.mif")
-                    # Check if the file already exists or not
-                    if not verify_file(in_pepolar_PA):
-                        cmd = ["dwiextract", in_dwi, in_pepolar_PA, "-bzero"]
-                        result, stderrl, sdtoutl = execute_command(cmd)
-                        if result != 0:
-                            msg = f"\nCannot launch dwiextract (exit code {result})"
-                            return 0, msg, info_prepoc
-                        else:
-                            print("\nb0_PA successfully extracted")
-                # Check dimension and average b0 if needed
-                # All fmaps are averaged to ensure that dwifslpreproc will run correctly 
-                # It can only run with even number of volumes in the fmaps
-                cmd = ["mrinfo", "-ndim", in_pepolar_PA]
-                result, stderrl, sdtoutl = execute_command(cmd)
-                dim = int(sdtoutl.decode("utf-8").replace("\n", ""))
-                in_pep_PA_mean = in_pepolar_PA.replace(".mif", "_mean.mif")
-                if dim == 4:
-                    cmd = ["mrmath", in_pepolar_PA, "mean", in_pep_PA_mean, "-axis", "3", "-force"]
+    # Create b0_pair if possible
+    # and choose rpe option for dwifslpreproc cmd
+    b0_pair = os.path.join(dir_name, "b0_pair.mif")
+    # If pe_dir=PA (j) and fmap AP exist
+    if pe_dir == "j" and in_pepolar_AP:
+        rpe = "pair"
+        if not verify_file(b0_pair):
+            # No fmap files in the encoding direction (PA) is given
+            if in_pepolar_PA is None:
+                # Extract b0 (PA) from main dwi
+                in_pepolar_PA = in_dwi.replace(".mif", "_bzero.mif")
+                # Check if the file already exists or not
+                if not verify_file(in_pepolar_PA):
+                    cmd = ["dwiextract", in_dwi, in_pepolar_PA, "-bzero"]
                     result, stderrl, sdtoutl = execute_command(cmd)
-                else:
-                    in_pep_PA_mean = in_pepolar_PA
-
-                cmd = ["mrinfo", "-ndim", in_pepolar_AP]
+                    if result != 0:
+                        msg = f"\nCannot launch dwiextract (exit code {result})"
+                        return 0, msg, info_prepoc
+                    else:
+                        print("\nb0_PA successfully extracted")
+            # Check dimension and average b0 if needed
+            # All fmaps are averaged to ensure that dwifslpreproc will run correctly 
+            # It can only run with even number of volumes in the fmaps
+            dim = _get_ndim(in_pepolar_PA)
+            in_pep_PA_mean = in_pepolar_PA.replace(".mif", "_mean.mif")
+            if dim == 4:
+                cmd = ["mrmath", in_pepolar_PA, "mean", in_pep_PA_mean, "-axis", "3", "-force"]
                 result, stderrl, sdtoutl = execute_command(cmd)
-                dim = int(sdtoutl.decode("utf-8").replace("\n", ""))
-                in_pep_AP_mean = in_pepolar_AP.replace(".mif", "_mean.mif")
-                if dim == 4:
-                    cmd = ["mrmath", in_pepolar_AP, "mean", in_pep_AP_mean, "-axis", "3", "-force"]
-                    result, stderrl, sdtoutl = execute_command(cmd)
-                else:
-                    in_pep_AP_mean = in_pepolar_AP
+            else:
+                in_pep_PA_mean = in_pepolar_PA
 
-                # Concatenate both b0 images to create b0_pair
-                cmd = ["mrcat", in_pep_PA_mean, in_pep_AP_mean, b0_pair]
-                result, stderrl, sdtoutl = execute_command(cmd)
-                if result != 0:
-                    msg = f"\nCannot launch mrcat to create b0_pair (exit code {result})"
-                    return 0, msg, info_prepoc
-                else:
-                    print(
-                        f"\nB0_pair successfully created. Output file: {b0_pair}")
-        # If pe_dir=AP (j-) and fmap PA exist
-        elif pe_dir == "j-" and in_pepolar_PA:
-            rpe = "pair"
-            if not verify_file(b0_pair):
-                # Check for fmap files encoding direction (AP)
-                if in_pepolar_AP is None:
-                    # Extract b0 (AP) from dwi
-                    in_pepolar_AP = in_dwi.replace(".mif", "_bzero.mif")
-                    # Check if the file already exists or not
-                    if not verify_file(in_pepolar_AP):
-                        cmd = ["dwiextract", in_dwi, in_pepolar_AP, "-bzero"]
-                        result, stderrl, sdtoutl = execute_command(cmd)
-                        if result != 0:
-                            msg = f"\nCannot launch dwiextract (exit code {result})"
-                            return 0, msg, info_prepoc
-                        else:
-                            print("\nb0_AP successfully extracted")
-                # Check dimension and average b0 if needed
-                cmd = ["mrinfo", "-ndim", in_pepolar_AP]
+            dim = _get_ndim(in_pepolar_AP)
+            in_pep_AP_mean = in_pepolar_AP.replace(".mif", "_mean.mif")
+            if dim == 4:
+                cmd = ["mrmath", in_pepolar_AP, "mean", in_pep_AP_mean, "-axis", "3", "-force"]
                 result, stderrl, sdtoutl = execute_command(cmd)
-                dim = int(sdtoutl.decode("utf-8").replace("\n", ""))
-                in_pep_AP_mean = in_pepolar_AP.replace(".mif", "_mean.mif")
-                if dim == 4:
-                    cmd = ["mrmath", in_pepolar_AP, "mean", in_pep_AP_mean, "-axis", "3", "-force"]
-                    result, stderrl, sdtoutl = execute_command(cmd)
-                else:
-                    in_pep_AP_mean = in_pepolar_AP
+            else:
+                in_pep_AP_mean = in_pepolar_AP
 
-                cmd = ["mrinfo", "-ndim", in_pepolar_PA]
-                result, stderrl, sdtoutl = execute_command(cmd)
-                dim = int(sdtoutl.decode("utf-8").replace("\n", ""))
-                in_pep_PA_mean = in_pepolar_PA.replace(".mif", "_mean.mif")
-                if dim == 4:
-                    cmd = ["mrmath", in_pepolar_PA, "mean", in_pep_PA_mean, "-axis", "3", "-force"]
+            # Concatenate both b0 images to create b0_pair
+            cmd = ["mrcat", in_pep_PA_mean, in_pep_AP_mean, b0_pair]
+            result, stderrl, sdtoutl = execute_command(cmd)
+            if result != 0:
+                msg = f"\nCannot launch mrcat to create b0_pair (exit code {result})"
+                return 0, msg, info_prepoc
+            else:
+                print(
+                    f"\nB0_pair successfully created. Output file: {b0_pair}")
+    # If pe_dir=AP (j-) and fmap PA exist
+    elif pe_dir == "j-" and in_pepolar_PA:
+        rpe = "pair"
+        if not verify_file(b0_pair):
+            # Check for fmap files encoding direction (AP)
+            if in_pepolar_AP is None:
+                # Extract b0 (AP) from dwi
+                in_pepolar_AP = in_dwi.replace(".mif", "_bzero.mif")
+                # Check if the file already exists or not
+                if not verify_file(in_pepolar_AP):
+                    cmd = ["dwiextract", in_dwi, in_pepolar_AP, "-bzero"]
                     result, stderrl, sdtoutl = execute_command(cmd)
-                else:
-                    in_pep_PA_mean = in_pepolar_PA
+                    if result != 0:
+                        msg = f"\nCannot launch dwiextract (exit code {result})"
+                        return 0, msg, info_prepoc
+                    else:
+                        print("\nb0_AP successfully extracted")
+            # Check dimension and average b0 if needed
+            dim = _get_ndim(in_pepolar_AP)
+            in_pep_AP_mean = in_pepolar_AP.replace(".mif", "_mean.mif")
+            if dim == 4:
+                cmd = ["mrmath", in_pepolar_AP, "mean", in_pep_AP_mean, "-axis", "3", "-force"]
+                result, stderrl, sdtoutl = execute_command(cmd)
+            else:
+                in_pep_AP_mean = in_pepolar_AP
 
-                # Concatenate both b0 images to create b0_pair
-                cmd = ["mrcat", in_pep_AP_mean, in_pep_PA_mean, b0_pair]
+            dim = _get_ndim(in_pepolar_PA)
+            in_pep_PA_mean = in_pepolar_PA.replace(".mif", "_mean.mif")
+            if dim == 4:
+                cmd = ["mrmath", in_pepolar_PA, "mean", in_pep_PA_mean, "-axis", "3", "-force"]
                 result, stderrl, sdtoutl = execute_command(cmd)
-                if result != 0:
-                    msg = f"\nCannot launch mrcat to create b0_pair (exit code {result})"
-                    return 0, msg, info_prepoc
-                else:
-                    print(
-                        f"\nB0_pair successfully created. Output file: {b0_pair}")
-        # If no inverse fmap available (pe_dir AP or PA)
-        else:
-            rpe = None
-            b0_pair = None
-            print(
-                "\nfmap not available. Due to use of a single fixed phase encoding, "
-                "no EPI distortion correction can be applied in this case."
-            )
+            else:
+                in_pep_PA_mean = in_pepolar_PA
 
-        # fslpreproc (topup and Eddy)
-        qc_directory = os.path.join(dir_name, "qc_text")
-        if not os.path.exists(qc_directory):
-            os.makedirs(qc_directory)
-        cmd = get_dwifslpreproc_command(
-            dwi_degibbs, dwi_preproc, pe_dir, readout_time, qc_directory, b0_pair, rpe, shell,
+            # Concatenate both b0 images to create b0_pair
+            cmd = ["mrcat", in_pep_AP_mean, in_pep_PA_mean, b0_pair]
+            result, stderrl, sdtoutl = execute_command(cmd)
+            if result != 0:
+                msg = f"\nCannot launch mrcat to create b0_pair (exit code {result})"
+                return 0, msg, info_prepoc
+            else:
+                print(
+                    f"\nB0_pair successfully created. Output file: {b0_pair}")
+    # If no inverse fmap available (pe_dir AP or PA)
+    else:
+        rpe = None
+        b0_pair = None
+        print(
+            "\nfmap not available. Due to use of a single fixed phase encoding, "
+            "no EPI distortion correction can be applied in this case."
         )
-        result, stderrl, sdtoutl = execute_command(cmd)
-        if result != 0:
-            msg = f"\nCannot launch dwifslpreproc (exit code {result})"
-            return 0, msg, info_prepoc
-        else:
-            print(
-                f"\nMotion and distortion correction completed. Output file: {dwi_preproc}")
+
+    # fslpreproc (topup and Eddy)
+    qc_directory = os.path.join(dir_name, "qc_text")
+    if not os.path.exists(qc_directory):
+        os.makedirs(qc_directory)
+    cmd = get_dwifslpreproc_command(
+        dwi_degibbs, dwi_preproc, pe_dir, readout_time, qc_directory, b0_pair, rpe, shell,
+    )
+    # Run only if the output is missing or stale (inputs, options or version changed)
+    inputs = [dwi_degibbs] + ([b0_pair] if b0_pair else [])
+    result, stderrl, sdtoutl = run_cached_command(
+        "dwifslpreproc", cmd, inputs=inputs, outputs=[dwi_preproc], stream=True
+    )
+    if result != 0:
+        msg = f"\nCannot launch dwifslpreproc (exit code {result})"
+        return 0, msg, info_prepoc
+    else:
+        print(
+            f"\nMotion and distortion correction completed. Output file: {dwi_preproc}")
 
     # Bias correction
     dwi_unbias = dwi_preproc.replace(
         "_degibbs_preproc.mif", "_degibbs_preproc_unbiased.mif")
     bias_output = dwi_preproc.replace(
         "_degibbs_preproc.mif", "_degibbs_preproc_bias.mif")
-    # Check if the file already exists or not
-    if not verify_file(dwi_unbias) and not verify_file(bias_output):
-        cmd = ["dwibiascorrect", "ants", dwi_preproc,
-               dwi_unbias, "-bias", bias_output]
-        result, stderrl, sdtoutl = execute_command(cmd)
-        if result != 0:
-            msg = f"\nCannot launch bias correction (exit code {result})"
-            return 0, msg
-        else:
-            print(
-                f"\nBias correction completed. Output files: {dwi_unbias}, {bias_output}")
+    # Run only if the outputs are missing or stale
+    cmd = ["dwibiascorrect", "ants", dwi_preproc,
+           dwi_unbias, "-bias", bias_output]
+    result, stderrl, sdtoutl = run_cached_command(
+        "dwibiascorrect", cmd, inputs=[dwi_preproc], outputs=[dwi_unbias, bias_output],
+        stream=True
+    )
+    if result != 0:
+        msg = f"\nCannot launch bias correction (exit code {result})"
+        return 0, msg, info_prepoc
+    else:
+        print(
+            f"\nBias correction completed. Output files: {dwi_unbias}, {bias_output}")
     
-    dwi_unbias_nii = dwi_unbias.replace(".mif", ".nii.gz")
-    if not verify_file(dwi_unbias_nii):
-        convert_mif_to_nifti(dwi_unbias, dir_name, diff=True)
+    # NIfTI (and bvec / bval) converted again only if dwi_unbias changed
+    result, msg, dwi_unbias_nii = convert_mif_to_nifti(dwi_unbias, dir_name, diff=True)
+    if result == 0:
+        return 0, msg, info_prepoc
     
     # # Upsampling
     # dwi_upsamp = dwi_unbias.replace("_unbiased.mif", "_unbiased_up.mif")
@@ -276,52 +347,26 @@ def run_preproc_dwi(
     #     convert_mif_to_nifti(dwi_upsamp, dir_name, diff=True)
 
     # Brain mask, for FA
-    dwi_mask = os.path.join(dir_name, "dwi_up_mask_bet_mask.mif")
-    dwi_mask_nii = dwi_mask.replace(".mif", ".nii.gz")
-    bzeros =  dwi_unbias_nii.replace(".nii.gz","_bzero.nii.gz")
-    bzeros_mean =  dwi_unbias_nii.replace(".nii.gz","_bzero_mean.nii.gz")
-    # Check if the file already exists or not
-    if not verify_file(dwi_mask):
-        # cmd = ["dwi2mask", dwi_unbias, dwi_mask]
-        # result, stderrl, sdtoutl = execute_command(cmd)
-        # if result != 0:
-        #     msg = f"\nCannot launch mask (exit code {result})"
-        #     return 0, msg
-        # else:
-        #     print(f"\nBrain mask completed. Output file: {dwi_mask}")
-        
-        # Compute mask using bet
-        if not verify_file(bzeros_mean):
-            cmd = [
-                "dwiextract", dwi_unbias, bzeros, "-bzero"
-
-            ]
-            result, stderrl, stdoutl = execute_command(cmd)
-            if result != 0:
-                msg = f"\nCannot launch dwiextract (exit code {result})"
-                return 0, msg
-
-            cmd = [
-                "mrmath", bzeros, "mean",  bzeros_mean,  "-axis",  "3"
-            ]
-            result, stderrl, stdoutl = execute_command(cmd)
-            if result != 0:
-                msg = f"\nCannot launch mrmaths (exit code {result})"
-                return 0, msg
-
-        cmd = [
-            "bet", bzeros_mean, dwi_mask_nii.replace("_mask.nii.gz",""),  "-m", "-n"
-        ]
-        result, stderrl, stdoutl = execute_command(cmd)
-        if result != 0:
-            msg = f"\nCannot launch bet (exit code {result})"
-            return 0, msg
-        if not verify_file(dwi_mask):
-            convert_nifti_to_mif(dwi_mask_nii, dir_name, diff=False)    
+    # Mean b0 and mask computed in Python, written in .nii.gz and .mif
+    # (bet is not used any more: the mask keeps the name given by bet, so
+    # the masks of the subjects already processed are found again)
+    dwi_mask_nii = os.path.join(dir_name, "dwi_up_mask_bet_mask.nii.gz")
+    bzeros_mean = dwi_unbias_nii.replace(".nii.gz", "_bzero_mean.nii.gz")
+    result, msg, info_mask = compute_brain_mask(dwi_unbias, bzeros_mean, dwi_mask_nii)
+    if result == 0:
+        return 0, msg, info_prepoc
+    dwi_mask = info_mask["brain_mask"]
 
     info_preproc = {"dwi_preproc": dwi_unbias, "dwi_preproc_nii": dwi_unbias_nii,
                     "brain_mask": dwi_mask, "brain_mask_nii": dwi_mask_nii,
                     "mean_b0": bzeros_mean }
+
+    # Crop to the brain for the next steps (grid shift saved in crop.json)
+    if crop_margin is not None:
+        result, msg, info_crop = crop_preprocessing(info_preproc, margin=crop_margin)
+        if result == 0:
+            return 0, msg, info_prepoc
+        info_preproc.update(info_crop)
     msg = "\nPreprocessing DWI done"
     print(colored(msg, "cyan"))
     return 1, msg, info_preproc
@@ -1,50 +1,105 @@
+"""
+Remove volumes of a diffusion image:
+    - read_volumes_to_remove: volume indices from a text file or a list
+    - remove_volumes
+"""
+
 import os
-from useful import delete_directory
+
+import numpy as np
+from termcolor import colored
+
+from mif_io import load_mif, save_mif
+from native_tools import read_mif_header
+from useful import verify_file
 
 
-def remove_volumes(input_file, output_file, volumes_to_remove_file):
+def read_volumes_to_remove(volumes):
+    """
+    Get the indices of the volumes to remove
+
+    Parameters:
+    - volumes: path to a text file with the indices (space, comma or
+               line separated), or list of indices (int or string)
+
+    Returns:
+    - indices (list of int): sorted, without duplicates
+    """
+    if isinstance(volumes, str):
+        volumes = [volumes]
+    if len(volumes) == 1 and os.path.isfile(str(volumes[0])):
+        with open(volumes[0], "r") as file:
+            volumes = file.read().split()
+    indices = set()
+    for value in volumes:
+        for index in str(value).replace(",", " ").split():
+            indices.add(int(index))
+    return sorted(indices)
+
+
+def _filter_sidecars(input_file, output_file, kept):
+    """Keep the same volumes in the bval / bvec files (if any)"""
+    for ext in ["bval", "bvec"]:
+        in_sidecar = os.path.splitext(input_file)[0] + "." + ext
+        if not os.path.exists(in_sidecar):
+            continue
+        table = np.loadtxt(in_sidecar, ndmin=2)
+        out_sidecar = os.path.splitext(output_file)[0] + "." + ext
+        np.savetxt(out_sidecar, table[:, kept], fmt="%g")
+
+
+def remove_volumes(input_file, output_file, volumes_to_remove):
     """
     Remove volumes
 
+    The image is read as a memmap and the kept volumes are written one
+    after the other in one pass. The gradient table (dw_scheme) and the
+    bval / bvec files next to the input are filtered the same way.
+    The removed volumes are recorded in the output header: the output
+    is not written again if it is newer than the input and the same
+    volumes were removed.
+
     Parameters:
-    - input_file (string): path to input diffusion
-    - output_file (string): path to output diffusion
-    - volume_to_remove (string): path to text file  with list of volumes to remove
+    - input_file (string): path to input diffusion (.mif)
+    - output_file (string): path to output diffusion (.mif)
+    - volumes_to_remove: path to text file with list of volumes to remove,
+                         or list of indices
+
+    Returns:
+    - int: 1 success, 0 failure
+    - msg
     """
-    # Créer un répertoire temporaire
-    dir_name = os.path.dirname(input_file)
-    temp_dir = os.path.join(dir_name, "_temp")
-    os.mkdir(temp_dir)
-
-    with open(volumes_to_remove_file, 'r') as file:
-        data = file.read()
-        volumes_to_remove = data.split()
-
-    print(f'\n   Vol to rm: {volumes_to_remove}')
-
-    # Liste pour stocker les chemins des volumes restants
-    remaining_volumes = []
-    volume_idx = 0
-
-    # Boucle pour extraire les volumes
-    while True:
-        temp_volume_file = os.path.join(temp_dir, f'volume_{volume_idx}.mif')
-        result = os.system(
-            f'mrconvert {input_file} -coord 3 {volume_idx} {temp_volume_file}')
-        # Break the loop if mrconvert fails (indicating no more volumes)
-        if result != 0:
-            print("\n No more volumes to extract")
-            break
-        if str(volume_idx) not in volumes_to_remove:
-            remaining_volumes.append(temp_volume_file)
-        volume_idx += 1
-
-    # Concaténer les volumes restants en un seul fichier .mif de sortie
-    remaining_volumes = ' '.join(remaining_volumes)
-    os.system(f'mrcat {remaining_volumes} -axis 3 {output_file}')
-
-    # Nettoyer les fichiers temporaires
-
-    delete_directory(temp_dir)
-
-    print(f"Volumes retirés et image sauvegardée sous '{output_file}'")
+    indices = read_volumes_to_remove(volumes_to_remove)
+    print(f'\n   Vol to rm: {indices}')
+    removed = ",".join(str(i) for i in indices)
+    if (
+        verify_file(output_file)
+        and os.path.getmtime(output_file) >= os.path.getmtime(input_file)
+        and (read_mif_header(output_file) or {}).get("removed_volumes") == [removed]
+    ):
+        msg = f"\nVolumes already removed: {output_file}"
+        print(msg)
+        return 1, msg
+
+    data, header = load_mif(input_file)
+    if data.ndim != 4:
+        msg = f"\nCan not remove volumes: {input_file} is not a 4D image"
+        return 0, msg
+    n_volumes = data.shape[3]
+    out_of_range = [i for i in indices if not 0 <= i < n_volumes]
+    if out_of_range:
+        print(colored(
+            f"\nVolumes {out_of_range} ignored: image has {n_volumes} volumes", "yellow"))
+    kept = [i for i in range(n_volumes) if i not in indices]
+    if not kept:
+        msg = "\nCan not remove volumes: no volume left"
+        return 0, msg
+
+    header["keyval"]["removed_volumes"] = [removed]
+    save_mif(output_file, data, header=header, volumes=kept)
+    _filter_sidecars(input_file, output_file, kept)
+
+    msg = (f"\nVolumes removed ({n_volumes - len(kept)}), "
+           f"image saved to '{output_file}'")
+    print(msg)
+    return 1, msg
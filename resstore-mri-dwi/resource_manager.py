@@ -0,0 +1,141 @@
+"""
+Thread budget of the external tools.
+Each process has a number of threads (node threads / --jobs) shared by
+the stages running at the same time: a stage gets a part of the free
+threads and the budget is applied to every tool it launches (MRtrix
+-nthreads, OMP_NUM_THREADS for eddy / dipy / torch,
+ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS for ANTs, AMICO nthreads):
+    - set_total_threads
+    - get_total_threads
+    - thread_budget: context manager giving threads to a stage
+    - get_thread_budget
+    - apply_thread_budget: add the budget to a command and its environment
+    - get_process_pool: pool of processes for the Python computations
+"""
+
+import contextlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# MRtrix commands accepting -nthreads
+MRTRIX_COMMANDS = {
+    "5tt2gmwmi", "5ttgen", "dwi2fod", "dwi2mask", "dwi2response", "dwi2tensor",
+    "dwibiascorrect", "dwicat", "dwidenoise", "dwiextract", "dwifslpreproc",
+    "mrcat", "mrconvert", "mrdegibbs", "mrgrid", "mrinfo", "mrmath",
+    "mrtransform", "mtnormalise", "sh2peaks", "tensor2metric", "transformconvert",
+}
+# Environment variables read by the other tools
+THREAD_VARIABLES = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "MRTRIX_NTHREADS",
+]
+
+_condition = threading.Condition()
+_state = {"total": os.cpu_count() or 1, "used": 0}
+_local = threading.local()
+
+
+def set_total_threads(n_threads):
+    """
+    Set the number of threads of the process
+
+    Parameters:
+    - n_threads (int): number of threads shared by the stages of the process
+    """
+    with _condition:
+        _state["total"] = max(1, int(n_threads))
+        _condition.notify_all()
+
+
+def get_total_threads():
+    """Number of threads of the process"""
+    return _state["total"]
+
+
+def get_thread_budget():
+    """Number of threads of the stage running in the current thread"""
+    return getattr(_local, "budget", None) or _state["total"]
+
+
+@contextlib.contextmanager
+def thread_budget(n_wanted=None):
+    """
+    Give threads to a stage
+
+    Waits until at least one thread is free, then takes up to n_wanted
+    free threads. The threads are given back at the end of the stage.
+
+    Parameters:
+    - n_wanted (int): number of threads wanted (default: all threads)
+
+    Yields:
+    - n_threads (int): number of threads of the stage
+    """
+    if n_wanted is None:
+        n_wanted = _state["total"]
+    with _condition:
+        while _state["total"] - _state["used"] < 1:
+            _condition.wait()
+        n_threads = max(1, min(n_wanted, _state["total"] - _state["used"]))
+        _state["used"] += n_threads
+    previous = getattr(_local, "budget", None)
+    _local.budget = n_threads
+    try:
+        yield n_threads
+    finally:
+        _local.budget = previous
+        with _condition:
+            _state["used"] -= n_threads
+            _condition.notify_all()
+
+
+def apply_thread_budget(command, n_threads=None):
+    """
+    Apply a thread budget to a command
+
+    Parameters:
+    - command (list): command to execute
+    - n_threads (int): number of threads (default: budget of the current stage)
+
+    Returns:
+    - command (list): command with -nthreads for MRtrix commands
+    - env (dict): environment of the command
+    """
+    if n_threads is None:
+        n_threads = get_thread_budget()
+    env = dict(os.environ)
+    for variable in THREAD_VARIABLES:
+        env[variable] = str(n_threads)
+    command = list(command)
+    tool = os.path.basename(str(command[0]))
+    if tool in MRTRIX_COMMANDS and "-nthreads" not in command:
+        command += ["-nthreads", str(n_threads)]
+    return command, env
+
+
+def get_process_pool(n_workers, initializer=None, initargs=()):
+    """
+    Pool of processes for the Python computations of a stage (fits,
+    denoising)
+
+    Parameters:
+    - n_workers (int): number of processes
+    - initializer (function): (optionnal) called once in each process
+    - initargs (tuple): (optionnal) arguments of initializer
+
+    Returns:
+    - executor (ProcessPoolExecutor)
+    """
+    # Processes are spawned, not forked: the stages of an acquisition run in
+    # threads, and a fork only copies the thread calling it (locks held by
+    # the other threads would stay locked in the child)
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=context, initializer=initializer,
+        initargs=initargs
+    )
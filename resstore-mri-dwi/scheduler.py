@@ -0,0 +1,195 @@
+"""
+Functions to schedule the processing of several units
+(one unit = one subject / session / acquisition):
+    - get_analysis_directory
+    - get_timeline_path
+    - run_unit: run one unit in its own working directory with its own log
+      and timeline
+    - run_units: run all units, serially or in a process pool
+    - print_summary
+"""
+
+import contextlib
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from termcolor import colored
+
+from resource_manager import set_total_threads
+from timing import reset_timeline, write_timeline
+
+
+def get_analysis_directory(bids_path, sub, ses, acq, volumes=None):
+    """
+    Get the derivatives directory of a unit
+
+    Parameters:
+    - bids_path (string): path to the BIDS directory
+    - sub (string): subject name
+    - ses (string): session name
+    - acq (string): acquisition name (abcd, hermes)
+    - volumes (list): (optionnal) volumes to remove (indices or text file)
+
+    Returns:
+    - analysis_directory (string)
+    """
+    acq_dir = "dwi-" + acq
+    if volumes is not None:
+        acq_dir += "_removed_volumes"
+    return os.path.join(
+        bids_path, "derivatives", "sub-" + sub, "ses-" + ses, acq_dir
+    )
+
+
+def get_timeline_path(analysis_directory):
+    """
+    Get path to the JSON timeline of a unit (see timing.write_timeline)
+
+    Parameters:
+    - analysis_directory (string): analysis directory of the unit
+
+    Returns:
+    - timeline_json (string)
+    """
+    return os.path.join(analysis_directory, "logs", "timeline.json")
+
+
+def run_unit(func, unit, log_file=None, n_threads=None):
+    """
+    Run one unit
+
+    The working directory is set to the analysis directory of the unit
+    (MRtrix creates its temporary directories in it). When a log file is
+    given, everything printed by the unit is written in it. The timing of
+    the commands and stages of the unit is written in
+    <analysis_directory>/logs/timeline.json (and .csv).
+
+    Parameters:
+    - func: function processing one unit, called with unit["kwargs"]
+            and returning (int, msg, ...)
+    - unit (dict): with keys "name", "analysis_directory" and "kwargs"
+    - log_file (string): (optionnal) path to the log file of the unit
+    - n_threads (int): (optionnal) number of threads of the unit
+
+    Returns:
+    - name (string): unit name
+    - int: 1 success, 0 failure
+    - msg
+    """
+    analysis_directory = unit["analysis_directory"]
+    if n_threads is not None:
+        set_total_threads(n_threads)
+    if not os.path.exists(analysis_directory):
+        os.makedirs(analysis_directory)
+    os.chdir(analysis_directory)
+
+    if log_file is None:
+        log = contextlib.nullcontext()
+    else:
+        log_dir = os.path.dirname(log_file)
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        log = open(log_file, "a", encoding="utf-8", buffering=1)
+
+    with log as stream:
+        if stream is None:
+            redirect_out = contextlib.nullcontext()
+            redirect_err = contextlib.nullcontext()
+        else:
+            redirect_out = contextlib.redirect_stdout(stream)
+            redirect_err = contextlib.redirect_stderr(stream)
+        with redirect_out, redirect_err:
+            reset_timeline()
+            try:
+                res = func(**unit["kwargs"])
+                result, msg = res[0], res[1]
+            except SystemExit as e:
+                result = 0
+                msg = f"\nProcessing stopped (exit code {e.code})"
+                print(msg)
+            except Exception:
+                result = 0
+                msg = traceback.format_exc()
+                print(msg)
+            timeline_json = get_timeline_path(analysis_directory)
+            write_timeline(os.path.dirname(timeline_json))
+            print(f"\nTimeline saved to {timeline_json}")
+
+    return unit["name"], result, msg
+
+
+def run_units(func, units, jobs=1, log_name="pipeline.log", threads=None):
+    """
+    Run all units
+
+    With jobs=1 the units are run one after the other in the current
+    process and print in the terminal. With jobs > 1 the units are
+    dispatched to a pool of processes, each unit running in its own
+    process (own working directory) and writing in its own log file
+    (<analysis_directory>/logs/<log_name>). The threads of the node
+    are divided between the units running at the same time.
+
+    Parameters:
+    - func: function processing one unit (see run_unit)
+    - units (list of dict): units to process (see run_unit)
+    - jobs (int): number of units processed at the same time
+    - log_name (string): name of the log file of each unit
+    - threads (int): number of threads of the node (default: all CPUs)
+
+    Returns:
+    - results (dict): {unit name: (int, msg)}
+    """
+    results = {}
+    if threads is None:
+        threads = os.cpu_count() or 1
+    n_threads = max(1, threads // max(1, min(jobs, len(units))))
+    if jobs <= 1:
+        for unit in units:
+            name, result, msg = run_unit(func, unit, n_threads=n_threads)
+            results[name] = (result, msg)
+        return results
+
+    print(colored(
+        f"\nProcessing {len(units)} units with {jobs} jobs ({n_threads} threads each)",
+        "magenta"))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for unit in units:
+            log_file = os.path.join(unit["analysis_directory"], "logs", log_name)
+            future = executor.submit(run_unit, func, unit, log_file, n_threads)
+            futures[future] = unit["name"]
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                name, result, msg = future.result()
+            except Exception as e:
+                # Worker process died (killed, out of memory...)
+                result, msg = 0, f"\nWorker failed: {e}"
+            results[name] = (result, msg)
+            status = "done" if result else "FAILED"
+            color = "green" if result else "red"
+            print(colored(f"Unit {name}: {status}", color))
+    return results
+
+
+def print_summary(results):
+    """
+    Print which units succeeded or failed
+
+    Parameters:
+    - results (dict): {unit name: (int, msg)} as returned by run_units
+
+    Returns:
+    - failed (list): names of the failed units
+    """
+    succeeded = [name for name, (result, _) in results.items() if result]
+    failed = [name for name, (result, _) in results.items() if not result]
+    print(colored("\n \n===== SUMMARY =====\n", "cyan"))
+    print(colored(f"Succeeded ({len(succeeded)}): {succeeded}", "green"))
+    if failed:
+        print(colored(f"Failed ({len(failed)}):", "red"))
+        for name in failed:
+            msg = str(results[name][1]).strip().splitlines()
+            print(colored(f"  - {name}: {msg[-1] if msg else ''}", "red"))
+    return failed
@@ -0,0 +1,392 @@
+"""
+Cache of the processing stages. A stage (one external command) is
+skipped only if its manifest shows that it was run with the same
+command line, the same tool version and the same inputs (content hash),
+and that its outputs were not modified since.
+Outputs are written in temporary files and renamed at the end of the
+command, so a killed command never leaves a partial output. A stage can
+also be a pipeline of commands (list of commands, see execute_pipe):
+    - hash_path
+    - get_tool_version
+    - get_manifest_path
+    - is_stage_up_to_date
+    - check_output: used by verify_file
+    - run_cached_command
+"""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import struct
+import subprocess
+
+import numpy as np
+from termcolor import colored
+
+from resource_manager import MRTRIX_COMMANDS
+
+CACHE_DIR = ".stage_cache"
+CHUNK_SIZE = 16 * 1024 * 1024
+_TOOL_VERSIONS = {}
+
+
+def hash_path(path, previous=None):
+    """
+    Get the fingerprint of a file (or of all files of a directory)
+
+    The sha256 of a file is only computed again if its size or
+    modification time changed since the previous fingerprint.
+
+    Parameters:
+    - path (string): path to a file or a directory
+    - previous (dict): (optionnal) previous fingerprint of the path
+
+    Returns:
+    - fingerprint (dict): {"size", "mtime_ns", "sha256"} or None if the
+                          path does not exist
+    """
+    if not os.path.exists(path):
+        return None
+
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(path)
+            for name in names
+        )
+    else:
+        files = [path]
+    size = sum(os.path.getsize(f) for f in files)
+    mtime_ns = max([os.stat(f).st_mtime_ns for f in files], default=0)
+    if (
+        previous is not None
+        and previous.get("size") == size
+        and previous.get("mtime_ns") == mtime_ns
+    ):
+        return dict(previous)
+
+    sha = hashlib.sha256()
+    for file_path in files:
+        sha.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, "rb") as stream:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+    return {"size": size, "mtime_ns": mtime_ns, "sha256": sha.hexdigest()}
+
+
+def get_tool_version(tool):
+    """
+    Get the version of an external tool
+
+    MRtrix commands give their version with -version. Other tools are
+    not run (FSL bet / flirt... have no -version option and would run
+    on their default inputs): the path, size and modification time of
+    the executable are used.
+
+    Parameters:
+    - tool (string): command name (ex: "dwidenoise")
+
+    Returns:
+    - version (string)
+    """
+    if tool in _TOOL_VERSIONS:
+        return _TOOL_VERSIONS[tool]
+
+    tool_path = shutil.which(tool)
+    if tool_path is None:
+        version = "not found"
+    else:
+        version = None
+        if os.path.basename(tool) in MRTRIX_COMMANDS:
+            try:
+                p = subprocess.run(
+                    [tool, "-version"], capture_output=True, timeout=30, check=False
+                )
+                out = p.stdout.decode("utf-8", errors="replace").strip()
+                if p.returncode == 0 and out:
+                    version = out.splitlines()[0]
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        if version is None:
+            stat = os.stat(tool_path)
+            version = f"{os.path.realpath(tool_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    _TOOL_VERSIONS[tool] = version
+    return version
+
+
+def _is_pipeline(cmd):
+    """Command is a list of commands chained by pipes"""
+    return len(cmd) > 0 and isinstance(cmd[0], (list, tuple))
+
+
+def _command_line(cmd):
+    """Command line recorded in the manifest ("|" between piped commands)"""
+    if not _is_pipeline(cmd):
+        return [str(c) for c in cmd]
+    line = []
+    for command in cmd:
+        if line:
+            line.append("|")
+        line += [str(c) for c in command]
+    return line
+
+
+def _cmd_version(cmd):
+    """Version of the tool(s) of a command"""
+    if not _is_pipeline(cmd):
+        return get_tool_version(str(cmd[0]))
+    return " | ".join(get_tool_version(str(command[0])) for command in cmd)
+
+
+def get_manifest_path(stage_name, outputs):
+    """
+    Get path of the manifest of a stage
+    (stored in .stage_cache next to the first output)
+
+    Parameters:
+    - stage_name (string): stage name
+    - outputs (list of string): outputs of the stage
+
+    Returns:
+    - manifest_path (string)
+    """
+    out_dir = os.path.dirname(os.path.abspath(outputs[0]))
+    return os.path.join(out_dir, CACHE_DIR, stage_name + ".json")
+
+
+def _load_manifest(manifest_path):
+    """Load a manifest, None if it does not exist or is not valid"""
+    try:
+        with open(manifest_path, encoding="utf-8") as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(manifest_path, manifest):
+    """Write a manifest (temp then rename)"""
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = f"{manifest_path}.tmp{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as stream:
+        json.dump(manifest, stream, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def _fingerprints(paths, previous=None):
+    """Fingerprints of several paths"""
+    previous = previous or {}
+    return {
+        os.path.abspath(p): hash_path(p, previous.get(os.path.abspath(p)))
+        for p in paths
+    }
+
+
+def is_stage_up_to_date(stage_name, cmd, inputs, outputs):
+    """
+    Check if a stage must be run again
+
+    Parameters:
+    - stage_name (string): stage name
+    - cmd (list): command of the stage
+    - inputs (list of string): files read by the stage
+    - outputs (list of string): files written by the stage
+
+    Returns:
+    - up_to_date (boolean)
+    - reason (string): why the stage must be run again
+    """
+    manifest = _load_manifest(get_manifest_path(stage_name, outputs))
+    if manifest is None:
+        return False, "no manifest"
+    if manifest.get("command") != _command_line(cmd):
+        return False, "command line changed"
+    if manifest.get("tool_version") != _cmd_version(cmd):
+        return False, f"{_command_line(cmd)[0]} version changed"
+
+    recorded_outputs = manifest.get("outputs", {})
+    for path, fingerprint in _fingerprints(outputs, recorded_outputs).items():
+        if fingerprint is None:
+            return False, f"{path} is missing"
+        if fingerprint != recorded_outputs.get(path):
+            return False, f"{path} was modified"
+
+    recorded_inputs = manifest.get("inputs", {})
+    for path, fingerprint in _fingerprints(inputs, recorded_inputs).items():
+        recorded = recorded_inputs.get(path)
+        if recorded is None or fingerprint is None:
+            return False, f"{path} is a new input"
+        if fingerprint["sha256"] != recorded["sha256"]:
+            return False, f"{path} changed"
+
+    return True, ""
+
+
+def _record_stage(stage_name, cmd, inputs, outputs):
+    """Write the manifest of a stage that has just been run"""
+    manifest = {
+        "stage": stage_name,
+        "command": _command_line(cmd),
+        "tool_version": _cmd_version(cmd),
+        "inputs": _fingerprints(inputs),
+        "outputs": _fingerprints(outputs),
+    }
+    _write_manifest(get_manifest_path(stage_name, outputs), manifest)
+
+
+def check_output(file_path):
+    """
+    Check an existing file against the manifests of its directory
+
+    Parameters:
+    - file_path (string): path to a file
+
+    Returns:
+    - valid (boolean): False if a manifest records this file and the file
+                       was modified (ex: truncated) since
+    """
+    path = os.path.abspath(file_path)
+    cache_dir = os.path.join(os.path.dirname(path), CACHE_DIR)
+    if not os.path.isdir(cache_dir):
+        return True
+    for manifest_path in glob.glob(os.path.join(cache_dir, "*.json")):
+        manifest = _load_manifest(manifest_path) or {}
+        recorded = manifest.get("outputs", {}).get(path)
+        if recorded is not None:
+            return hash_path(path, recorded) == recorded
+    return True
+
+
+def _temp_path(path):
+    """Temporary path in the same directory, same extension"""
+    dir_name, file_name = os.path.split(os.path.abspath(path))
+    return os.path.join(dir_name, f".tmp{os.getpid()}_{file_name}")
+
+
+def _remove(path):
+    """Remove a file or a directory if it exists"""
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _is_complete(path):
+    """
+    Check that an existing output is a whole image (not truncated by a
+    killed command): the data of a MIF / NIfTI must fit in the file
+    """
+    if os.path.isdir(path):
+        return bool(os.listdir(path))
+    if os.path.getsize(path) == 0:
+        return False
+    try:
+        if path.endswith((".mif", ".mih", ".mif.gz")):
+            from mif_io import load_mif
+
+            # memmap / read of the whole data fails if the file is too small
+            load_mif(path)
+        elif path.endswith((".nii", ".nii.gz")):
+            import nibabel as nib
+
+            proxy = nib.load(path).dataobj
+            expected = int(proxy.offset) + int(np.prod(proxy.shape)) * proxy.dtype.itemsize
+            if path.endswith(".nii"):
+                return os.path.getsize(path) >= expected
+            # gzip trailer: size of the uncompressed data (modulo 2**32)
+            with open(path, "rb") as stream:
+                stream.seek(-4, os.SEEK_END)
+                size = struct.unpack("<I", stream.read(4))[0]
+            return size == expected % 2 ** 32
+    except (OSError, ValueError, EOFError, struct.error):
+        return False
+    return True
+
+
+def run_cached_command(stage_name, cmd, inputs, outputs, atomic=True, adopt_existing=False,
+                       stream=False, timeout=None):
+    """
+    Run a command only if its outputs are missing or stale
+
+    Parameters:
+    - stage_name (string): stage name (name of the manifest)
+    - cmd (list): command to execute, or list of commands chained by
+                  pipes (intermediate images are not kept)
+    - inputs (list of string): files read by the command
+    - outputs (list of string): files written by the command
+    - atomic (boolean): output paths in cmd are replaced by temporary paths,
+                        renamed once the command succeeded
+    - adopt_existing (boolean): (default: False) if all outputs exist but
+                                there is no manifest (outputs created
+                                before the cache existed), trust them if
+                                they are whole images and create the
+                                manifest (never done if not atomic: a
+                                killed command may have left partial
+                                outputs)
+    - stream (boolean): streaming mode of execute_command
+    - timeout (float): (optionnal) timeout of the command in seconds
+
+    Returns:
+    - result: exit code (0 if the stage is up to date)
+    - stderrl
+    - sdtoutl
+    """
+    from useful import execute_command, execute_pipe
+
+    up_to_date, reason = is_stage_up_to_date(stage_name, cmd, inputs, outputs)
+    if up_to_date:
+        print(colored(f"\nStage {stage_name} is up to date, skipped", "yellow"))
+        return 0, b"", b""
+    manifest_path = get_manifest_path(stage_name, outputs)
+    if (
+        adopt_existing
+        and atomic
+        and reason == "no manifest"
+        and all(os.path.exists(o) and _is_complete(o) for o in outputs)
+    ):
+        print(colored(f"\nStage {stage_name}: existing outputs recorded in cache", "yellow"))
+        _record_stage(stage_name, cmd, inputs, outputs)
+        return 0, b"", b""
+    print(colored(f"\nStage {stage_name} must be run ({reason})", "yellow"))
+
+    # The stage will write new outputs, old manifest is not valid anymore
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    commands = cmd if _is_pipeline(cmd) else [cmd]
+    if atomic:
+        temp_outputs = {os.path.abspath(o): _temp_path(o) for o in outputs}
+        run_cmds = []
+        for command in commands:
+            run_cmd = []
+            for arg in command:
+                # "-" is a piped image, not a file
+                key = os.path.abspath(arg) if isinstance(arg, str) and arg != "-" else arg
+                run_cmd.append(temp_outputs.get(key, arg))
+            run_cmds.append(run_cmd)
+        for temp in temp_outputs.values():
+            _remove(temp)
+    else:
+        temp_outputs = {}
+        run_cmds = [list(command) for command in commands]
+        for output in outputs:
+            _remove(output)
+
+    if _is_pipeline(cmd):
+        result, stderrl, sdtoutl = execute_pipe(run_cmds, stream=stream, timeout=timeout)
+    else:
+        result, stderrl, sdtoutl = execute_command(
+            run_cmds[0], stream=stream, timeout=timeout
+        )
+    if result != 0:
+        for temp in temp_outputs.values():
+            _remove(temp)
+        return result, stderrl, sdtoutl
+
+    for final, temp in temp_outputs.items():
+        if os.path.exists(temp):
+            _remove(final)
+            os.replace(temp, final)
+    _record_stage(stage_name, cmd, inputs, outputs)
+    return result, stderrl, sdtoutl
@@ -0,0 +1,164 @@
+"""
+Functions to run processing stages declared as a graph.
+Each stage declares the names of its inputs and outputs, a stage is
+launched as soon as all its inputs are available:
+    - make_stage
+    - check_stage_graph
+    - run_stage_graph
+"""
+
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from termcolor import colored
+
+from resource_manager import get_total_threads, thread_budget
+from timing import timed_stage
+
+
+def make_stage(name, func, inputs=(), outputs=()):
+    """
+    Declare a stage
+
+    Parameters:
+    - name (string): stage name
+    - func: function called with the inputs as keyword arguments
+            and returning (int, msg, outputs), with outputs a dictionary
+            containing (at least) the declared outputs
+    - inputs (list of string): names of the values needed by the stage
+    - outputs (list of string): names of the values created by the stage
+
+    Returns:
+    - stage (dict)
+    """
+    return {
+        "name": name,
+        "func": func,
+        "inputs": list(inputs),
+        "outputs": list(outputs),
+    }
+
+
+def check_stage_graph(stages, available):
+    """
+    Check that the graph can be run: each output is created by only one
+    stage, each input is available or created by a stage, and there is
+    no cycle.
+
+    Parameters:
+    - stages (list of dict): stages (see make_stage)
+    - available (list of string): names of the values available at start
+
+    Returns:
+    - int 1 success, 0 failure
+    - msg
+    """
+    producers = {}
+    for stage in stages:
+        for output in stage["outputs"]:
+            if output in producers or output in available:
+                msg = f"\n'{output}' is created by several stages"
+                return 0, msg
+            producers[output] = stage["name"]
+
+    for stage in stages:
+        for inp in stage["inputs"]:
+            if inp not in producers and inp not in available:
+                msg = f"\nInput '{inp}' of stage {stage['name']} is never created"
+                return 0, msg
+
+    # Cycle detection: resolve stages as if they were all successful
+    resolved = set(available)
+    pending = list(stages)
+    while pending:
+        ready = [s for s in pending if all(i in resolved for i in s["inputs"])]
+        if not ready:
+            names = [s["name"] for s in pending]
+            msg = f"\nCycle between stages {names}"
+            return 0, msg
+        for stage in ready:
+            resolved.update(stage["outputs"])
+            pending.remove(stage)
+
+    return 1, "\nStage graph is valid"
+
+
+def _run_stage(stage, kwargs, n_threads):
+    """Call a stage with its inputs and its threads, never raise"""
+    try:
+        with thread_budget(n_threads), timed_stage(stage["name"]):
+            result, msg, outputs = stage["func"](**kwargs)
+    except Exception:
+        return 0, traceback.format_exc(), {}
+    if result and outputs is not None:
+        missing = [o for o in stage["outputs"] if o not in outputs]
+        if missing:
+            return 0, f"\nStage {stage['name']} did not create {missing}", {}
+    return result, msg, outputs
+
+
+def run_stage_graph(stages, context, max_workers=1):
+    """
+    Run the stages: ready stages (all inputs available) are launched in
+    a pool of threads. With max_workers=1 stages are run one after the
+    other in the declaration order. When a stage fails, the stages that
+    depend on it are skipped. The threads of the process (see
+    resource_manager) are shared between the stages running together.
+
+    Parameters:
+    - stages (list of dict): stages (see make_stage)
+    - context (dict): values available at start, updated with the
+                      outputs of the stages
+    - max_workers (int): number of stages run at the same time
+
+    Returns:
+    - int 1 success, 0 failure
+    - msg
+    - status (dict): {stage name: "done", "failed" or "skipped"}
+    """
+    status = {}
+    result, msg = check_stage_graph(stages, list(context.keys()))
+    if result == 0:
+        return 0, msg, status
+
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while pending or running:
+            # Launch all ready stages (in declaration order)
+            ready = [s for s in pending if all(i in context for i in s["inputs"])]
+            ready = ready[:max(0, max(1, max_workers) - len(running))]
+            if ready:
+                # Share the threads between the stages that will run together
+                n_threads = max(1, get_total_threads() // (len(running) + len(ready)))
+            for stage in ready:
+                pending.remove(stage)
+                print(colored(f"\n>> Stage {stage['name']} starts", "blue"))
+                kwargs = {name: context[name] for name in stage["inputs"]}
+                future = executor.submit(_run_stage, stage, kwargs, n_threads)
+                running[future] = stage
+            if not running:
+                # Remaining stages depend on a failed stage
+                break
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                res, stage_msg, outputs = future.result()
+                if res:
+                    context.update(outputs or {})
+                    status[stage["name"]] = "done"
+                    print(colored(f"\n>> Stage {stage['name']} done", "blue"))
+                else:
+                    status[stage["name"]] = "failed"
+                    print(colored(f"\n>> Stage {stage['name']} failed: {stage_msg}", "red"))
+
+    for stage in pending:
+        status[stage["name"]] = "skipped"
+        print(colored(f"\n>> Stage {stage['name']} skipped (missing inputs)", "yellow"))
+
+    failed = [name for name, state in status.items() if state != "done"]
+    if failed:
+        msg = f"\nStages not done: {failed}"
+        return 0, msg, status
+    msg = "\nAll stages done"
+    return 1, msg, status
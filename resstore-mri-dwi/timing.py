@@ -0,0 +1,195 @@
+"""
+Timing and resource instrumentation of the pipeline.
+Every external command (see useful.execute_command) and every stage
+(see stage_graph) is recorded with its wall time, user / sys CPU time
+and peak memory (RSS):
+    - reset_timeline
+    - get_current_stage
+    - timed_stage: context manager recording an in-process stage
+    - record_command
+    - write_timeline: JSON / CSV timeline of one unit
+    - write_cohort_report: roll-up of the timelines of several units
+"""
+
+import contextlib
+import csv
+import json
+import os
+import resource
+import threading
+import time
+
+TIMELINE_FIELDS = [
+    "kind", "stage", "name", "start", "end", "wall_s",
+    "user_s", "sys_s", "max_rss_mb", "exit_code",
+]
+# user / sys time of the calling thread only (Linux), else of the process
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+_timeline = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def reset_timeline():
+    """Remove all records (start of a new unit)"""
+    with _lock:
+        del _timeline[:]
+
+
+def get_current_stage():
+    """Name of the stage running in the current thread"""
+    return getattr(_local, "stage", None) or "main"
+
+
+def _add_record(record):
+    """Add a record to the timeline (thread safe)"""
+    with _lock:
+        _timeline.append(record)
+
+
+@contextlib.contextmanager
+def timed_stage(name):
+    """
+    Record an in-process stage
+
+    CPU times are those of the calling thread (external commands
+    launched by the stage are recorded separately). Peak RSS is the peak
+    of the whole Python process at the end of the stage.
+
+    Parameters:
+    - name (string): stage name
+    """
+    previous = getattr(_local, "stage", None)
+    _local.stage = name
+    start = time.time()
+    usage_start = resource.getrusage(RUSAGE_THREAD)
+    try:
+        yield
+    finally:
+        usage_end = resource.getrusage(RUSAGE_THREAD)
+        end = time.time()
+        _local.stage = previous
+        _add_record({
+            "kind": "stage",
+            "stage": name,
+            "name": name,
+            "start": start,
+            "end": end,
+            "wall_s": end - start,
+            "user_s": usage_end.ru_utime - usage_start.ru_utime,
+            "sys_s": usage_end.ru_stime - usage_start.ru_stime,
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "exit_code": None,
+        })
+
+
+def record_command(command, start, end, rusage, exit_code):
+    """
+    Record an external command
+
+    Parameters:
+    - command (list): command executed
+    - start, end (float): start and end time (time.time())
+    - rusage: resource usage of the command (as returned by os.wait4)
+    - exit_code (int): exit code of the command
+    """
+    _add_record({
+        "kind": "command",
+        "stage": get_current_stage(),
+        "name": " ".join(str(c) for c in command),
+        "start": start,
+        "end": end,
+        "wall_s": end - start,
+        "user_s": rusage.ru_utime if rusage is not None else None,
+        "sys_s": rusage.ru_stime if rusage is not None else None,
+        # ru_maxrss is in kilobytes on Linux; it includes the memory of the
+        # Python process before exec, so small commands report at least it
+        "max_rss_mb": rusage.ru_maxrss / 1024 if rusage is not None else None,
+        "exit_code": exit_code,
+    })
+
+
+def write_timeline(out_dir, name="timeline"):
+    """
+    Write the timeline of the current unit (<name>.json and <name>.csv)
+
+    Parameters:
+    - out_dir (string): output directory
+    - name (string): name of the output files
+
+    Returns:
+    - timeline_json (string): path to the JSON timeline
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with _lock:
+        records = sorted(_timeline, key=lambda r: r["start"])
+    timeline_json = os.path.join(out_dir, name + ".json")
+    with open(timeline_json, "w", encoding="utf-8") as stream:
+        json.dump(records, stream, indent=2)
+    with open(os.path.join(out_dir, name + ".csv"), "w", newline="", encoding="utf-8") as stream:
+        writer = csv.DictWriter(stream, fieldnames=TIMELINE_FIELDS, delimiter=";")
+        writer.writeheader()
+        writer.writerows(records)
+    return timeline_json
+
+
+def write_cohort_report(timelines, out_dir, name="timing_cohort"):
+    """
+    Roll-up of the stage timings of several units
+
+    For each stage: number of units, mean and max wall time, mean CPU time
+    (stage + its external commands) and max peak RSS.
+
+    Parameters:
+    - timelines (dict): {unit name: path to its JSON timeline}
+    - out_dir (string): output directory
+    - name (string): name of the output files (.json and .csv)
+
+    Returns:
+    - report_csv (string): path to the CSV report
+    """
+    stages = {}
+    for unit, timeline_json in timelines.items():
+        if not os.path.exists(timeline_json):
+            continue
+        with open(timeline_json, encoding="utf-8") as stream:
+            records = json.load(stream)
+        per_stage = {}
+        for record in records:
+            info = per_stage.setdefault(
+                record["stage"], {"wall_s": 0.0, "cpu_s": 0.0, "max_rss_mb": 0.0}
+            )
+            if record["kind"] == "stage":
+                info["wall_s"] = record["wall_s"]
+            for key in ["user_s", "sys_s"]:
+                info["cpu_s"] += record[key] or 0.0
+            info["max_rss_mb"] = max(info["max_rss_mb"], record["max_rss_mb"] or 0.0)
+        for stage, info in per_stage.items():
+            stages.setdefault(stage, []).append(dict(info, unit=unit))
+
+    rows = []
+    for stage, infos in stages.items():
+        walls = [i["wall_s"] for i in infos]
+        rows.append({
+            "stage": stage,
+            "n_units": len(infos),
+            "wall_mean_s": sum(walls) / len(walls),
+            "wall_max_s": max(walls),
+            "wall_total_s": sum(walls),
+            "cpu_mean_s": sum(i["cpu_s"] for i in infos) / len(infos),
+            "max_rss_mb": max(i["max_rss_mb"] for i in infos),
+        })
+    rows.sort(key=lambda r: r["wall_total_s"], reverse=True)
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, name + ".json"), "w", encoding="utf-8") as stream:
+        json.dump({"stages": rows, "units": sorted(timelines)}, stream, indent=2)
+    report_csv = os.path.join(out_dir, name + ".csv")
+    with open(report_csv, "w", newline="", encoding="utf-8") as stream:
+        fields = ["stage", "n_units", "wall_mean_s", "wall_max_s", "wall_total_s",
+                  "cpu_mean_s", "max_rss_mb"]
+        writer = csv.DictWriter(stream, fieldnames=fields, delimiter=";")
+        writer.writeheader()
+        writer.writerows(rows)
+    return report_csv
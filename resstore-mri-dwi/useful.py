@@ -3,6 +3,8 @@ Useful functions :
 
     - check_file_ext
     - execute_command
+    - execute_pipe: commands chained by pipes
+    - set_command_timeout
     - convert_mif_to_nifti
     - convert_nifti_to_mif
     - get_shell
@@ -10,16 +12,26 @@ Useful functions :
     - plot_cst_data
 """
 
+import collections
 import os
+import signal
 import subprocess
 import shutil
+import threading
+import time
 import urllib.request
 import pandas as pd
 import matplotlib.pyplot as plt
 from termcolor import colored
+from stage_cache import check_output
+from native_tools import get_shell_bvalues
+from timing import get_current_stage, record_command
+from resource_manager import apply_thread_budget
 
 EXT_NIFTI = {"NIFTI_GZ": "nii.gz", "NIFTI": "nii"}
 EXT_MIF = {"MIF": "mif"}
+# Default timeout of the commands (seconds), see set_command_timeout
+COMMAND_TIMEOUT = {"seconds": None}
 
 
 def check_file_ext(in_file, ext_dic):
@@ -56,6 +68,10 @@ def verify_file(file_path):
     """
     Check if a file alerady exist
 
+    If the file was created by a cached stage (see stage_cache), it is
+    also checked against the stage manifest: a file modified or
+    truncated since the stage ended is considered as missing.
+
     Parameters:
     - file_path: path to a file (a string)
 
@@ -63,95 +79,313 @@ def verify_file(file_path):
     if os.path.exists(file_path):
         print(
             colored(f"\nFile {file_path} already exists. Verifying contents...", "yellow"))
+        if not check_output(file_path):
+            print(
+                colored(f"\nFile {file_path} differs from its stage manifest.", "yellow"))
+            return False
         return True
     else:
         return False
 
 
-def execute_command(command):
+def set_command_timeout(seconds):
+    """
+    Set the default timeout of the commands (see execute_command)
+
+    Parameters:
+    - seconds (float): timeout in seconds, None for no timeout
+    """
+    COMMAND_TIMEOUT["seconds"] = seconds
+
+
+def _read_pipe(pipe, name, keep, log, lock, live):
+    """
+    Read the output of a command line by line
+
+    Parameters:
+    - pipe: stdout or stderr of the command
+    - name (string): "stdout" or "stderr"
+    - keep: list or deque (bounded) storing the lines
+    - log: (optionnal) opened log file
+    - lock: lock protecting the log file
+    - live (boolean): print the lines as soon as they are read
+    """
+    for line in iter(pipe.readline, b""):
+        keep.append(line)
+        if log is not None:
+            with lock:
+                log.write(f"[{name}] " + line.decode(errors="replace"))
+        if live:
+            print(line.decode(errors="replace"), end="", flush=True)
+    pipe.close()
+
+
+def _kill_process_group(p, timed_out):
+    """Stop a command (and its children) at the end of its timeout"""
+    timed_out.set()
+    for sig, grace in [(signal.SIGTERM, 10), (signal.SIGKILL, 0)]:
+        if p.returncode is not None:
+            return
+        try:
+            os.killpg(p.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            return
+        time.sleep(grace)
+
+
+def execute_command(command, stream=False, log_file=None, timeout=None, tail_lines=200):
     """Execute command
 
+    By default, outputs are kept in memory and printed at the end of the
+    command. In streaming mode, outputs are printed line by line while
+    the command runs and written in a log file, and only the last lines
+    are kept in memory (for long and verbose tools: eddy, TractSeg...).
+
     Parameters:
     - command: command to execute (a list)
+    - stream: streaming mode (a boolean)
+    - log_file: (optionnal) log file of the command, used in streaming mode
+                (default: logs/<stage name>.log in the working directory)
+    - timeout: (optionnal) time in seconds after which the command (and
+               its children) is killed (default: see set_command_timeout)
+    - tail_lines: number of lines of each output kept in streaming mode
+
+    Returns:
+    - result: exit code of the command
+    - stderrl: stderr (last lines in streaming mode)
+    - sdtoutl: stdout (last lines in streaming mode)
 
     Examples:
     - command = ["cd", "path"]
     """
+    if timeout is None:
+        timeout = COMMAND_TIMEOUT["seconds"]
+    # Threads given to the running stage (MRtrix -nthreads, OMP_NUM_THREADS...)
+    command, env = apply_thread_budget(command)
     print("\n", command)
+
+    log = None
+    if stream:
+        if log_file is None:
+            log_file = os.path.join(os.getcwd(), "logs", get_current_stage() + ".log")
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        log = open(log_file, "a", encoding="utf-8", buffering=1)
+        log.write(f"\n### {time.ctime()} {' '.join(str(c) for c in command)}\n")
+        print("--------->Log:", log_file)
+
+    start = time.time()
     p = subprocess.Popen(
         command,
         shell=False,
+        env=env,
         bufsize=-1,
-        stdin=subprocess.PIPE,
+        stdin=subprocess.DEVNULL,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         close_fds=True,
+        # Own process group, to be able to kill the children on timeout
+        start_new_session=timeout is not None,
     )
     print("--------->PID:", p.pid)
 
-    (sdtoutl, stderrl) = p.communicate()
-    if str(sdtoutl) != "":
-        print("sdtoutl: ", sdtoutl.decode())
-    if str(stderrl) != "":
-        print("stderrl: ", stderrl.decode())
+    # Read outputs in threads and reap the process with wait4
+    # to get its resource usage (CPU time, peak memory)
+    lock = threading.Lock()
+    out_lines = collections.deque(maxlen=tail_lines) if stream else []
+    err_lines = collections.deque(maxlen=tail_lines) if stream else []
+    readers = [
+        threading.Thread(
+            target=_read_pipe, args=(p.stdout, "stdout", out_lines, log, lock, stream)
+        ),
+        threading.Thread(
+            target=_read_pipe, args=(p.stderr, "stderr", err_lines, log, lock, stream)
+        ),
+    ]
+    for reader in readers:
+        reader.start()
+    timed_out = threading.Event()
+    killer = None
+    if timeout is not None:
+        killer = threading.Timer(timeout, _kill_process_group, args=(p, timed_out))
+        killer.daemon = True
+        killer.start()
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    if killer is not None:
+        killer.cancel()
+    for reader in readers:
+        reader.join()
+    end = time.time()
+    sdtoutl = b"".join(out_lines)
+    stderrl = b"".join(err_lines)
+
+    result = p.returncode
+    if timed_out.is_set():
+        reason = f"Command killed: no end after the timeout of {timeout} s"
+        stderrl += ("\n" + reason).encode()
+        print(colored(reason, "red"))
+        if result == 0:
+            result = 1
+    if log is not None:
+        log.write(f"### exit code {result}, {end - start:.1f} s\n")
+        log.close()
+
+    if not stream:
+        if str(sdtoutl) != "":
+            print("sdtoutl: ", sdtoutl.decode())
+        if str(stderrl) != "":
+            print("stderrl: ", stderrl.decode())
+
+    record_command(command, start, end, rusage, result)
+    print(
+        f"--------->Wall time: {end - start:.1f} s, "
+        f"CPU: {rusage.ru_utime + rusage.ru_stime:.1f} s, "
+        f"peak RSS: {rusage.ru_maxrss / 1024:.0f} MB"
+    )
+
+    return result, stderrl, sdtoutl
+
 
-    result = p.wait()
+def execute_pipe(commands, stream=False, log_file=None, timeout=None, tail_lines=200):
+    """Execute commands chained by pipes (command1 | command2 ...)
+
+    Used with MRtrix piped images ("-"): the image between two commands
+    is written in MRTRIX_TMPFILE_DIR (node-local /tmp by default) and
+    removed by the next command, never in the output directory.
+
+    Parameters:
+    - commands: commands to execute (a list of lists)
+    - stream, log_file, timeout, tail_lines: see execute_command
+
+    Returns:
+    - result: first non-zero exit code of the commands (0 success)
+    - stderrl: stderr of all commands (last lines in streaming mode)
+    - sdtoutl: stdout of the last command
+    """
+    if timeout is None:
+        timeout = COMMAND_TIMEOUT["seconds"]
+    print("\n", " | ".join(" ".join(str(c) for c in cmd) for cmd in commands))
+
+    log = None
+    if stream:
+        if log_file is None:
+            log_file = os.path.join(os.getcwd(), "logs", get_current_stage() + ".log")
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        log = open(log_file, "a", encoding="utf-8", buffering=1)
+        log.write(f"\n### {time.ctime()} {' | '.join(' '.join(map(str, c)) for c in commands)}\n")
+        print("--------->Log:", log_file)
+
+    lock = threading.Lock()
+    out_lines = collections.deque(maxlen=tail_lines) if stream else []
+    err_lines = collections.deque(maxlen=tail_lines) if stream else []
+    processes = []
+    readers = []
+    start = time.time()
+    for i, command in enumerate(commands):
+        # Threads given to the running stage (MRtrix -nthreads, OMP_NUM_THREADS...)
+        command, env = apply_thread_budget(command)
+        p = subprocess.Popen(
+            command,
+            shell=False,
+            env=env,
+            stdin=processes[-1][1].stdout if processes else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True,
+            start_new_session=timeout is not None,
+        )
+        if processes:
+            # Only the next command reads the output of the previous one
+            processes[-1][1].stdout.close()
+        processes.append((command, p))
+        readers.append(threading.Thread(
+            target=_read_pipe, args=(p.stderr, "stderr", err_lines, log, lock, stream)
+        ))
+    readers.append(threading.Thread(
+        target=_read_pipe,
+        args=(processes[-1][1].stdout, "stdout", out_lines, log, lock, stream)
+    ))
+    for reader in readers:
+        reader.start()
+    timed_out = threading.Event()
+    killers = []
+    if timeout is not None:
+        for _, p in processes:
+            killer = threading.Timer(timeout, _kill_process_group, args=(p, timed_out))
+            killer.daemon = True
+            killer.start()
+            killers.append(killer)
+
+    result = 0
+    for command, p in processes:
+        _, status, rusage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        end = time.time()
+        record_command(command, start, end, rusage, p.returncode)
+        print(
+            f"--------->{command[0]}: exit code {p.returncode}, "
+            f"CPU: {rusage.ru_utime + rusage.ru_stime:.1f} s, "
+            f"peak RSS: {rusage.ru_maxrss / 1024:.0f} MB"
+        )
+        if result == 0:
+            result = p.returncode
+    for killer in killers:
+        killer.cancel()
+    for reader in readers:
+        reader.join()
+    end = time.time()
+    sdtoutl = b"".join(out_lines)
+    stderrl = b"".join(err_lines)
+
+    if timed_out.is_set():
+        reason = f"Commands killed: no end after the timeout of {timeout} s"
+        stderrl += ("\n" + reason).encode()
+        print(colored(reason, "red"))
+        if result == 0:
+            result = 1
+    if log is not None:
+        log.write(f"### exit code {result}, {end - start:.1f} s\n")
+        log.close()
+    if not stream:
+        if str(sdtoutl) != "":
+            print("sdtoutl: ", sdtoutl.decode())
+        if str(stderrl) != "":
+            print("stderrl: ", stderrl.decode())
+    print(f"--------->Wall time: {end - start:.1f} s")
 
     return result, stderrl, sdtoutl
 
 
 def convert_mif_to_nifti(in_file, out_directory, diff=True):
     """
-    Convert NIfTI into MIF format
+    Convert MIF into NIfTI format
+    (only if needed, see conversions.get_image)
 
     Parameters: 
     - in_file: file in .mif format
-    - out_directory: path to the directory that should store the .mif file 
+    - out_directory: path to the directory that should store the .nii.gz file
     - diff: by default set to True to take the bvec and bval files 
 
     Returns:
-    - int: 1 problem, 0 success
+    - int: 1 success, 0 problem
     - msg 
     - in_file_niftii: converted file in .nii format
     """
+    from conversions import get_image
 
-    in_file_nifti = None
     # Check inputs files and get files name
     valid_bool, ext, file_name = check_file_ext(in_file, EXT_MIF)
     if not valid_bool:
         msg = "\nInput image format is not " "recognized (mif needed)...!"
         print(msg)
-        return 0, msg, in_file_nifti
-
-    # Convert diffusions into ".mif" format (mrtrix format)
-    in_file_nifti = os.path.join(out_directory, file_name + ".nii.gz")
-    if not verify_file(in_file_nifti):
-        if diff:
-            bvec = in_file.replace(ext, "bvec")
-            bval = in_file.replace(ext, "bval")
-            cmd = [
-                "mrconvert",
-                in_file,
-                in_file_nifti,
-                "-export_grad_fsl",
-                bvec,
-                bval,
-            ]
-        else:
-            cmd = ["mrconvert", in_file, in_file_nifti]
-        result, stderrl, sdtoutl = execute_command(cmd)
-        if result != 0:
-            msg = f"Issue during conversion of {in_file} to nifti format"
-            return 0, msg, in_file_nifti
-        msg = f"Conversion of {in_file} to nifti format done"
-        print(msg)
-    else:
-        msg = None
-    return 1, msg, in_file_nifti
+        return 0, msg, None
+
+    return get_image(in_file, "nifti", out_directory, diff=diff)
 
 
 def convert_nifti_to_mif(in_file, out_directory, diff=True):
     """Convert NIfTI into MIF format
+    (only if needed, see conversions.get_image)
     
     Parameters:
     - in_file: file in .nii format 
@@ -159,11 +393,11 @@ def convert_nifti_to_mif(in_file, out_directory, diff=True):
     - diff: by default set to True to take the bvec and bval files 
 
     Returns:
-    - int: 1 problem, 0 success
+    - int: 1 success, 0 problem
     - msg 
     - in_file_mif: converted file in .mif format
     """
-    in_file_mif = None
+    from conversions import get_image
 
     # Check inputs files and get files name
     valid_bool, ext, file_name = check_file_ext(in_file, EXT_NIFTI)
@@ -172,31 +406,9 @@ def convert_nifti_to_mif(in_file, out_directory, diff=True):
             "\nInput image format is not "
             "recognized (nii or nii.gz needed)...!"
         )
-        return 0, msg, in_file_mif
-
-    # Check if output MIF file already exists
-    in_file_mif = os.path.join(out_directory, file_name + ".mif")
-    if verify_file(in_file_mif):
-        return 1, "", in_file_mif
-
-    # Convert diffusions into ".mif" format (mrtrix format)
-    # in_file_mif = os.path.join(out_directory, file_name + ".mif")
-    if diff:
-        bvec = in_file.replace(ext, "bvec")
-        bval = in_file.replace(ext, "bval")
-        cmd = ["mrconvert", in_file, in_file_mif, "-fslgrad", bvec, bval]
-    else:
-        cmd = ["mrconvert", in_file, in_file_mif]
-
-    result, stderrl, sdtoutl = execute_command(cmd)
+        return 0, msg, None
 
-    if result != 0:
-        msg = f"\nIssue during conversion of {in_file} to MIF format"
-        return 0, msg, in_file_mif
-
-    msg = f"\nConversion of {in_file} to MIF format done"
-
-    return 1, msg, in_file_mif
+    return get_image(in_file, "mif", out_directory, diff=diff)
 
 
 def get_shell(in_file):
@@ -217,14 +429,17 @@ def get_shell(in_file):
         msg = "\nInput image format is not recognized (mif needed)...!"
         return 0, msg, shell
 
-    cmd = ["mrinfo", in_file, "-shell_bvalues"]
-    result, stderrl, sdtoutl = execute_command(cmd)
+    # Read the gradient table of the header, mrinfo if it can not be read
+    shell = get_shell_bvalues(in_file)
+    if shell is None:
+        cmd = ["mrinfo", in_file, "-shell_bvalues"]
+        result, stderrl, sdtoutl = execute_command(cmd)
 
-    if result != 0:
-        msg = f"\nCan not get info for {in_file}"
-        return 0, msg, shell
-    shell = sdtoutl.decode("utf-8").replace("\n", "").split(" ")
-    shell = [i for i in shell if i != ""]
+        if result != 0:
+            msg = f"\nCan not get info for {in_file}"
+            return 0, msg, []
+        shell = sdtoutl.decode("utf-8").replace("\n", "").split(" ")
+        shell = [i for i in shell if i != ""]
     msg = f"\nShell found for {in_file}"
 
     return 1, msg, shell
@@ -0,0 +1,221 @@
+"""
+Automatic detection of corrupted volumes (list given to remove_volumes).
+Each volume is scored in one pass over the memory-mapped DWI (signal
+of the voxels of a rough mask only, see dwi_dataset.MaskedDWI):
+    - slice dropout: slices much darker than the same slice in the other
+      volumes of the shell
+    - intensity outlier: mean signal far from the other volumes of the shell
+    - motion and eddy outliers: read in the eddy qc_text directory of a
+      previous run (eddy_movement_rms, eddy_outlier_map) when present
+Functions:
+    - read_eddy_qc
+    - score_volumes
+    - detect_outlier_volumes: write volumes_to_remove.txt and volume_qc.csv
+"""
+
+import csv
+import os
+
+import numpy as np
+from termcolor import colored
+
+from dwi_dataset import MaskedDWI
+from mif_io import get_fsl_gradients, load_mif
+from native_tools import BVALUE_EPSILON, BZERO_THRESHOLD
+
+# Robust z-score (median / MAD) above which a slice or volume is an outlier
+Z_THRESHOLD = 4.0
+# A volume is removed if more slices than this are dropped out
+MAX_DROPOUT_SLICES = 1
+# Relative RMS displacement (mm) from eddy
+MAX_MOTION_MM = 2.0
+# Fraction of slices replaced by eddy (--repol outlier map)
+MAX_EDDY_OUTLIER_FRACTION = 0.1
+# Never remove more than this fraction of the volumes of a shell
+MAX_REMOVED_FRACTION = 0.2
+
+QC_FIELDS = [
+    "volume", "bval", "dropout_slices", "intensity_z",
+    "motion_mm", "eddy_outlier_fraction", "score", "removed",
+]
+
+
+def _get_shells(bvals):
+    """Shell index of each volume (b=0 volumes are shell 0)"""
+    labels = np.zeros(len(bvals), dtype=int)
+    order = np.argsort(bvals)
+    shell = 0
+    previous = None
+    for volume in order:
+        b = bvals[volume]
+        if b > BZERO_THRESHOLD and (previous is None or b - previous > BVALUE_EPSILON):
+            shell += 1
+        if b > BZERO_THRESHOLD:
+            previous = b
+        labels[volume] = shell
+    return labels
+
+
+def _robust_z(values, axis=-1):
+    """Robust z-score (median / MAD) along an axis, 0 where MAD is 0"""
+    median = np.median(values, axis=axis, keepdims=True)
+    mad = 1.4826 * np.median(np.abs(values - median), axis=axis, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = np.where(mad > 0, (values - median) / mad, 0.0)
+    return z
+
+
+def read_eddy_qc(qc_directory, n_volumes):
+    """
+    Read motion and outliers per volume in the eddy qc_text directory
+
+    Parameters:
+    - qc_directory (string): directory given to dwifslpreproc -eddyqc_text
+    - n_volumes (int): number of volumes of the DWI
+
+    Returns:
+    - motion (array): relative RMS displacement (mm), None if not found
+    - outlier_fraction (array): fraction of outlier slices, None if not found
+    """
+    motion = None
+    outlier_fraction = None
+    if qc_directory is None:
+        return motion, outlier_fraction
+    movement_rms = os.path.join(qc_directory, "eddy_movement_rms")
+    if os.path.exists(movement_rms):
+        table = np.loadtxt(movement_rms, ndmin=2)
+        if table.shape[0] == n_volumes:
+            motion = table[:, 1]
+    outlier_map = os.path.join(qc_directory, "eddy_outlier_map")
+    if os.path.exists(outlier_map):
+        # First line is a description
+        table = np.loadtxt(outlier_map, skiprows=1, ndmin=2)
+        if table.shape[0] == n_volumes:
+            outlier_fraction = table.mean(axis=1)
+    if motion is None and outlier_fraction is None:
+        print(colored(f"\nNo eddy QC found in {qc_directory}", "yellow"))
+    return motion, outlier_fraction
+
+
+def score_volumes(in_dwi, qc_directory=None):
+    """
+    Score every volume of a DWI
+
+    Parameters:
+    - in_dwi (string): path to the DWI (.mif)
+    - qc_directory (string): (optionnal) eddy qc_text directory
+
+    Returns:
+    - scores (dict): {field of QC_FIELDS: array (one value per volume)}
+    """
+    data, header = load_mif(in_dwi)
+    bvals, _ = get_fsl_gradients(header)
+    n_volumes = data.shape[3]
+    if bvals is None:
+        bvals = np.zeros(n_volumes)
+    shells = _get_shells(bvals)
+
+    # Rough mask from the mean b0 (or the first volume)
+    b0_volumes = np.flatnonzero(shells == 0)
+    reference = np.zeros(data.shape[:3], dtype=np.float64)
+    for volume in (b0_volumes if len(b0_volumes) else [0]):
+        reference += data[..., volume]
+    reference /= max(1, len(b0_volumes))
+    mask = reference > 0.1 * np.percentile(reference, 99)
+    n_slice_voxels = mask.sum(axis=(0, 1))
+    slices = n_slice_voxels > 0.05 * n_slice_voxels.max()
+
+    # One pass: signal of the voxels of the mask, then mean of each slice
+    masked = MaskedDWI(data, mask)
+    slice_index = masked.indices[2]
+    slice_means = np.zeros((n_volumes, data.shape[2]))
+    for volume in range(n_volumes):
+        slice_means[volume] = np.bincount(
+            slice_index, weights=masked.signal[:, volume], minlength=data.shape[2]
+        ) / np.maximum(n_slice_voxels, 1)
+    volume_means = (slice_means * n_slice_voxels).sum(axis=1) / max(1, n_slice_voxels.sum())
+
+    dropout = np.zeros(n_volumes, dtype=int)
+    intensity_z = np.zeros(n_volumes)
+    for shell in np.unique(shells):
+        in_shell = np.flatnonzero(shells == shell)
+        if len(in_shell) < 3:
+            continue
+        z_slices = _robust_z(slice_means[in_shell][:, slices], axis=0)
+        dropout[in_shell] = (z_slices < -Z_THRESHOLD).sum(axis=1)
+        intensity_z[in_shell] = _robust_z(volume_means[in_shell])
+
+    motion, outlier_fraction = read_eddy_qc(qc_directory, n_volumes)
+    return {
+        "volume": np.arange(n_volumes),
+        "bval": bvals,
+        "shell": shells,
+        "dropout_slices": dropout,
+        "intensity_z": intensity_z,
+        "motion_mm": motion if motion is not None else np.full(n_volumes, np.nan),
+        "eddy_outlier_fraction": (
+            outlier_fraction if outlier_fraction is not None else np.full(n_volumes, np.nan)
+        ),
+    }
+
+
+def detect_outlier_volumes(in_dwi, out_directory, qc_directory=None):
+    """
+    Detect corrupted volumes and write the list of volumes to remove
+
+    A volume is removed if it has dropped out slices, an abnormal mean
+    signal, too much motion or too many eddy outliers. In each shell, at
+    most MAX_REMOVED_FRACTION of the volumes (the worst ones) are removed.
+
+    Parameters:
+    - in_dwi (string): path to the DWI (.mif)
+    - out_directory (string): output directory
+    - qc_directory (string): (optionnal) eddy qc_text directory of a
+                             previous run with all volumes
+
+    Returns:
+    - int: 1 success, 0 failure
+    - msg
+    - volumes_file (string): path to volumes_to_remove.txt
+    """
+    volumes_file = os.path.join(out_directory, "volumes_to_remove.txt")
+    print(colored("\n~~Volume QC starts~~", "cyan"))
+    try:
+        scores = score_volumes(in_dwi, qc_directory)
+    except (OSError, ValueError) as e:
+        msg = f"\nCan not score volumes of {in_dwi}: {e}"
+        return 0, msg, volumes_file
+
+    # Each criterion above its threshold adds to the score
+    with np.errstate(invalid="ignore"):
+        score = (
+            np.maximum(scores["dropout_slices"] - MAX_DROPOUT_SLICES, 0)
+            + np.maximum(np.abs(scores["intensity_z"]) - Z_THRESHOLD, 0)
+            + np.nan_to_num(np.maximum(scores["motion_mm"] - MAX_MOTION_MM, 0))
+            + np.nan_to_num(np.maximum(
+                scores["eddy_outlier_fraction"] - MAX_EDDY_OUTLIER_FRACTION, 0) * 10)
+        )
+    removed = np.zeros(len(score), dtype=bool)
+    for shell in np.unique(scores["shell"]):
+        in_shell = np.flatnonzero(scores["shell"] == shell)
+        candidates = in_shell[score[in_shell] > 0]
+        # Keep at least one volume and most of the shell
+        n_max = min(int(MAX_REMOVED_FRACTION * len(in_shell)), len(in_shell) - 1)
+        worst = candidates[np.argsort(score[candidates])[::-1]][:max(0, n_max)]
+        removed[worst] = True
+    scores["score"] = score
+    scores["removed"] = removed.astype(int)
+
+    os.makedirs(out_directory, exist_ok=True)
+    with open(volumes_file, "w") as file:
+        file.write(" ".join(str(v) for v in np.flatnonzero(removed)) + "\n")
+    with open(os.path.join(out_directory, "volume_qc.csv"), "w", newline="") as stream:
+        writer = csv.writer(stream, delimiter=";")
+        writer.writerow(QC_FIELDS)
+        for volume in range(len(score)):
+            writer.writerow([scores[field][volume] for field in QC_FIELDS])
+
+    msg = (f"\nVolume QC done: {removed.sum()} volumes to remove "
+           f"{list(np.flatnonzero(removed))} ({volumes_file})")
+    print(colored(msg, "cyan"))
+    return 1, msg, volumes_file
@@ -0,0 +1,9 @@
+"""
+The modules of the pipeline are imported as top-level modules
+(as main.py does)
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "resstore-mri-dwi"))
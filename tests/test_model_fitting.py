@@ -0,0 +1,32 @@
+"""Chunked fits (model_fitting) against the serial fit"""
+
+import numpy as np
+import pytest
+from dipy.core.gradients import gradient_table
+from dipy.sims.voxel import single_tensor
+
+from model_fitting import fit_masked
+
+
+def _get_signal(n_voxels=300, seed=0):
+    """Two-shell gradient table and noisy tensor signals"""
+    rng = np.random.default_rng(seed)
+    bvecs = rng.normal(size=(63, 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, None]
+    bvecs[:3] = 0
+    bvals = np.r_[[0] * 3, [1000] * 30, [2000] * 30].astype(float)
+    gtab = gradient_table(bvals, bvecs)
+    signal = np.empty((n_voxels, len(bvals)), dtype=np.float32)
+    for voxel in range(n_voxels):
+        evals = np.sort(rng.uniform(0.2e-3, 1.8e-3, 3))[::-1]
+        signal[voxel] = single_tensor(gtab, S0=1000, evals=evals, snr=30, rng=rng)
+    return signal, bvals, bvecs
+
+
+@pytest.mark.parametrize("model_name", ["DTI", "DKI"])
+def test_chunked_fit_is_serial_fit(model_name):
+    signal, bvals, bvecs = _get_signal()
+    serial = fit_masked(model_name, signal, bvals, bvecs, n_jobs=1, chunk_size=len(signal))
+    chunked = fit_masked(model_name, signal, bvals, bvecs, n_jobs=2, chunk_size=37)
+    for metric, values in serial.items():
+        assert np.abs(chunked[metric] - values).max() == 0.0, metric
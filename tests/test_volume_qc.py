@@ -0,0 +1,32 @@
+"""Detection of corrupted volumes (volume_qc)"""
+
+import os
+
+import numpy as np
+
+from mif_io import save_mif
+from volume_qc import detect_outlier_volumes
+
+
+def test_damaged_volume_is_removed(tmp_path):
+    rng = np.random.default_rng(0)
+    shape = (20, 20, 12)
+    grid = np.indices(shape) - np.array(shape)[:, None, None, None] / 2
+    head = (grid ** 2).sum(axis=0) < 8 ** 2
+    bvals = np.r_[[0] * 3, [1000] * 20]
+    data = np.zeros(shape + (len(bvals),), dtype=np.float32)
+    for volume, bval in enumerate(bvals):
+        data[..., volume] = head * 1000 * np.exp(-bval * 0.7e-3)
+    data += rng.normal(scale=5, size=data.shape).astype(np.float32)
+    # Volume 10: signal dropout in three slices
+    damaged = 10
+    data[:, :, 4:7, damaged] *= 0.2
+    dw_scheme = np.c_[np.tile(np.eye(3), (8, 1))[:len(bvals)], bvals]
+    in_dwi = str(tmp_path / "dwi.mif")
+    save_mif(in_dwi, data, vox=[2.0] * 4, dw_scheme=dw_scheme)
+
+    result, msg, volumes_file = detect_outlier_volumes(in_dwi, str(tmp_path / "qc"))
+    assert result == 1, msg
+    with open(volumes_file) as file:
+        assert file.read().split() == [str(damaged)]
+    assert os.path.exists(str(tmp_path / "qc" / "volume_qc.csv"))